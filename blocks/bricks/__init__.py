@@ -7,8 +7,8 @@ from .bn import (BatchNormalization, SpatialBatchNormalization,
 from .interfaces import (Activation, Feedforward, Initializable, LinearLike,
                          Random)
 from .recurrent import (BaseRecurrent, SimpleRecurrent, LSTM, GatedRecurrent,
-                        Bidirectional, RecurrentStack, RECURRENTSTACK_SEPARATOR,
-                        recurrent)
+                        FusedLSTM, ResetAfterGatedRecurrent, Bidirectional,
+                        RecurrentStack, RECURRENTSTACK_SEPARATOR, recurrent)
 from .simple import (Linear, Bias, Maxout, LinearMaxout, Identity, Tanh,
                      Logistic, Softplus, Rectifier, LeakyRectifier,
                      Softmax, NDimensionalSoftmax)
@@ -23,5 +23,5 @@ __all__ = ('application', 'Brick', 'lazy', 'BatchNormalization',
            'Softmax', 'NDimensionalSoftmax', 'Sequence',
            'FeedforwardSequence', 'MLP', 'WithExtraDims',
            'BaseRecurrent', 'SimpleRecurrent', 'LSTM', 'GatedRecurrent',
-           'Bidirectional', 'RecurrentStack', 'RECURRENTSTACK_SEPARATOR',
-           'recurrent')
+           'FusedLSTM', 'ResetAfterGatedRecurrent', 'Bidirectional',
+           'RecurrentStack', 'RECURRENTSTACK_SEPARATOR', 'recurrent')
@@ -448,6 +448,196 @@ class ShallowEnergyComputer(Sequence, Initializable, Feedforward):
         self.children[1].output_dim = value
 
 
+class LocalContentAttention(SequenceContentAttention):
+    """Content attention restricted to a window of the sequence.
+
+    Like :class:`SequenceContentAttention`, but the energies are only
+    computed for the `2 * window_size + 1` elements of the sequence around
+    a position, which makes the cost of a step independent of the length
+    of the sequence. This is the local attention of [LPM]_. The position
+    either moves by one element every step (the monotonic mode) or is
+    predicted from the states (the predictive mode), in which case the
+    weights are also scaled by a Gaussian centered at the position.
+
+    The weights are returned for the window only, together with its
+    position, which is an additional glimpse carried over in the monotonic
+    mode. Use :meth:`dense_weights` to get the weights for the whole
+    sequence, with zeros outside of the window, like the ones of
+    :class:`SequenceContentAttention`.
+
+    Parameters
+    ----------
+    window_size : int
+        The number of elements on each side of the position.
+    predictive : bool, optional
+        If ``True``, the position is predicted from the states, otherwise
+        it is the number of the step. ``False`` by default.
+    position_computer : :class:`.Feedforward`, optional
+        Computes the position from the sum of the transformed states in
+        the predictive mode, the result is scaled to the length of the
+        sequence with a sigmoid. If ``None``, an affine transformation
+        preceded by :math:`tanh` is used.
+
+    Notes
+    -----
+    See :class:`SequenceContentAttention` for the other parameters.
+
+    .. [LPM] Minh-Thang Luong, Hieu Pham and Christopher D. Manning.
+       Effective Approaches to Attention-based Neural Machine Translation.
+
+    """
+    @lazy(allocation=['match_dim', 'window_size'])
+    def __init__(self, match_dim, window_size, predictive=False,
+                 position_computer=None, **kwargs):
+        self.window_size = window_size
+        self.predictive = predictive
+        children = []
+        if predictive:
+            if not position_computer:
+                position_computer = ShallowEnergyComputer(
+                    name="position_comp")
+            self.position_computer = position_computer
+            children.append(position_computer)
+        kwargs.setdefault('children', []).extend(children)
+        super(LocalContentAttention, self).__init__(match_dim, **kwargs)
+
+    def _push_allocation_config(self):
+        super(LocalContentAttention, self)._push_allocation_config()
+        if self.predictive:
+            self.position_computer.input_dim = self.match_dim
+            self.position_computer.output_dim = 1
+
+    @application(outputs=['weighted_averages', 'weights', 'positions'])
+    def take_glimpses(self, attended, preprocessed_attended=None,
+                      attended_mask=None, positions=None, **states):
+        r"""Compute attention weights in a window and produce glimpses.
+
+        Parameters
+        ----------
+        attended : :class:`~tensor.TensorVariable`
+            The sequence, time is the 1-st dimension.
+        preprocessed_attended : :class:`~tensor.TensorVariable`
+            The preprocessed sequence. If ``None``, is computed by calling
+            :meth:`preprocess`.
+        attended_mask : :class:`~tensor.TensorVariable`
+            A 0/1 mask specifying available data. 0 means that the
+            corresponding sequence element is fake.
+        positions : :class:`~tensor.TensorVariable`
+            The positions of the previous step, required in the monotonic
+            mode and ignored in the predictive one.
+        \*\*states
+            The states of the network.
+
+        Returns
+        -------
+        weighted_averages : :class:`~theano.Variable`
+            Linear combinations of sequence elements with the attention
+            weights.
+        weights : :class:`~theano.Variable`
+            The attention weights in the window. The first dimension is
+            batch, the second is the offset in the window.
+        positions : :class:`~theano.Variable`
+            The positions of the windows.
+
+        """
+        if not self.predictive and positions is None:
+            raise ValueError("the positions of the previous step are "
+                             "required in the monotonic mode")
+        if not preprocessed_attended:
+            preprocessed_attended = self.preprocess(attended)
+        transformed_states = self.state_transformers.apply(as_dict=True,
+                                                           **states)
+        states_sum = sum(transformed_states.values())
+        length = attended.shape[0]
+        if self.predictive:
+            lengths = (attended_mask.sum(axis=0) if attended_mask
+                       else tensor.cast(length, attended.dtype))
+            positions = (lengths - 1) * tensor.nnet.sigmoid(
+                self.position_computer.apply(states_sum)[:, 0])
+        else:
+            positions = positions + 1
+
+        # Gather the window, indices outside of the sequence are masked
+        indices, window_mask = self._window_indices(positions, length)
+        batch_indices = (tensor.zeros_like(indices) +
+                         tensor.arange(attended.shape[1])[None, :])
+        window_mask = tensor.cast(window_mask, attended.dtype)
+        if attended_mask:
+            window_mask *= attended_mask[indices, batch_indices]
+
+        match_vectors = states_sum + preprocessed_attended[indices,
+                                                           batch_indices]
+        energies = self.energy_computer.apply(match_vectors).reshape(
+            match_vectors.shape[:-1], ndim=match_vectors.ndim - 1)
+        weights = self.compute_weights(energies, window_mask)
+        if self.predictive:
+            sigma = self.window_size / 2.
+            distances = (tensor.cast(indices, positions.dtype) -
+                         positions[None, :])
+            weights *= tensor.exp(-distances ** 2 / (2 * sigma ** 2))
+        weighted_averages = self.compute_weighted_averages(
+            weights, attended[indices, batch_indices])
+        return weighted_averages, weights.T, positions
+
+    @take_glimpses.property('inputs')
+    def take_glimpses_inputs(self):
+        inputs = ['attended', 'preprocessed_attended', 'attended_mask']
+        if not self.predictive:
+            inputs.append('positions')
+        return inputs + self.state_names
+
+    @application(outputs=['weighted_averages', 'weights', 'positions'])
+    def initial_glimpses(self, batch_size, attended):
+        return [tensor.zeros((batch_size, self.attended_dim)),
+                tensor.zeros((batch_size, 2 * self.window_size + 1)),
+                -tensor.ones((batch_size,))]
+
+    @application(inputs=['weights', 'positions'], outputs=['dense_weights'])
+    def dense_weights(self, weights, positions, length):
+        """Scatter the window weights over the whole sequence.
+
+        Parameters
+        ----------
+        weights : :class:`~tensor.TensorVariable`
+            The weights in the windows, as returned by
+            :meth:`take_glimpses`.
+        positions : :class:`~tensor.TensorVariable`
+            The positions of the windows.
+        length : int or :class:`~tensor.TensorVariable`
+            The length of the attended sequence.
+
+        Returns
+        -------
+        dense_weights : :class:`~theano.Variable`
+            The attention weights with zeros outside of the window. The
+            first dimension is batch, the second is time.
+
+        """
+        indices, _ = self._window_indices(positions, length)
+        batch_indices = (tensor.zeros_like(indices) +
+                         tensor.arange(weights.shape[0])[None, :])
+        # The weights outside of the sequence are zero, so adding them to
+        # the clipped indices changes nothing
+        return tensor.inc_subtensor(
+            tensor.zeros((weights.shape[0], length),
+                         dtype=weights.dtype)[batch_indices, indices],
+            weights.T)
+
+    def _window_indices(self, positions, length):
+        offsets = tensor.arange(-self.window_size, self.window_size + 1)
+        indices = (tensor.cast(tensor.round(positions), 'int64')[None, :] +
+                   offsets[:, None])
+        window_mask = tensor.ge(indices, 0) * tensor.lt(indices, length)
+        return tensor.clip(indices, 0, length - 1), window_mask
+
+    def get_dim(self, name):
+        if name == 'weights':
+            return 2 * self.window_size + 1
+        if name == 'positions':
+            return 0
+        return super(LocalContentAttention, self).get_dim(name)
+
+
 @add_metaclass(ABCMeta)
 class AbstractAttentionRecurrent(BaseRecurrent):
     """The interface for attention-equipped recurrent transitions.
@@ -667,6 +857,18 @@ class AttentionRecurrent(AbstractAttentionRecurrent, Initializable):
     def compute_states_outputs(self):
         return self._state_names
 
+    def project_inputs(self, application_name, sequences):
+        """Project the sequences the distribute does not change.
+
+        The distribute adds the glimpses of the current step to the
+        sequences it targets, so only the other sequences of the wrapped
+        transition can be projected before the iteration.
+
+        """
+        return self.transition.project_inputs(
+            'apply', {name: sequence for name, sequence in sequences.items()
+                      if name not in self.distribute.apply.outputs})
+
     @recurrent
     def do_apply(self, **kwargs):
         r"""Process a sequence attending the attended context every step.
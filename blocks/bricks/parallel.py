@@ -2,9 +2,12 @@
 import copy
 
 from picklable_itertools.extras import equizip
+from theano import tensor
 
-from blocks.bricks.base import lazy, application
+from blocks.bricks.base import (lazy, application, ApplicationCall,
+                                copy_and_tag)
 from blocks.bricks.simple import Initializable, Linear
+from blocks.roles import OUTPUT
 from blocks.utils import pack, extract_args
 
 
@@ -128,6 +131,21 @@ class Fork(Parallel):
     prototype : :class:`~blocks.bricks.Feedforward`, optional
         The transformation prototype. A copy will be created for every
         input. By default an affine transformation is used.
+    fused : bool, optional
+        If ``True``, the weights of the copies are concatenated and the
+        input is multiplied by them at once, which replaces a matrix
+        product per output by a single one. The copies keep their
+        parameters, so the parameter names do not change. Requires the
+        prototype to be a :class:`.Linear` brick. ``False`` by default.
+        Each slice of the fused product is annotated as the output of the
+        `apply` application of its copy, so filtering the outputs of a
+        copy keeps working. The inputs of the copies are not annotated,
+        since the copies share a single product. The weights are
+        concatenated in the graph, which costs one copy of them per call
+        of the compiled function (scan moves it out of its loop); storing
+        them in a single shared variable would save that copy, but would
+        change the parameters of the copies and break existing
+        checkpoints.
 
     Attributes
     ----------
@@ -145,12 +163,16 @@ class Fork(Parallel):
 
     """
     @lazy(allocation=['input_dim'])
-    def __init__(self, output_names, input_dim,  prototype=None, **kwargs):
+    def __init__(self, output_names, input_dim,  prototype=None, fused=False,
+                 **kwargs):
         if not prototype:
             prototype = Linear()
+        if fused and not isinstance(prototype, Linear):
+            raise ValueError("only Linear transformations can be fused")
 
         self.output_names = output_names
         self.input_dim = input_dim
+        self.fused = fused
 
         kwargs.setdefault('child_prefix', 'fork')
         super(Fork, self).__init__(output_names, prototype=prototype,
@@ -163,9 +185,31 @@ class Fork(Parallel):
 
     @application(inputs=['input_'])
     def apply(self, input_):
+        if self.fused:
+            return self._apply_fused(input_)
         return super(Fork, self).apply(**{name: input_
                                           for name in self.input_names})
 
+    def _apply_fused(self, input_):
+        output = tensor.dot(input_, tensor.concatenate(
+            [child.W for child in self.children], axis=1))
+        if any(getattr(child, 'use_bias', True) for child in self.children):
+            output += tensor.concatenate(
+                [child.b if getattr(child, 'use_bias', True)
+                 else tensor.zeros((child.output_dim,), dtype=output.dtype)
+                 for child in self.children])
+        outputs = []
+        start = 0
+        for child in self.children:
+            call = ApplicationCall(child.apply)
+            outputs.append(copy_and_tag(
+                output[(slice(None),) * (output.ndim - 1) +
+                       (slice(start, start + child.output_dim),)],
+                child, call, OUTPUT, child.apply.name,
+                child.apply.outputs[0]))
+            start += child.output_dim
+        return outputs
+
     @apply.property('outputs')
     def apply_outputs(self):
         return super(Fork, self).apply.outputs
@@ -222,7 +266,8 @@ class Distribute(Fork):
 
     Notes
     -----
-    See :class:`.Initializable` for initialization parameters.
+    See :class:`.Initializable` for initialization parameters and
+    :class:`Fork` for the fused mode.
 
     """
     @lazy(allocation=['source_name', 'target_dims', 'source_dim'])
@@ -1,3 +1,5 @@
 from .base import BaseRecurrent, recurrent
-from .architectures import SimpleRecurrent, LSTM, GatedRecurrent
+from .architectures import (SimpleRecurrent, LSTM, GatedRecurrent,
+                            FusedLSTM, ResetAfterGatedRecurrent,
+                            convert_lstm_layout, convert_recurrent_parameters)
 from .misc import Bidirectional, RecurrentStack, RECURRENTSTACK_SEPARATOR
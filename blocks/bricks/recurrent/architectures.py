@@ -370,3 +370,286 @@ class GatedRecurrent(BaseRecurrent, Initializable):
     @application(outputs=apply.states)
     def initial_states(self, batch_size, *args, **kwargs):
         return [tensor.repeat(self.parameters[2][None, :], batch_size, 0)]
+
+
+class FusedLSTM(LSTM):
+    u"""Long Short Term Memory with a fused gate layout.
+
+    Computes the transition of :class:`LSTM`, but the inputs and the
+    columns of `W_state` are laid out as input gates, forget gates,
+    output gates and cells, so that the gates are computed by one
+    activation call over a contiguous block. With peepholes the output
+    gate looks at the next cells and is computed separately. Use
+    :func:`convert_lstm_layout` for the weights producing the inputs and
+    :func:`convert_recurrent_parameters` to copy the parameters of a
+    :class:`LSTM`.
+
+    Parameters
+    ----------
+    dim : int
+        The dimension of the hidden state.
+    activation : :class:`~.bricks.Brick`, optional
+        The activation function, :class:`.Tanh` by default.
+    gate_activation : :class:`~.bricks.Brick` or None
+        The activation of the gates, :class:`.Logistic` by default.
+    peepholes : bool, optional
+        Whether the gates look at the cells, ``True`` by default.
+    coupled_gates : bool, optional
+        If ``True``, the input gate is one minus the forget gate and the
+        inputs have no block for it. ``False`` by default.
+
+    Notes
+    -----
+    See :class:`.Initializable` for initialization parameters.
+
+    """
+    @lazy(allocation=['dim'])
+    def __init__(self, dim, activation=None, gate_activation=None,
+                 peepholes=True, coupled_gates=False, **kwargs):
+        self.peepholes = peepholes
+        self.coupled_gates = coupled_gates
+        super(FusedLSTM, self).__init__(dim, activation, gate_activation,
+                                        **kwargs)
+
+    @property
+    def num_gates(self):
+        return 2 if self.coupled_gates else 3
+
+    def get_dim(self, name):
+        if name == 'inputs':
+            return self.dim * (self.num_gates + 1)
+        return super(FusedLSTM, self).get_dim(name)
+
+    def _allocate(self):
+        self.W_state = shared_floatx_nans(
+            (self.dim, (self.num_gates + 1) * self.dim), name='W_state')
+        add_role(self.W_state, WEIGHT)
+        self.parameters = [self.W_state]
+        if self.peepholes:
+            names = ['W_cell_to_forget', 'W_cell_to_out']
+            if not self.coupled_gates:
+                names.insert(0, 'W_cell_to_in')
+            for name in names:
+                peephole = shared_floatx_nans((self.dim,), name=name)
+                add_role(peephole, WEIGHT)
+                setattr(self, name, peephole)
+                self.parameters.append(peephole)
+        self.initial_state_ = shared_floatx_zeros((self.dim,),
+                                                  name="initial_state")
+        self.initial_cells = shared_floatx_zeros((self.dim,),
+                                                 name="initial_cells")
+        add_role(self.initial_state_, INITIAL_STATE)
+        add_role(self.initial_cells, INITIAL_STATE)
+        self.parameters.extend([self.initial_state_, self.initial_cells])
+
+    def _initialize(self):
+        for weights in self.parameters[:-2]:
+            self.weights_init.initialize(weights, self.rng)
+
+    @recurrent(sequences=['inputs', 'mask'], states=['states', 'cells'],
+               contexts=[], outputs=['states', 'cells'])
+    def apply(self, inputs, states, cells, mask=None):
+        """Apply the fused Long Short Term Memory transition.
+
+        The arguments and the outputs are the ones of :meth:`LSTM.apply`,
+        except for the layout of the inputs.
+
+        """
+        dim = self.dim
+        activation = tensor.dot(states, self.W_state) + inputs
+        num_gates = self.num_gates
+        if self.peepholes:
+            # The gates looking at the current cells
+            if self.coupled_gates:
+                peepholes = self.W_cell_to_forget
+            else:
+                peepholes = tensor.concatenate([self.W_cell_to_in,
+                                                self.W_cell_to_forget])
+            gates = self.gate_activation.apply(
+                activation[:, :(num_gates - 1) * dim] +
+                tensor.tile(cells, (1, num_gates - 1)) * peepholes)
+        else:
+            gates = self.gate_activation.apply(
+                activation[:, :num_gates * dim])
+        if self.coupled_gates:
+            forget_gate = gates[:, :dim]
+            in_gate = 1 - forget_gate
+        else:
+            in_gate = gates[:, :dim]
+            forget_gate = gates[:, dim:2 * dim]
+        next_cells = (
+            forget_gate * cells +
+            in_gate * self.activation.apply(activation[:, num_gates * dim:]))
+        if self.peepholes:
+            out_gate = self.gate_activation.apply(
+                activation[:, (num_gates - 1) * dim:num_gates * dim] +
+                next_cells * self.W_cell_to_out)
+        else:
+            out_gate = gates[:, (num_gates - 1) * dim:]
+        next_states = out_gate * self.activation.apply(next_cells)
+
+        if mask:
+            next_states = (mask[:, None] * next_states +
+                           (1 - mask[:, None]) * states)
+            next_cells = (mask[:, None] * next_cells +
+                          (1 - mask[:, None]) * cells)
+
+        return next_states, next_cells
+
+
+class ResetAfterGatedRecurrent(BaseRecurrent, Initializable):
+    u"""Gated recurrent network with the reset gates after the product.
+
+    A different cell from :class:`GatedRecurrent`: the reset gates are
+    applied to the product of the states with the state-to-state weights
+    instead of to the states, like in the "reset after" variant of the
+    gated recurrent unit. The gates and the candidate states are then
+    computed by one matrix product per step with `W_state`, laid out as
+    update gates, reset gates and state-to-state weights. It is not a
+    replacement of :class:`GatedRecurrent`, the parameters of one can
+    not be used by the other.
+
+    Parameters
+    ----------
+    dim : int
+        The dimension of the hidden state.
+    activation : :class:`~.bricks.Brick` or None
+        The brick to apply as activation. If ``None`` a
+        :class:`.Tanh` brick is used.
+    gate_activation : :class:`~.bricks.Brick` or None
+        The brick to apply as activation for gates. If ``None`` a
+        :class:`.Logistic` brick is used.
+
+    Notes
+    -----
+    See :class:`.Initializable` for initialization parameters.
+
+    """
+    @lazy(allocation=['dim'])
+    def __init__(self, dim, activation=None, gate_activation=None,
+                 **kwargs):
+        self.dim = dim
+
+        if not activation:
+            activation = Tanh()
+        if not gate_activation:
+            gate_activation = Logistic()
+        self.activation = activation
+        self.gate_activation = gate_activation
+
+        children = [activation, gate_activation]
+        kwargs.setdefault('children', []).extend(children)
+        super(ResetAfterGatedRecurrent, self).__init__(**kwargs)
+
+    def get_dim(self, name):
+        if name == 'mask':
+            return 0
+        if name in ['inputs', 'states']:
+            return self.dim
+        if name == 'gate_inputs':
+            return 2 * self.dim
+        return super(ResetAfterGatedRecurrent, self).get_dim(name)
+
+    def _allocate(self):
+        self.W_state = shared_floatx_nans((self.dim, 3 * self.dim),
+                                          name='W_state')
+        self.initial_state_ = shared_floatx_zeros((self.dim,),
+                                                  name="initial_state")
+        add_role(self.W_state, WEIGHT)
+        add_role(self.initial_state_, INITIAL_STATE)
+        self.parameters = [self.W_state, self.initial_state_]
+
+    def _initialize(self):
+        self.W_state.set_value(numpy.hstack([
+            self.weights_init.generate(self.rng, (self.dim, self.dim))
+            for _ in range(3)]))
+
+    @recurrent(sequences=['mask', 'inputs', 'gate_inputs'],
+               states=['states'], outputs=['states'], contexts=[])
+    def apply(self, inputs, gate_inputs, states, mask=None):
+        """Apply the fused gated recurrent transition.
+
+        The arguments and the outputs are the ones of
+        :meth:`GatedRecurrent.apply`.
+
+        """
+        dim = self.dim
+        activation = tensor.dot(states, self.W_state)
+        gate_values = self.gate_activation.apply(
+            activation[:, :2 * dim] + gate_inputs)
+        update_values = gate_values[:, :dim]
+        reset_values = gate_values[:, dim:]
+        next_states = self.activation.apply(
+            reset_values * activation[:, 2 * dim:] + inputs)
+        next_states = (next_states * update_values +
+                       states * (1 - update_values))
+        if mask:
+            next_states = (mask[:, None] * next_states +
+                           (1 - mask[:, None]) * states)
+        return next_states
+
+    @application(outputs=apply.states)
+    def initial_states(self, batch_size, *args, **kwargs):
+        return [tensor.repeat(self.initial_state_[None, :], batch_size, 0)]
+
+
+def convert_lstm_layout(array, dim):
+    """Reorder the gate blocks of LSTM weights or biases.
+
+    Swaps the blocks of the output gates and of the cells, which converts
+    from the layout of :class:`LSTM` to the one of :class:`FusedLSTM`
+    with peepholes and without coupled gates, and back.
+
+    Parameters
+    ----------
+    array : :class:`numpy.ndarray`
+        The weights or biases whose last axis is laid out like the inputs
+        of :class:`LSTM`, e.g. the `W_state` of the brick or the weights
+        of the :class:`.Linear` brick producing the inputs.
+    dim : int
+        The dimension of the LSTM.
+
+    """
+    blocks = [array[..., i * dim:(i + 1) * dim] for i in range(4)]
+    # LSTM: input, forget, cells, output; FusedLSTM: input, forget,
+    # output, cells
+    order = [0, 1, 3, 2]
+    return numpy.concatenate([blocks[i] for i in order], axis=-1)
+
+
+def convert_recurrent_parameters(source, target):
+    """Copy the parameters of a transition to its fused variant.
+
+    Supports copying from :class:`LSTM` to :class:`FusedLSTM` with
+    peepholes and without coupled gates and back, which gives the same
+    function. Both bricks have to be allocated.
+
+    Parameters
+    ----------
+    source : :class:`~.bricks.Brick`
+        The brick to copy the parameters from.
+    target : :class:`~.bricks.Brick`
+        The brick to copy the parameters to.
+
+    """
+    def copy_lstm(source, target):
+        if (not getattr(source, 'peepholes', True) or
+                not getattr(target, 'peepholes', True) or
+                getattr(source, 'coupled_gates', False) or
+                getattr(target, 'coupled_gates', False)):
+            raise ValueError("can only convert LSTMs with peepholes and "
+                             "without coupled gates")
+        target.W_state.set_value(convert_lstm_layout(
+            source.W_state.get_value(), source.dim))
+        for name in ['W_cell_to_in', 'W_cell_to_forget', 'W_cell_to_out',
+                     'initial_state_', 'initial_cells']:
+            getattr(target, name).set_value(
+                getattr(source, name).get_value())
+
+    if isinstance(source, LSTM) and isinstance(target, LSTM):
+        if isinstance(target, FusedLSTM) == isinstance(source, FusedLSTM):
+            raise ValueError("can only convert between LSTM and FusedLSTM")
+        copy_lstm(source, target)
+    else:
+        raise ValueError("can not convert the parameters of {} to {}".format(
+            source, target))
@@ -1,15 +1,21 @@
 # -*- coding: utf-8 -*-
 import inspect
 import logging
+from collections import OrderedDict
+from functools import partial
 from six import wraps
 
+import numpy
 from picklable_itertools.extras import equizip
 import theano
 from theano import tensor, Variable
+from theano.ifelse import ifelse
 
 from ..base import Application, application, Brick
 from ...initialization import NdarrayInitialization
-from ...utils import pack, dict_union, dict_subset, is_shared_variable
+from ...roles import add_role, CARRIED_STATE
+from ...utils import (pack, dict_union, dict_subset, is_shared_variable,
+                      shared_floatx)
 
 logger = logging.getLogger(__name__)
 
@@ -20,6 +26,193 @@ by scan explicitly. That can significantly slow down `tensor.grad` \
 call. Did you forget to declare it in `contexts`?"""
 
 
+def unrolled_scan(fn, sequences, outputs_info, non_sequences, n_steps,
+                  go_backwards=False, **kwargs):
+    """Iterate like :func:`theano.scan` with a Python loop.
+
+    Builds a flat graph without a scan, which avoids the overhead of the
+    scan for short sequences. The other arguments of :func:`theano.scan`
+    are ignored.
+
+    Parameters
+    ----------
+    fn : callable
+        The step function, called like by :func:`theano.scan`.
+    sequences : list of :class:`~tensor.TensorVariable`
+        The sequences to iterate over.
+    outputs_info : list
+        The initial states of the recurrent outputs and ``None`` for the
+        other outputs.
+    non_sequences : list of :class:`~tensor.TensorVariable`
+        The arguments passed to every step.
+    n_steps : int
+        The number of steps.
+    go_backwards : bool, optional
+        Iterate over the sequences in the backward direction.
+
+    Returns
+    -------
+    The outputs of all steps and the (empty) updates, like
+    :func:`theano.scan`.
+
+    """
+    states = [info for info in outputs_info if info is not None]
+    outputs = [[] for _ in outputs_info]
+    steps = range(n_steps)
+    if go_backwards:
+        steps = reversed(steps)
+    for step in steps:
+        step_outputs = pack(fn(*([sequence[step] for sequence in sequences] +
+                                 states + list(non_sequences))))
+        states = [step_output for step_output, info
+                  in equizip(step_outputs, outputs_info) if info is not None]
+        for output, step_output in equizip(outputs, step_outputs):
+            output.append(step_output)
+    return [tensor.stack(output) for output in outputs], OrderedDict()
+
+
+def checkpoint_scan(fn, sequences, outputs_info, non_sequences, n_steps,
+                    checkpoint_every, go_backwards=False, name=None,
+                    segment_scan=None, **kwargs):
+    r"""Iterate like :func:`theano.scan`, keeping fewer intermediates.
+
+    The steps are split into segments of `checkpoint_every` steps, the
+    last one being shorter if the number of steps is not a multiple of
+    it. A first scan over the segments only returns the states at their
+    boundaries. A second scan starts every segment from its boundary
+    state and returns the outputs of its steps, its segments are
+    independent of each other. Differentiating them recomputes the steps
+    of one segment at a time, so the values computed inside the steps are
+    only kept for one segment. The last segment is iterated on its own,
+    so no step is run on padding.
+
+    The steps have to be deterministic, since they are computed more than
+    once, and can not have updates. Unlike :func:`theano.scan`, only
+    outputs without taps are supported.
+
+    Parameters
+    ----------
+    fn : callable
+        The step function, called like by :func:`theano.scan`.
+    sequences : list of :class:`~tensor.TensorVariable`
+        The sequences to iterate over.
+    outputs_info : list
+        The initial states of the recurrent outputs and ``None`` for the
+        other outputs.
+    non_sequences : list of :class:`~tensor.TensorVariable`
+        The arguments passed to every step.
+    n_steps : int or :class:`~tensor.TensorVariable`
+        The number of steps.
+    checkpoint_every : int
+        The number of steps in a segment.
+    go_backwards : bool, optional
+        Iterate over the sequences in the backward direction.
+    name : str, optional
+        The name of the scans.
+    segment_scan : callable, optional
+        Iterates over the steps of a segment, :func:`theano.scan` by
+        default. With :func:`unrolled_scan` the segments are unrolled,
+        except for the last one when its length is not constant.
+    \*\*kwargs : dict
+        Passed to all scans.
+
+    Returns
+    -------
+    The outputs of all steps and the (empty) updates, like
+    :func:`theano.scan`.
+
+    """
+    if go_backwards:
+        sequences = [sequence[::-1] for sequence in sequences]
+    if segment_scan is None:
+        segment_scan = theano.scan
+    non_sequences = list(non_sequences)
+    recurrent = [i for i, info in enumerate(outputs_info) if info is not None]
+    # The last segment has from 1 to `checkpoint_every` steps, a scan can
+    # not do 0 steps
+    n_segments = (n_steps - 1) // checkpoint_every
+    segmented_length = n_segments * checkpoint_every
+    last_length = n_steps - segmented_length
+
+    def iterate(scan, segment_sequences, states, segment_non_sequences,
+                length):
+        segment_outputs_info = list(outputs_info)
+        for i, state in zip(recurrent, states):
+            segment_outputs_info[i] = state
+        outputs, updates = scan(
+            fn, sequences=list(segment_sequences),
+            outputs_info=segment_outputs_info,
+            non_sequences=list(segment_non_sequences), n_steps=length,
+            name=None if name is None else name + '_segment', **kwargs)
+        if updates:
+            raise ValueError("checkpointed steps can not have updates")
+        return pack(outputs)
+
+    def boundary_function(*args):
+        outputs = iterate(
+            segment_scan, args[:len(sequences)],
+            args[len(sequences):len(sequences) + len(recurrent)],
+            args[len(sequences) + len(recurrent):], checkpoint_every)
+        return [outputs[i][-1] for i in recurrent]
+
+    def segment_function(*args):
+        return iterate(
+            segment_scan, args[:len(sequences)],
+            args[len(sequences):len(sequences) + len(recurrent)],
+            args[len(sequences) + len(recurrent):], checkpoint_every)
+
+    # The scans over the segments can not be run without segments either
+    def if_segments(then_branch, else_branch):
+        if isinstance(n_segments, int):
+            return then_branch if n_segments else else_branch
+        return ifelse(tensor.gt(n_segments, 0), then_branch, else_branch)
+
+    segmented = []
+    for sequence in sequences:
+        shape = [sequence.shape[i] for i in range(1, sequence.ndim)]
+        segmented.append(sequence[:segmented_length].reshape(
+            [n_segments, checkpoint_every] + shape, ndim=sequence.ndim + 1))
+    boundaries, _ = theano.scan(
+        boundary_function, sequences=segmented,
+        outputs_info=[outputs_info[i] for i in recurrent],
+        non_sequences=non_sequences, n_steps=n_segments,
+        name=None if name is None else name + '_boundaries', **kwargs)
+    boundaries = pack(boundaries)
+    starts = [tensor.concatenate([tensor.shape_padleft(outputs_info[i]),
+                                  boundary[:-1]])
+              for i, boundary in zip(recurrent, boundaries)]
+    results, _ = theano.scan(
+        segment_function, sequences=segmented + starts,
+        outputs_info=[None] * len(outputs_info),
+        non_sequences=non_sequences, n_steps=n_segments, name=name,
+        **kwargs)
+
+    last_scan = segment_scan
+    if segment_scan is not theano.scan:
+        try:
+            last_length = int(tensor.get_scalar_constant_value(last_length))
+        except tensor.NotScalarConstantError:
+            last_scan = theano.scan
+    last_outputs = iterate(
+        last_scan, [sequence[segmented_length:n_steps]
+                    for sequence in sequences],
+        [if_segments(boundary[-1], outputs_info[i])
+         for i, boundary in zip(recurrent, boundaries)],
+        non_sequences, last_length)
+    outputs = []
+    for result, last_output in equizip(pack(results), last_outputs):
+        shape = [result.shape[i] for i in range(2, result.ndim)]
+        # An unrolled segment of one step is broadcastable along time
+        last_output = tensor.unbroadcast(last_output, 0)
+        outputs.append(if_segments(
+            tensor.concatenate([
+                result.reshape([segmented_length] + shape,
+                               ndim=result.ndim - 1),
+                last_output]),
+            last_output))
+    return outputs, OrderedDict()
+
+
 class BaseRecurrent(Brick):
     """Base class for brick with recurrent application method."""
     has_bias = False
@@ -59,6 +252,68 @@ class BaseRecurrent(Brick):
     def initial_states_outputs(self):
         return self.apply.states
 
+    def project_inputs(self, application_name, sequences):
+        """Project the sequences before the iteration.
+
+        Called by the recurrent applications with ``hoist_inputs=True``.
+        A transition that multiplies its sequences by parameters in every
+        step can return these products for the whole sequences here, so
+        that they are computed with one large matrix product instead of
+        one small product per step. The step then receives their elements
+        as a `projections` dictionary, in addition to the sequences, and
+        has to use them instead of projecting the sequences itself. By
+        default nothing is projected.
+
+        Parameters
+        ----------
+        application_name : str
+            The name of the recurrent application method.
+        sequences : dict
+            A {name: :class:`~tensor.TensorVariable`} dictionary of the
+            sequences given to the application.
+
+        Returns
+        -------
+        A {name: :class:`~tensor.TensorVariable`} ordered dictionary of
+        the projections, with time as their first dimension.
+
+        """
+        return OrderedDict()
+
+    def get_carried_state(self, application_name, state_name, ndim=2):
+        """Return the shared variable carrying a state between batches.
+
+        Used by recurrent applications called with ``carry_states=True``.
+        The variable is created on the first call, empty, so that the
+        first batch starts from the initial state.
+
+        Parameters
+        ----------
+        application_name : str
+            The name of the recurrent application method.
+        state_name : str
+            The name of the state.
+        ndim : int, optional
+            The number of dimensions of the state, 2 by default.
+
+        """
+        if not hasattr(self, 'carried_states'):
+            self.carried_states = {}
+        key = (application_name, state_name)
+        if key not in self.carried_states:
+            shape = (0,) + (self.get_dim(state_name),) * (ndim - 1)
+            carried_state = shared_floatx(
+                numpy.zeros(shape), name='{}_carried'.format(state_name))
+            add_role(carried_state, CARRIED_STATE)
+            self.carried_states[key] = carried_state
+        return self.carried_states[key]
+
+    def reset_carried_states(self):
+        """Make the next batch start from the initial states."""
+        for carried_state in getattr(self, 'carried_states', {}).values():
+            value = carried_state.get_value()
+            carried_state.set_value(value[:0])
+
 
 def recurrent(*args, **kwargs):
     """Wraps an apply method to allow its iterative application.
@@ -117,6 +372,38 @@ def recurrent(*args, **kwargs):
             return_initial_states : bool
                 If ``True``, initial states are included in the returned
                 state tensors. ``False`` by default.
+            hoist_inputs : bool
+                If ``True``, the projections of the sequences are computed
+                for the whole sequences before the iteration, see
+                :meth:`BaseRecurrent.project_inputs`. ``False`` by
+                default.
+            checkpoint_every : int
+                If given, only the states of every `checkpoint_every`-th
+                step are kept for the backward pass and the other steps
+                are recomputed, see :func:`checkpoint_scan`. This trades
+                computation time for memory on long sequences.
+            unroll : bool or int
+                If ``True``, the steps are applied in a Python loop, which
+                builds a flat graph without a scan. The number of steps
+                has to be constant: the `n_steps` argument or a constant
+                length of the sequences. If an integer `k`, the scan
+                iterates over segments of `k` steps unrolled in the same
+                way. ``False`` by default.
+            carry_states : bool
+                If ``True``, the iteration starts from the final states of
+                the previous batch, which are kept in shared variables,
+                see :meth:`BaseRecurrent.get_carried_state`. The shared
+                variables are updated through the updates of the
+                application call. This allows truncated backpropagation
+                through time over long sequences split into contiguous
+                chunks, provided every row of a batch continues the same
+                row of the previous batch. When the batch size changes
+                the initial states are used. ``False`` by default.
+            reset : :class:`~tensor.TensorVariable`
+                A vector with a flag for every row of the batch, when it
+                is one the iteration starts from the initial state, e.g.
+                at the beginning of a document. Only used with
+                `carry_states`.
 
             """
             # Extract arguments related to iteration and immediately relay the
@@ -127,6 +414,13 @@ def recurrent(*args, **kwargs):
             reverse = kwargs.pop('reverse', False)
             scan_kwargs = kwargs.pop('scan_kwargs', {})
             return_initial_states = kwargs.pop('return_initial_states', False)
+            hoist_inputs = kwargs.pop('hoist_inputs', False)
+            checkpoint_every = kwargs.pop('checkpoint_every', None)
+            unroll = kwargs.pop('unroll', False)
+            if unroll and checkpoint_every:
+                raise ValueError("can not unroll a checkpointed iteration")
+            carry_states = kwargs.pop('carry_states', False)
+            reset = kwargs.pop('reset', None)
 
             # Push everything to kwargs
             for arg, arg_name in zip(args, arg_names):
@@ -152,7 +446,7 @@ def recurrent(*args, **kwargs):
             if len(sequences_given):
                 # TODO Assumes 1 time dim!
                 shape = list(sequences_given.values())[0].shape
-                n_steps = shape[0]
+                n_steps = kwargs.pop('n_steps', shape[0])
                 batch_size = shape[1]
             else:
                 # TODO Raise error if n_steps and batch_size not found?
@@ -196,14 +490,44 @@ def recurrent(*args, **kwargs):
                 states_given[name] = tensor.unbroadcast(state,
                                                         *range(state.ndim))
 
+            # Start from the final states of the previous batch
+            carried_states = {}
+            if carry_states:
+                for name, state in states_given.items():
+                    carried_state = brick.get_carried_state(
+                        application.application_name, name, state.ndim)
+                    start = ifelse(
+                        tensor.eq(carried_state.shape[0], state.shape[0]),
+                        carried_state.astype(state.dtype), state)
+                    if reset is not None:
+                        start = tensor.switch(
+                            tensor.shape_padright(reset, state.ndim - 1),
+                            state, start)
+                    states_given[name] = start
+                    carried_states[name] = carried_state
+
+            # Compute the projections of the whole sequences at once
+            projections = OrderedDict()
+            if hoist_inputs and sequences_given:
+                projections = brick.project_inputs(
+                    application.application_name, sequences_given)
+
             def scan_function(*args):
                 args = list(args)
+                projection_slices = args[
+                    len(sequences_given):
+                    len(sequences_given) + len(projections)]
+                del args[len(sequences_given):
+                         len(sequences_given) + len(projections)]
                 arg_names = (list(sequences_given) +
                              [output for output in application.outputs
                               if output in application.states] +
                              list(contexts_given))
                 kwargs = dict(equizip(arg_names, args))
                 kwargs.update(rest_kwargs)
+                if projections:
+                    kwargs['projections'] = OrderedDict(
+                        equizip(projections, projection_slices))
                 outputs = application(iterate=False, **kwargs)
                 # We want to save the computation graph returned by the
                 # `application_function` when it is called inside the
@@ -215,8 +539,24 @@ def recurrent(*args, **kwargs):
                 states_given[name] if name in application.states
                 else None
                 for name in application.outputs]
-            result, updates = theano.scan(
-                scan_function, sequences=list(sequences_given.values()),
+            scan = theano.scan
+            if checkpoint_every:
+                scan = partial(checkpoint_scan,
+                               checkpoint_every=checkpoint_every)
+            elif unroll is True:
+                try:
+                    n_steps = int(tensor.get_scalar_constant_value(n_steps))
+                except tensor.NotScalarConstantError:
+                    raise ValueError("unrolling needs a constant number of "
+                                     "steps, pass `n_steps`")
+                scan = unrolled_scan
+            elif unroll:
+                scan = partial(checkpoint_scan, checkpoint_every=unroll,
+                               segment_scan=unrolled_scan)
+            result, updates = scan(
+                scan_function,
+                sequences=(list(sequences_given.values()) +
+                           list(projections.values())),
                 outputs_info=outputs_info,
                 non_sequences=list(contexts_given.values()),
                 n_steps=n_steps,
@@ -225,7 +565,31 @@ def recurrent(*args, **kwargs):
                     brick.name, application.application_name),
                 **scan_kwargs)
             result = pack(result)
-            if return_initial_states:
+            if unroll:
+                # Save a step graph with its own inputs, like the one of
+                # a scan, instead of the last unrolled step
+                scan_function(*(
+                    [tensor.TensorType(sequence.dtype,
+                                       sequence.broadcastable[1:])()
+                     for sequence in (list(sequences_given.values()) +
+                                      list(projections.values()))] +
+                    [info.type() for info in outputs_info
+                     if info is not None] +
+                    [context.type() for context in contexts_given.values()]))
+            if carried_states:
+                application_call.updates = dict_union(
+                    application_call.updates,
+                    OrderedDict(
+                        (carried_state,
+                         result[application.outputs.index(name)][-1])
+                        for name, carried_state in carried_states.items()
+                        if name in application.outputs))
+            if return_initial_states and (checkpoint_every or unroll):
+                for i, info in enumerate(outputs_info):
+                    if info is not None:
+                        result[i] = tensor.concatenate(
+                            [tensor.shape_padleft(info), result[i]])
+            elif return_initial_states:
                 # Undo Subtensor
                 for i, info in enumerate(outputs_info):
                     if info is not None:
@@ -238,6 +602,8 @@ def recurrent(*args, **kwargs):
 
             return result
 
+        # The names of the positional arguments of the step
+        recurrent_apply.arg_names = arg_names
         return recurrent_apply
 
     # Decorator can be used with or without arguments
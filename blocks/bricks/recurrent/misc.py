@@ -2,14 +2,95 @@
 import copy
 
 from picklable_itertools.extras import equizip
+import theano
 from theano import tensor
 
 from ..base import application, lazy
 from ..parallel import Fork
 from ..simple import Initializable, Linear
+from ...utils import dict_subset, pack
+from .architectures import SimpleRecurrent, LSTM, GatedRecurrent
 from .base import BaseRecurrent, recurrent
 
 
+def _stack(bricks, name):
+    return tensor.stack([getattr(brick, name) for brick in bricks])
+
+
+def _stacked_simple_recurrent(bricks):
+    W = _stack(bricks, 'W')
+    activation = bricks[0].children[0]
+
+    def step(inputs, states, mask=None):
+        next_states = activation.apply(
+            inputs + tensor.batched_dot(states, W))
+        if mask:
+            next_states = (mask[:, :, None] * next_states +
+                           (1 - mask[:, :, None]) * states)
+        return next_states
+    return step
+
+
+def _stacked_lstm(bricks):
+    W_state = _stack(bricks, 'W_state')
+    W_cell_to_in, W_cell_to_forget, W_cell_to_out = [
+        _stack(bricks, name)[:, None, :] for name in
+        ['W_cell_to_in', 'W_cell_to_forget', 'W_cell_to_out']]
+    brick = bricks[0]
+
+    def slice_last(x, no):
+        return x[:, :, no*brick.dim: (no+1)*brick.dim]
+
+    def step(inputs, states, cells, mask=None):
+        activation = tensor.batched_dot(states, W_state) + inputs
+        in_gate = brick.gate_activation.apply(
+            slice_last(activation, 0) + cells * W_cell_to_in)
+        forget_gate = brick.gate_activation.apply(
+            slice_last(activation, 1) + cells * W_cell_to_forget)
+        next_cells = (
+            forget_gate * cells +
+            in_gate * brick.activation.apply(slice_last(activation, 2)))
+        out_gate = brick.gate_activation.apply(
+            slice_last(activation, 3) + next_cells * W_cell_to_out)
+        next_states = out_gate * brick.activation.apply(next_cells)
+        if mask:
+            next_states = (mask[:, :, None] * next_states +
+                           (1 - mask[:, :, None]) * states)
+            next_cells = (mask[:, :, None] * next_cells +
+                          (1 - mask[:, :, None]) * cells)
+        return next_states, next_cells
+    return step
+
+
+def _stacked_gated_recurrent(bricks):
+    state_to_state = _stack(bricks, 'state_to_state')
+    state_to_gates = _stack(bricks, 'state_to_gates')
+    brick = bricks[0]
+
+    def step(inputs, gate_inputs, states, mask=None):
+        gate_values = brick.gate_activation.apply(
+            tensor.batched_dot(states, state_to_gates) + gate_inputs)
+        update_values = gate_values[:, :, :brick.dim]
+        reset_values = gate_values[:, :, brick.dim:]
+        next_states = brick.activation.apply(
+            tensor.batched_dot(states * reset_values, state_to_state) +
+            inputs)
+        next_states = (next_states * update_values +
+                       states * (1 - update_values))
+        if mask:
+            next_states = (mask[:, :, None] * next_states +
+                           (1 - mask[:, :, None]) * states)
+        return next_states
+    return step
+
+
+# Transitions computed for both directions at once, with the direction
+# as the first axis of the sequences, the states and the weights
+_STACKED_TRANSITIONS = {SimpleRecurrent: _stacked_simple_recurrent,
+                        LSTM: _stacked_lstm,
+                        GatedRecurrent: _stacked_gated_recurrent}
+
+
 class Bidirectional(Initializable):
     """Bidirectional network.
 
@@ -21,6 +102,19 @@ class Bidirectional(Initializable):
     prototype : instance of :class:`BaseRecurrent`
         A prototype brick from which the forward and backward bricks are
         cloned.
+    fused : bool, optional
+        If ``True``, both directions are computed in a single scan, the
+        backward one over the reversed sequences. The outputs and the
+        parameters are the same as with separate scans. Only the
+        arguments of the recurrent application and `n_steps` and
+        `batch_size` are supported in this mode. ``False`` by default.
+        For :class:`.SimpleRecurrent`, :class:`.LSTM` and
+        :class:`.GatedRecurrent` prototypes whose activations have no
+        parameters, the sequences and the states of both directions are
+        stacked and every step does one batched matrix product against
+        the stacked recurrent weights of both directions. The step of
+        these transitions is then not an application of the children.
+        Other prototypes apply each child to its direction.
 
     Notes
     -----
@@ -30,8 +124,9 @@ class Bidirectional(Initializable):
     has_bias = False
 
     @lazy()
-    def __init__(self, prototype, **kwargs):
+    def __init__(self, prototype, fused=False, **kwargs):
         self.prototype = prototype
+        self.fused = fused
 
         children = [copy.deepcopy(prototype) for _ in range(2)]
         children[0].name = 'forward'
@@ -42,13 +137,137 @@ class Bidirectional(Initializable):
     @application
     def apply(self, *args, **kwargs):
         """Applies forward and backward networks and concatenates outputs."""
-        forward = self.children[0].apply(as_list=True, *args, **kwargs)
-        backward = [x[::-1] for x in
-                    self.children[1].apply(reverse=True, as_list=True,
-                                           *args, **kwargs)]
+        if self.fused:
+            forward, backward = self._apply_fused(*args, **kwargs)
+        else:
+            forward = self.children[0].apply(as_list=True, *args, **kwargs)
+            backward = [x[::-1] for x in
+                        self.children[1].apply(reverse=True, as_list=True,
+                                               *args, **kwargs)]
         return [tensor.concatenate([f, b], axis=2)
                 for f, b in equizip(forward, backward)]
 
+    def _apply_fused(self, *args, **kwargs):
+        """Iterates both directions in one scan.
+
+        Returns the outputs of the forward and the backward networks, the
+        latter in the order of the input sequences.
+
+        """
+        forward, backward = self.children[:2]
+        application = forward.apply
+        arg_names = getattr(application.application_function, 'arg_names',
+                            application.sequences + application.contexts)
+        kwargs.update(equizip(arg_names[:len(args)], args))
+        unknown = (set(kwargs) - set(application.sequences) -
+                   set(application.states) - set(application.contexts) -
+                   {'n_steps', 'batch_size'})
+        if unknown:
+            raise ValueError("fused iteration does not support {}".format(
+                ", ".join(sorted(unknown))))
+        sequences = {name: tensor.as_tensor_variable(value)
+                     for name, value in dict_subset(
+                         kwargs, application.sequences,
+                         must_have=False).items()
+                     if value is not None}
+        contexts = {name: value for name, value in dict_subset(
+                        kwargs, application.contexts, must_have=False).items()
+                    if value is not None}
+        if sequences:
+            shape = list(sequences.values())[0].shape
+            n_steps = kwargs.pop('n_steps', shape[0])
+            batch_size = shape[1]
+        else:
+            n_steps = kwargs.pop('n_steps')
+            batch_size = kwargs.pop('batch_size')
+
+        outputs_info = []
+        for brick in (forward, backward):
+            initial_states = brick.initial_states(batch_size, as_dict=True,
+                                                  **kwargs)
+            for name in application.outputs:
+                if name in application.states:
+                    state = kwargs.get(name)
+                    if state is None:
+                        state = initial_states[name]
+                    # Theano issue 1772
+                    outputs_info.append(
+                        tensor.unbroadcast(state, *range(state.ndim)))
+                else:
+                    outputs_info.append(None)
+        recurrent_outputs = [name for name in application.outputs
+                             if name in application.states]
+        if (type(forward) in _STACKED_TRANSITIONS and
+                not any(child.parameters for brick in (forward, backward)
+                        for child in brick.children) and
+                recurrent_outputs == application.outputs):
+            return self._apply_stacked(sequences, outputs_info, n_steps)
+
+        def step(*args):
+            # The arguments are the forward and the backward sequences,
+            # the forward and the backward states and the contexts
+            n_sequences = len(sequences)
+            n_states = len(recurrent_outputs)
+            sequence_steps = [args[:n_sequences],
+                              args[n_sequences:2 * n_sequences]]
+            args = args[2 * n_sequences:]
+            state_steps = [args[:n_states], args[n_states:2 * n_states]]
+            step_contexts = dict(equizip(contexts, args[2 * n_states:]))
+            outputs = []
+            for brick, sequence_step, state_step in equizip(
+                    (forward, backward), sequence_steps, state_steps):
+                step_kwargs = dict(equizip(sequences, sequence_step))
+                step_kwargs.update(equizip(recurrent_outputs, state_step))
+                step_kwargs.update(step_contexts)
+                outputs.extend(brick.apply(iterate=False, as_list=True,
+                                           **step_kwargs))
+            return outputs
+
+        results, updates = theano.scan(
+            step,
+            sequences=(list(sequences.values()) +
+                       [sequence[::-1] for sequence in sequences.values()]),
+            outputs_info=outputs_info,
+            non_sequences=list(contexts.values()),
+            n_steps=n_steps,
+            name='{}_fused_scan'.format(self.name))
+        results = pack(results)
+        n_outputs = len(application.outputs)
+        return (results[:n_outputs],
+                [result[::-1] for result in results[n_outputs:]])
+
+    def _apply_stacked(self, sequences, outputs_info, n_steps):
+        """Iterates both directions with batched matrix products.
+
+        The initial states in `outputs_info` are the forward ones followed
+        by the backward ones.
+
+        """
+        bricks = self.children[:2]
+        application = bricks[0].apply
+        n_states = len(outputs_info) // 2
+        transition = _STACKED_TRANSITIONS[type(bricks[0])](bricks)
+
+        def step(*args):
+            step_kwargs = dict(equizip(sequences, args[:len(sequences)]))
+            step_kwargs.update(equizip(application.outputs,
+                                       args[len(sequences):]))
+            return transition(**step_kwargs)
+
+        results, updates = theano.scan(
+            step,
+            sequences=[tensor.stack([sequence, sequence[::-1]], axis=1)
+                       for sequence in sequences.values()],
+            outputs_info=[tensor.stack([forward, backward])
+                          for forward, backward in equizip(
+                              outputs_info[:n_states],
+                              outputs_info[n_states:])],
+            n_steps=n_steps,
+            name='{}_stacked_scan'.format(self.name))
+        results = pack(results)
+        return ([result[:, 0] for result in results],
+                [result[:, 1][::-1] for result in results])
+
     @apply.delegate
     def apply_delegate(self):
         return self.children[0].apply
@@ -302,6 +521,7 @@ class RecurrentStack(BaseRecurrent, Initializable):
 
         if kwargs.get("reverse", False):
             raise NotImplementedError
+        projections = kwargs.pop('projections', None)
 
         results = []
         last_states = None
@@ -321,6 +541,9 @@ class RecurrentStack(BaseRecurrent, Initializable):
             for name in transition.apply.contexts:
                 layer_kwargs[name] = kwargs.get(name)  # contexts has no suffix
 
+            if level == 0 and projections:
+                layer_kwargs['projections'] = projections
+
             if level > 0:
                 # add the forked states of the layer below
                 inputs = self.forks[level - 1].apply(last_states, as_list=True)
@@ -350,6 +573,19 @@ class RecurrentStack(BaseRecurrent, Initializable):
 
         return tuple(results)
 
+    def project_inputs(self, application_name, sequences):
+        """Project the sequences of the bottom transition.
+
+        The sequences of the transitions above are added to forks of the
+        states of the layers below in every step, so only the bottom
+        transition can project its sequences before the iteration.
+
+        """
+        transition = self.transitions[0]
+        return transition.project_inputs(
+            'apply', dict_subset(sequences, transition.apply.sequences,
+                                 must_have=False))
+
     @recurrent
     def low_memory_apply(self, *args, **kwargs):
         # we let the recurrent decorator handle the iteration for us
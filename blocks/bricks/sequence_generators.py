@@ -28,8 +28,11 @@ To simulate optional attention, :class:`SequenceGenerator` wraps the
 pure recurrent network in :class:`FakeAttentionRecurrent`.
 
 """
+import contextlib
 from abc import ABCMeta, abstractmethod
 
+import numpy
+import theano
 from six import add_metaclass
 from theano import tensor
 
@@ -40,8 +43,9 @@ from blocks.bricks.lookup import LookupTable
 from blocks.bricks.recurrent import recurrent
 from blocks.bricks.attention import (
     AbstractAttentionRecurrent, AttentionRecurrent)
-from blocks.roles import add_role, COST
-from blocks.utils import dict_union, dict_subset
+from blocks.roles import add_role, BIAS, COST, WEIGHT
+from blocks.utils import (dict_union, dict_subset, find_bricks,
+                          shared_floatx_nans)
 
 
 class BaseSequenceGenerator(Initializable):
@@ -236,9 +240,17 @@ class BaseSequenceGenerator(Initializable):
         return cost
 
     @application
-    def cost_matrix(self, application_call, outputs, mask=None, **kwargs):
+    def cost_matrix(self, application_call, outputs, mask=None,
+                    checkpoint_every=None, **kwargs):
         """Returns generation costs for output sequences.
 
+        Parameters
+        ----------
+        checkpoint_every : int, optional
+            If given, passed to the recurrent application of the
+            transition to keep only the states of every
+            `checkpoint_every`-th step for the backward pass.
+
         See Also
         --------
         :meth:`cost` : Scalar cost.
@@ -254,10 +266,14 @@ class BaseSequenceGenerator(Initializable):
         feedback = self.readout.feedback(outputs)
         inputs = self.fork.apply(feedback, as_dict=True)
 
-        # Run the recurrent network
+        # Run the recurrent network, transitions that are not made with
+        # the recurrent decorator may not accept `checkpoint_every`
+        iteration_kwargs = {}
+        if checkpoint_every is not None:
+            iteration_kwargs['checkpoint_every'] = checkpoint_every
         results = self.transition.apply(
             mask=mask, return_initial_states=True, as_dict=True,
-            **dict_union(inputs, states, contexts))
+            **dict_union(inputs, states, contexts, iteration_kwargs))
 
         # Separate the deliverables. The last states are discarded: they
         # are not used to predict any output symbol. The initial glimpses
@@ -722,6 +738,334 @@ class SoftmaxEmitter(AbstractEmitter, Initializable, Random):
         return super(SoftmaxEmitter, self).get_dim(name)
 
 
+class SampledEmitter(SoftmaxEmitter):
+    """A softmax emitter over a large vocabulary trained with samples.
+
+    The emitter projects the readouts to the energies of the outputs
+    itself, so that in training mode the cost only needs the energies of
+    the correct outputs and of `num_samples` sampled ones instead of the
+    whole vocabulary. The samples are drawn from the log-uniform (Zipfian)
+    distribution, which assumes that the outputs are sorted by decreasing
+    frequency, and are shared by the whole batch. Training mode is
+    enabled by :func:`sampled_training`, otherwise :meth:`cost` is the
+    exact categorical cross-entropy, so that monitoring the cost on
+    validation data gives comparable numbers.
+
+    Parameters
+    ----------
+    num_outputs : int
+        The size of the vocabulary.
+    num_samples : int
+        The number of outputs sampled for every batch.
+    remove_accidental_hits : bool, optional
+        If ``True`` (default), the samples equal to the correct output
+        are ignored in its cost.
+    readout_dim : int, optional
+        The dimension of the readouts, usually given by the
+        :class:`Readout` brick.
+
+    Notes
+    -----
+    See :class:`.Initializable` for initialization parameters, the
+    remaining keyword arguments are passed to :class:`SoftmaxEmitter`.
+
+    """
+    @lazy(allocation=['num_outputs', 'num_samples'])
+    def __init__(self, num_outputs, num_samples, remove_accidental_hits=True,
+                 readout_dim=None, **kwargs):
+        self.num_outputs = num_outputs
+        self.readout_dim = readout_dim
+        self.num_samples = num_samples
+        self.remove_accidental_hits = remove_accidental_hits
+        self._training_mode = []
+        super(SampledEmitter, self).__init__(**kwargs)
+
+    @property
+    def W(self):
+        return self.parameters[0]
+
+    @property
+    def b(self):
+        return self.parameters[1]
+
+    def _allocate(self):
+        W = shared_floatx_nans((self.readout_dim, self.num_outputs),
+                               name='W')
+        add_role(W, WEIGHT)
+        self.parameters.append(W)
+        b = shared_floatx_nans((self.num_outputs,), name='b')
+        add_role(b, BIAS)
+        self.parameters.append(b)
+
+    def _initialize(self):
+        self.weights_init.initialize(self.W, self.rng)
+        self.biases_init.initialize(self.b, self.rng)
+
+    def __enter__(self):
+        self._training_mode.append(True)
+
+    def __exit__(self, *exc_info):
+        self._training_mode.pop()
+
+    @application
+    def energies(self, readouts):
+        """Compute the energies of all the outputs."""
+        return tensor.dot(readouts, self.W) + self.b
+
+    @application
+    def probs(self, readouts):
+        return self.softmax.apply(self.energies(readouts),
+                                  extra_ndim=readouts.ndim - 2)
+
+    @application
+    def cost(self, application_call, readouts, outputs):
+        # Cast to bool, self._training_mode is a list to support nested
+        # context managers.
+        application_call.metadata['training_mode'] = bool(
+            self._training_mode)
+        if not self._training_mode:
+            return self.softmax.categorical_cross_entropy(
+                outputs, self.energies(readouts),
+                extra_ndim=readouts.ndim - 2)
+        readouts_flat = readouts.reshape((-1, readouts.shape[-1]))
+        outputs_flat = outputs.flatten()
+        samples = self.sample_outputs()
+        # The energies are corrected by the logarithm of the expected
+        # number of times an output is sampled.
+        true_energies = (
+            (readouts_flat * self.W.T[outputs_flat]).sum(axis=1) +
+            self.b[outputs_flat] - self.log_expected_count(outputs_flat))
+        sampled_energies = (
+            tensor.dot(readouts_flat, self.W.T[samples].T) +
+            self.b[samples] - self.log_expected_count(samples))
+        if self.remove_accidental_hits:
+            sampled_energies = tensor.switch(
+                tensor.eq(outputs_flat[:, None], samples[None, :]),
+                -numpy.inf, sampled_energies)
+        costs = self.sampled_cost(true_energies, sampled_energies)
+        return costs.reshape(outputs.shape)
+
+    @abstractmethod
+    def sampled_cost(self, true_energies, sampled_energies):
+        """Compute the cost from the corrected energies.
+
+        Parameters
+        ----------
+        true_energies : :class:`~tensor.TensorVariable`
+            The vector of the energies of the correct outputs.
+        sampled_energies : :class:`~tensor.TensorVariable`
+            The matrix of the energies of the sampled outputs for every
+            correct output, minus infinity for the accidental hits.
+
+        """
+        pass
+
+    def sample_outputs(self):
+        """Sample outputs from the log-uniform distribution.
+
+        The output `k` is sampled with the probability
+        :math:`\\log((k + 2) / (k + 1)) / \\log(V + 1)`, where `V` is the
+        number of outputs.
+
+        """
+        uniform = self.theano_rng.uniform((self.num_samples,),
+                                          dtype=theano.config.floatX)
+        samples = tensor.floor(
+            tensor.exp(uniform * numpy.log(self.num_outputs + 1))) - 1
+        return tensor.clip(tensor.cast(samples, 'int64'),
+                           0, self.num_outputs - 1)
+
+    def log_expected_count(self, outputs):
+        """The log of the expected number of samples equal to `outputs`."""
+        outputs = tensor.cast(outputs, theano.config.floatX)
+        return tensor.log(self.num_samples *
+                          tensor.log1p(1 / (outputs + 1)) /
+                          numpy.log(self.num_outputs + 1))
+
+
+class SampledSoftmaxEmitter(SampledEmitter):
+    """An emitter trained with the sampled softmax.
+
+    In training mode the cost is the cross-entropy of the softmax over the
+    correct output and the samples, an estimate of the full softmax cost
+    which is biased for small numbers of samples.
+
+    """
+    def sampled_cost(self, true_energies, sampled_energies):
+        energies = tensor.concatenate([true_energies[:, None],
+                                       sampled_energies], axis=1)
+        max_energies = energies.max(axis=1)
+        return (tensor.log(tensor.exp(
+            energies - max_energies[:, None]).sum(axis=1)) +
+            max_energies - true_energies)
+
+
+class NCEEmitter(SampledEmitter):
+    """An emitter trained with noise-contrastive estimation.
+
+    In training mode the cost is the logistic loss of telling the correct
+    output from the samples, the noise. The exact cost in inference mode
+    assumes that the model learnt to be normalized.
+
+    """
+    def sampled_cost(self, true_energies, sampled_energies):
+        return (tensor.nnet.softplus(-true_energies) +
+                tensor.nnet.softplus(sampled_energies).sum(axis=1))
+
+
+@contextlib.contextmanager
+def sampled_training(*bricks):
+    r"""Context manager to compute the costs of sampled emitters.
+
+    Parameters
+    ----------
+    \*bricks
+        One or more bricks which will be inspected for descendant
+        instances of :class:`SampledEmitter`.
+
+    Examples
+    --------
+    The training cost is built inside the context, the cost built outside
+    of it is exact and can be monitored on validation data.
+
+    >>> with sampled_training(generator): # doctest: +SKIP
+    ...     training_cost = generator.cost(outputs)
+
+    """
+    emitters = find_bricks(bricks, lambda b: isinstance(b, SampledEmitter))
+    try:
+        for brick in emitters:
+            brick.__enter__()
+        yield
+    finally:
+        for brick in emitters[::-1]:
+            brick.__exit__()
+
+
+class AdaptiveSoftmaxEmitter(SoftmaxEmitter):
+    """A softmax emitter with the adaptive softmax over the outputs.
+
+    The outputs are split by frequency, which assumes that they are sorted
+    by decreasing frequency, into a head and clusters of rarer outputs.
+    The head softmax is over the most frequent outputs and the clusters,
+    the softmax of every cluster is computed from a projection of the
+    readouts to a smaller dimension. The cost only computes the cluster
+    softmaxes for the outputs in the clusters, while :meth:`probs` gives
+    the exact probabilities of all the outputs, which can be used by
+    :class:`.BeamSearch`.
+
+    Parameters
+    ----------
+    cutoffs : list of int
+        The increasing ends of the head and of the clusters, the last one
+        is the number of outputs.
+    reduction_factor : int, optional
+        The dimension of the projection is divided by this factor for
+        every next cluster, 4 by default.
+    readout_dim : int, optional
+        The dimension of the readouts, usually given by the
+        :class:`Readout` brick.
+
+    Notes
+    -----
+    See :class:`.Initializable` for initialization parameters, the
+    remaining keyword arguments are passed to :class:`SoftmaxEmitter`.
+
+    """
+    @lazy(allocation=['cutoffs'])
+    def __init__(self, cutoffs, reduction_factor=4, readout_dim=None,
+                 **kwargs):
+        self.cutoffs = cutoffs
+        self.reduction_factor = reduction_factor
+        self.readout_dim = readout_dim
+        super(AdaptiveSoftmaxEmitter, self).__init__(**kwargs)
+
+    @property
+    def num_outputs(self):
+        return self.cutoffs[-1]
+
+    @property
+    def num_clusters(self):
+        return len(self.cutoffs) - 1
+
+    def _allocate(self):
+        W = shared_floatx_nans(
+            (self.readout_dim, self.cutoffs[0] + self.num_clusters),
+            name='W_head')
+        add_role(W, WEIGHT)
+        self.parameters.append(W)
+        b = shared_floatx_nans((self.cutoffs[0] + self.num_clusters,),
+                               name='b_head')
+        add_role(b, BIAS)
+        self.parameters.append(b)
+        for i in range(self.num_clusters):
+            dim = max(self.readout_dim // self.reduction_factor ** (i + 1),
+                      1)
+            size = self.cutoffs[i + 1] - self.cutoffs[i]
+            projection = shared_floatx_nans((self.readout_dim, dim),
+                                            name='projection_{}'.format(i))
+            add_role(projection, WEIGHT)
+            self.parameters.append(projection)
+            W = shared_floatx_nans((dim, size), name='W_{}'.format(i))
+            add_role(W, WEIGHT)
+            self.parameters.append(W)
+            b = shared_floatx_nans((size,), name='b_{}'.format(i))
+            add_role(b, BIAS)
+            self.parameters.append(b)
+
+    def _initialize(self):
+        for parameter in self.parameters:
+            if parameter.ndim == 2:
+                self.weights_init.initialize(parameter, self.rng)
+            else:
+                self.biases_init.initialize(parameter, self.rng)
+
+    def _head_energies(self, readouts):
+        W, b = self.parameters[:2]
+        return tensor.dot(readouts, W) + b
+
+    def _cluster_energies(self, readouts, i):
+        projection, W, b = self.parameters[2 + 3 * i:5 + 3 * i]
+        return tensor.dot(tensor.dot(readouts, projection), W) + b
+
+    @application
+    def probs(self, readouts):
+        readouts_flat = readouts.reshape((-1, readouts.shape[-1]))
+        head_probs = self.softmax.apply(self._head_energies(readouts_flat))
+        probs = [head_probs[:, :self.cutoffs[0]]]
+        for i in range(self.num_clusters):
+            cluster_probs = self.softmax.apply(
+                self._cluster_energies(readouts_flat, i))
+            probs.append(head_probs[:, self.cutoffs[0] + i][:, None] *
+                         cluster_probs)
+        probs = tensor.concatenate(probs, axis=1)
+        return probs.reshape(
+            tensor.concatenate([readouts.shape[:-1], [self.num_outputs]]),
+            ndim=readouts.ndim)
+
+    @application
+    def cost(self, readouts, outputs):
+        readouts_flat = readouts.reshape((-1, readouts.shape[-1]))
+        outputs_flat = outputs.flatten()
+        # The outputs of the head are the frequent outputs and the clusters
+        head_outputs = outputs_flat
+        for i in range(self.num_clusters):
+            head_outputs = tensor.switch(
+                tensor.ge(outputs_flat, self.cutoffs[i]),
+                self.cutoffs[0] + i, head_outputs)
+        costs = self.softmax.categorical_cross_entropy(
+            head_outputs, self._head_energies(readouts_flat))
+        for i in range(self.num_clusters):
+            start, end = self.cutoffs[i:i + 2]
+            indices = (tensor.ge(outputs_flat, start) *
+                       tensor.lt(outputs_flat, end)).nonzero()[0]
+            costs = tensor.inc_subtensor(
+                costs[indices], self.softmax.categorical_cross_entropy(
+                    outputs_flat[indices] - start,
+                    self._cluster_energies(readouts_flat[indices], i)))
+        return costs.reshape(outputs.shape)
+
+
 class TrivialFeedback(AbstractFeedback):
     """A feedback brick for the case when readout are outputs."""
     @lazy(allocation=['output_dim'])
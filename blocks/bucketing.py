@@ -0,0 +1,341 @@
+"""Batching of sequences of similar lengths.
+
+Recurrent bricks and :meth:`.SequenceGenerator.cost` compute every step
+of the padded batch and only then apply the masks, so the padding of
+batches with sequences of very different lengths is wasted computation.
+The iteration scheme :class:`LengthBucketScheme` and the transformer
+:class:`BucketedBatch` sort a window of examples by length and form the
+batches from buckets of similar lengths. Follow them by a
+:class:`~fuel.transformers.Padding` transformer to get the masks, the
+result can be used as the data stream of a :class:`.MainLoop` or of a
+:class:`.DataStreamMonitoring` extension. The :class:`PaddingRatio`
+extension adds the fraction of padded steps to the log.
+
+Documents too long to backpropagate through at once can instead be split
+into contiguous chunks by the :class:`ContiguousChunks` transformer, to
+be processed by recurrent applications called with ``carry_states=True``.
+
+"""
+from bisect import bisect_left
+from collections import defaultdict
+
+import numpy
+import theano
+from fuel.schemes import BatchScheme
+from fuel.transformers import Transformer
+from picklable_itertools import iter_
+
+from blocks.config import config
+from blocks.extensions import SimpleExtension
+
+
+def bucket_batches(lengths, batch_size, boundaries, window_size=None,
+                   rng=None):
+    """Group examples into batches of similar lengths.
+
+    Parameters
+    ----------
+    lengths : list of int
+        The lengths of the examples.
+    batch_size : int
+        The maximum number of examples in a batch.
+    boundaries : list of int
+        The increasing upper bounds of the lengths in the buckets. An
+        example of length `l` goes into the first bucket with
+        `l <= boundary`, or into the last bucket if there is none.
+    window_size : int, optional
+        The number of consecutive examples which are sorted and divided
+        into buckets together. By default, all the examples.
+    rng : :class:`numpy.random.RandomState`, optional
+        If given, the batches of every window are shuffled.
+
+    Returns
+    -------
+    A list of batches, lists of indices of the examples.
+
+    """
+    if window_size is None:
+        window_size = max(len(lengths), 1)
+    batches = []
+    for start in range(0, len(lengths), window_size):
+        window = range(start, min(start + window_size, len(lengths)))
+        buckets = defaultdict(list)
+        for index in sorted(window, key=lambda index: lengths[index]):
+            buckets[bisect_left(boundaries, lengths[index])].append(index)
+        window_batches = [bucket[i:i + batch_size]
+                          for _, bucket in sorted(buckets.items())
+                          for i in range(0, len(bucket), batch_size)]
+        if rng is not None:
+            rng.shuffle(window_batches)
+        batches.extend(window_batches)
+    return batches
+
+
+class PaddingStatistics(object):
+    """Counts the padded steps of batches.
+
+    Attributes
+    ----------
+    steps : int
+        The number of steps of the examples.
+    padded_steps : int
+        The number of steps of the padded batches.
+
+    """
+    def reset_padding_statistics(self):
+        self.steps = 0
+        self.padded_steps = 0
+
+    def count_padding(self, lengths):
+        if lengths:
+            self.steps += sum(lengths)
+            self.padded_steps += len(lengths) * max(lengths)
+
+    @property
+    def padding_ratio(self):
+        """The fraction of the padded steps which are padding."""
+        if not self.padded_steps:
+            return 0.
+        return 1. - float(self.steps) / self.padded_steps
+
+
+class LengthBucketScheme(BatchScheme, PaddingStatistics):
+    """Iterates over batches of examples of similar lengths.
+
+    The examples are shuffled, divided into windows and the batches of
+    every window are formed by :func:`bucket_batches`. The padding
+    statistics describe the batches of the last epoch.
+
+    Parameters
+    ----------
+    lengths : list of int
+        The lengths of the examples of the dataset.
+    batch_size : int
+        The maximum number of examples in a batch.
+    boundaries : list of int
+        The upper bounds of the lengths in the buckets, see
+        :func:`bucket_batches`.
+    window_size : int, optional
+        The number of examples sorted together. By default, all the
+        examples, which gives the least padding.
+    shuffle : bool, optional
+        Whether to shuffle the examples and the batches, ``True`` by
+        default.
+    rng : :class:`numpy.random.RandomState`, optional
+        The random number generator, by default seeded with
+        ``config.default_seed``.
+
+    """
+    def __init__(self, lengths, batch_size, boundaries, window_size=None,
+                 shuffle=True, rng=None):
+        super(LengthBucketScheme, self).__init__(len(lengths), batch_size)
+        self.lengths = lengths
+        self.boundaries = boundaries
+        self.window_size = window_size
+        self.shuffle = shuffle
+        if rng is None:
+            rng = numpy.random.RandomState(config.default_seed)
+        self.rng = rng
+        self.reset_padding_statistics()
+
+    def get_request_iterator(self):
+        indices = list(self.indices)
+        if self.shuffle:
+            self.rng.shuffle(indices)
+        lengths = [self.lengths[index] for index in indices]
+        batches = bucket_batches(lengths, self.batch_size, self.boundaries,
+                                 self.window_size,
+                                 self.rng if self.shuffle else None)
+        self.reset_padding_statistics()
+        for batch in batches:
+            self.count_padding([lengths[i] for i in batch])
+        return iter_([[indices[i] for i in batch] for batch in batches])
+
+
+class BucketedBatch(Transformer, PaddingStatistics):
+    """Batches a stream of examples by length.
+
+    Reads `window_size` examples at a time and emits the batches formed
+    from them by :func:`bucket_batches`. The padding statistics describe
+    the batches emitted in the current epoch.
+
+    Parameters
+    ----------
+    data_stream : :class:`~fuel.streams.AbstractDataStream`
+        A stream of examples.
+    batch_size : int
+        The maximum number of examples in a batch.
+    boundaries : list of int
+        The upper bounds of the lengths in the buckets, see
+        :func:`bucket_batches`.
+    window_size : int
+        The number of examples sorted together.
+    length_source : str, optional
+        The source whose length is the length of an example, by default
+        the first one.
+    rng : :class:`numpy.random.RandomState`, optional
+        If given, the batches of every window are shuffled.
+
+    """
+    def __init__(self, data_stream, batch_size, boundaries, window_size,
+                 length_source=None, rng=None, **kwargs):
+        if not data_stream.produces_examples:
+            raise ValueError('the input stream has to produce examples')
+        kwargs.setdefault('produces_examples', False)
+        super(BucketedBatch, self).__init__(data_stream, **kwargs)
+        self.batch_size = batch_size
+        self.boundaries = boundaries
+        self.window_size = window_size
+        if length_source is None:
+            length_source = self.sources[0]
+        self.length_index = self.sources.index(length_source)
+        self.rng = rng
+        self.batches = []
+        self.reset_padding_statistics()
+
+    def get_epoch_iterator(self, **kwargs):
+        self.batches = []
+        self.reset_padding_statistics()
+        return super(BucketedBatch, self).get_epoch_iterator(**kwargs)
+
+    def get_data(self, request=None):
+        if request is not None:
+            raise ValueError
+        if not self.batches:
+            examples = []
+            for _ in range(self.window_size):
+                try:
+                    examples.append(next(self.child_epoch_iterator))
+                except StopIteration:
+                    break
+            if not examples:
+                raise StopIteration
+            lengths = [len(example[self.length_index])
+                       for example in examples]
+            self.batches = [([examples[i] for i in batch],
+                             [lengths[i] for i in batch])
+                            for batch in bucket_batches(
+                                lengths, self.batch_size, self.boundaries,
+                                rng=self.rng)]
+        examples, lengths = self.batches.pop(0)
+        self.count_padding(lengths)
+        return tuple(list(source) for source in zip(*examples))
+
+
+class PaddingRatio(SimpleExtension):
+    """Adds the fraction of padded steps to the log.
+
+    Parameters
+    ----------
+    batching : :class:`LengthBucketScheme` or :class:`BucketedBatch`
+        The iteration scheme or the transformer forming the batches.
+    log_record : str, optional
+        The record name to use, 'padding_ratio' by default.
+
+    Notes
+    -----
+    By default, triggers after every epoch.
+
+    """
+    def __init__(self, batching, log_record='padding_ratio', **kwargs):
+        kwargs.setdefault('after_epoch', True)
+        super(PaddingRatio, self).__init__(**kwargs)
+        self.batching = batching
+        self.log_record = log_record
+
+    def do(self, *args):
+        self.main_loop.log.current_row[self.log_record] = (
+            self.batching.padding_ratio)
+
+
+class ContiguousChunks(Transformer):
+    """Splits documents into contiguous chunks for every row of a batch.
+
+    Every row of the batches reads the documents of the stream one after
+    another, a batch contains the next `chunk_length` steps of the
+    document of every row. This is the layout expected by recurrent
+    applications called with ``carry_states=True``, which continue the
+    states of every row from the previous batch. A document starts at
+    the beginning of a chunk, and the last chunk of a document is padded.
+    The rows left without documents at the end of the epoch are padded
+    as well, so that the size of the batches does not change.
+
+    For every source of the stream, produces the chunks, in the
+    time-major layout of Blocks, and their mask, with the name of the
+    source suffixed with ``_mask``. The ``reset`` source is a vector which
+    is one for the rows where a new document starts, to be given as the
+    `reset` argument of the recurrent application.
+
+    Parameters
+    ----------
+    data_stream : :class:`~fuel.streams.AbstractDataStream`
+        A stream of examples, all the sources of an example have to be
+        sequences of the same length.
+    batch_size : int
+        The number of rows in a batch.
+    chunk_length : int
+        The maximum number of steps in a chunk.
+
+    """
+    def __init__(self, data_stream, batch_size, chunk_length, **kwargs):
+        if not data_stream.produces_examples:
+            raise ValueError('the input stream has to produce examples')
+        kwargs.setdefault('produces_examples', False)
+        super(ContiguousChunks, self).__init__(data_stream, **kwargs)
+        self.batch_size = batch_size
+        self.chunk_length = chunk_length
+        self.rows = [None] * batch_size
+
+    @property
+    def sources(self):
+        sources = []
+        for source in self.data_stream.sources:
+            sources.extend([source, source + '_mask'])
+        return tuple(sources) + ('reset',)
+
+    def get_epoch_iterator(self, **kwargs):
+        # Every row holds its document and the position in it
+        self.rows = [None] * self.batch_size
+        return super(ContiguousChunks, self).get_epoch_iterator(**kwargs)
+
+    def _next_document(self):
+        for example in self.child_epoch_iterator:
+            if len(example[0]):
+                return [numpy.asarray(source) for source in example], 0
+        return None
+
+    def get_data(self, request=None):
+        if request is not None:
+            raise ValueError
+        reset = numpy.zeros(self.batch_size, dtype=theano.config.floatX)
+        for i, row in enumerate(self.rows):
+            if row is None or row[1] >= len(row[0][0]):
+                self.rows[i] = self._next_document()
+                reset[i] = 1
+        documents = [row[0] for row in self.rows if row is not None]
+        if not documents:
+            raise StopIteration
+        chunks = []
+        for i, row in enumerate(self.rows):
+            if row is None:
+                chunks.append(None)
+                continue
+            document, position = row
+            chunks.append([source[position:position + self.chunk_length]
+                           for source in document])
+            self.rows[i] = (document, position + self.chunk_length)
+        length = max(len(chunk[0]) for chunk in chunks if chunk is not None)
+
+        data = []
+        for j, example_source in enumerate(documents[0]):
+            batch = numpy.zeros(
+                (length, self.batch_size) + example_source.shape[1:],
+                dtype=example_source.dtype)
+            mask = numpy.zeros((length, self.batch_size),
+                               dtype=theano.config.floatX)
+            for i, chunk in enumerate(chunks):
+                if chunk is not None:
+                    batch[:len(chunk[j]), i] = chunk[j]
+                    mask[:len(chunk[j]), i] = 1
+            data.extend([batch, mask])
+        return tuple(data) + (reset,)
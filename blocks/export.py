@@ -0,0 +1,148 @@
+"""Export of models to the NumPy runtime.
+
+See :mod:`blocks.runtime` for running the exported models.
+
+"""
+import json
+
+import numpy
+
+from blocks.bricks import (
+    BatchNormalization, Bias, FusedLSTM, GatedRecurrent, Identity,
+    LeakyRectifier, Linear, Logistic, LSTM, Rectifier, Sequence,
+    SimpleRecurrent, Softmax, Softplus, Tanh)
+from blocks.bricks.lookup import LookupTable
+from blocks.filter import VariableFilter, get_application_call
+from blocks.roles import INITIAL_STATE
+from blocks.runtime import SPEC_NAME
+from blocks.utils import is_shared_variable
+
+ACTIVATIONS = [(Identity, 'identity'), (Tanh, 'tanh'),
+               (Logistic, 'logistic'), (Softplus, 'softplus'),
+               (LeakyRectifier, 'leaky_rectifier'),
+               (Rectifier, 'rectifier')]
+
+
+def _initial_state(brick):
+    """Find the initial state of a recurrent brick by its role."""
+    initial_state, = VariableFilter(roles=[INITIAL_STATE])(brick.parameters)
+    return initial_state
+
+
+def _export_brick(brick, arrays):
+    """Describe a brick for :func:`blocks.runtime.build`."""
+    def parameters(**variables):
+        names = {}
+        for name, variable in variables.items():
+            if not is_shared_variable(variable):
+                continue
+            array_name = brick.get_hierarchical_name(variable)
+            arrays[array_name] = variable.get_value()
+            names[name] = array_name
+        return names
+
+    for class_, function in ACTIVATIONS:
+        if isinstance(brick, class_):
+            config = {'function': function}
+            if function == 'leaky_rectifier':
+                config['leak'] = brick._leak
+            return {'type': 'activation', 'config': config}
+    if isinstance(brick, Softmax):
+        return {'type': 'softmax'}
+    if isinstance(brick, Linear):
+        return {'type': 'linear',
+                'parameters': parameters(W=brick.W, b=brick.b)
+                if brick.use_bias else parameters(W=brick.W)}
+    if isinstance(brick, Bias):
+        return {'type': 'bias', 'parameters': parameters(b=brick.b)}
+    if isinstance(brick, LookupTable):
+        return {'type': 'lookup', 'parameters': parameters(W=brick.W)}
+    if isinstance(brick, BatchNormalization):
+        variables = {'population_mean': brick.population_mean,
+                     'scale': brick.scale, 'shift': brick.shift}
+        if not brick.mean_only:
+            variables['population_stdev'] = brick.population_stdev
+        return {'type': 'batch_normalization',
+                'parameters': parameters(**variables)}
+    if isinstance(brick, SimpleRecurrent):
+        return {'type': 'simple_recurrent',
+                'parameters': parameters(
+                    W=brick.W, initial_state=_initial_state(brick)),
+                'children': {'activation': _export_brick(brick.children[0],
+                                                         arrays)}}
+    if isinstance(brick, LSTM) and not isinstance(brick, FusedLSTM):
+        return {'type': 'lstm',
+                'parameters': parameters(
+                    W_state=brick.W_state, W_cell_to_in=brick.W_cell_to_in,
+                    W_cell_to_forget=brick.W_cell_to_forget,
+                    W_cell_to_out=brick.W_cell_to_out,
+                    initial_state=brick.initial_state_,
+                    initial_cells=brick.initial_cells),
+                'children': {
+                    'activation': _export_brick(brick.activation, arrays),
+                    'gate_activation': _export_brick(brick.gate_activation,
+                                                     arrays)}}
+    if isinstance(brick, GatedRecurrent):
+        return {'type': 'gated_recurrent',
+                'parameters': parameters(
+                    state_to_state=brick.state_to_state,
+                    state_to_gates=brick.state_to_gates,
+                    initial_state=_initial_state(brick)),
+                'children': {
+                    'activation': _export_brick(brick.activation, arrays),
+                    'gate_activation': _export_brick(brick.gate_activation,
+                                                     arrays)}}
+    if isinstance(brick, Sequence):
+        layers = []
+        for application in brick.application_methods:
+            if application.name != 'apply':
+                raise ValueError("can not export the {} application of "
+                                 "{}".format(application.name,
+                                             application.brick))
+            layers.append(_export_brick(application.brick, arrays))
+        return {'type': 'sequence', 'layers': layers}
+    raise ValueError("can not export {}".format(brick))
+
+
+def _get_bricks(model):
+    """Get the top bricks of a model in the order they are applied."""
+    bricks = []
+    top_bricks = model.get_top_bricks()
+    for variable in model.variables:
+        call = get_application_call(variable)
+        if (call is not None and call.application.brick in top_bricks and
+                call.application.brick not in bricks):
+            bricks.append(call.application.brick)
+    return bricks
+
+
+def export(model, path):
+    """Export a model to the NumPy runtime.
+
+    The model should apply its top bricks one after another, each one to
+    the output of the previous one. The supported bricks are activations,
+    :class:`.Linear`, :class:`.Bias`, :class:`.Softmax`,
+    :class:`.LookupTable`, :class:`.BatchNormalization` in inference
+    mode, :class:`.SimpleRecurrent`, :class:`.LSTM`,
+    :class:`.GatedRecurrent` and sequences of these such as
+    :class:`.MLP`. The recurrent bricks return the states of all steps,
+    the :class:`.GatedRecurrent` takes its inputs and gate inputs
+    concatenated along the last axis.
+
+    Parameters
+    ----------
+    model : :class:`.Model` or list of :class:`.Brick`
+        The model, or the bricks to apply in order.
+    path : str
+        The destination, an ``.npz`` file with the current parameter
+        values and the description of the model, which can be loaded by
+        :func:`blocks.runtime.load`.
+
+    """
+    bricks = model if isinstance(model, list) else _get_bricks(model)
+    arrays = {}
+    spec = {'type': 'sequence',
+            'layers': [_export_brick(brick, arrays) for brick in bricks]}
+    arrays[SPEC_NAME] = numpy.array(json.dumps(spec))
+    with open(path, 'wb') as destination:
+        numpy.savez(destination, **arrays)
@@ -1,10 +1,17 @@
 """Extensions for monitoring the training process."""
 import logging
+import signal
+import traceback
+from collections import deque
+from multiprocessing import Process, Queue
 
 import theano
+from six.moves import cPickle, queue
+from theano import tensor
 
 from blocks.extensions import SimpleExtension, TrainingExtension
 from blocks.algorithms import UpdatesAlgorithm
+from blocks.graph import ComputationGraph
 from blocks.monitoring.aggregation import MonitoredQuantity, take_last
 from blocks.monitoring.evaluators import (
     AggregationBuffer, MonitoredQuantityBuffer, DatasetEvaluator)
@@ -52,10 +59,41 @@ class MonitoringExtension(TrainingExtension):
 
     def add_records(self, log, record_tuples):
         """Helper function to add monitoring records to the log."""
+        current_row = log.current_row
         for name, value in record_tuples:
             if not name:
                 raise ValueError("monitor variable without name")
-            log.current_row[self._record_name(name)] = value
+            current_row[self._record_name(name)] = value
+
+
+def _evaluation_worker(evaluator, data_stream, shared_variables,
+                       tasks, results):
+    """Evaluate parameter snapshots received from the training process.
+
+    Runs in a child process. Every task is a pair of the iteration number
+    and the values of `shared_variables` at that iteration. A ``None``
+    task terminates the worker. The result of a task is a triple of the
+    iteration, the values and ``None``, or of the iteration, ``None``
+    and the exception raised by the evaluation.
+
+    """
+    # The main loop handles interrupts, the worker is stopped by it.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for iteration, values in iter(tasks.get, None):
+        try:
+            for variable, value in zip(shared_variables, values):
+                variable.set_value(value)
+            result = (iteration, evaluator.evaluate(data_stream), None)
+            # The queue pickles in a background thread and only logs the
+            # errors, so that an unpicklable result would be lost
+            cPickle.dumps(result, protocol=cPickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            try:
+                cPickle.dumps(e, protocol=cPickle.HIGHEST_PROTOCOL)
+            except Exception:
+                e = RuntimeError(traceback.format_exc())
+            result = (iteration, None, e)
+        results.put(result)
 
 
 class DataStreamMonitoring(SimpleExtension, MonitoringExtension):
@@ -80,22 +118,198 @@ class DataStreamMonitoring(SimpleExtension, MonitoringExtension):
     data_stream : instance of :class:`.DataStream`
         The data stream to monitor on. A data epoch is requested
         each time monitoring is done.
+    asynchronous : bool, optional
+        If ``True``, the evaluation is done in a separate process and
+        training continues while it runs. When triggered, the extension
+        takes a snapshot of the values of the shared variables the
+        monitored variables depend on and sends it to the evaluator
+        process. The results are written to the log row of the iteration
+        at which the snapshot was taken as soon as they are available.
+        ``False`` by default.
+    max_pending : int, optional
+        The maximum number of snapshots being evaluated or waiting to be
+        evaluated in asynchronous mode. When the limit is reached,
+        training is blocked until the oldest evaluation finishes.
+        Defaults to 1.
+
+    Notes
+    -----
+    In asynchronous mode the evaluator process is forked from the
+    training process the first time the extension is triggered, so the
+    data stream must support being iterated from a child process.
+    Evaluations still pending after training are waited for in the
+    `after_training` callback.
+
+    Because asynchronous results arrive late, extensions that read them
+    from ``log.current_row`` (e.g. :class:`.TrackTheBest`) do not see
+    them. Such extensions can either call :meth:`wait` to block until
+    all the results are available, or be registered with
+    :meth:`add_listener` to be notified when results arrive.
 
     """
-    def __init__(self, variables, data_stream, updates=None, **kwargs):
+    def __init__(self, variables, data_stream, updates=None,
+                 asynchronous=False, max_pending=1, **kwargs):
         kwargs.setdefault("after_epoch", True)
         kwargs.setdefault("before_first_epoch", True)
         super(DataStreamMonitoring, self).__init__(**kwargs)
         self._evaluator = DatasetEvaluator(variables, updates)
         self.data_stream = data_stream
+        self.asynchronous = asynchronous
+        self.max_pending = max_pending
+        self._listeners = []
+        self._reset_worker()
+
+    def __getstate__(self):
+        # Processes and queues can not be pickled; evaluations that
+        # are still pending are lost.
+        state = dict(self.__dict__)
+        for attribute in ['_worker', '_tasks', '_results', '_pending']:
+            del state[attribute]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset_worker()
+
+    def _reset_worker(self):
+        self._worker = None
+        self._tasks = None
+        self._results = None
+        self._pending = deque()
+
+    def _start_worker(self):
+        evaluator = self._evaluator
+        self._shared_variables = ComputationGraph(
+            evaluator.theano_variables +
+            evaluator.monitored_quantities_buffer.requires).shared_variables
+        self._tasks = Queue()
+        self._results = Queue()
+        self._worker = Process(
+            target=_evaluation_worker,
+            args=(evaluator, self.data_stream, self._shared_variables,
+                  self._tasks, self._results))
+        self._worker.daemon = True
+        self._worker.start()
+
+    def _stop_worker(self):
+        if self._worker is not None:
+            self._tasks.put(None)
+            self._worker.join()
+        self._reset_worker()
+
+    def add_listener(self, listener):
+        """Register a function called when asynchronous results arrive.
+
+        Parameters
+        ----------
+        listener : callable
+            Called with the iteration at which the evaluated snapshot was
+            taken and a dictionary of the log records written for it.
+
+        """
+        self._listeners.append(listener)
+
+    def dispatch(self, callback_invoked, *from_main_loop):
+        if self.asynchronous:
+            self.poll()
+        super(DataStreamMonitoring, self).dispatch(callback_invoked,
+                                                   *from_main_loop)
+        if self.asynchronous:
+            if callback_invoked == 'after_training':
+                self.wait()
+                self._stop_worker()
+            elif callback_invoked == 'on_error':
+                if self._worker is not None:
+                    self._worker.terminate()
+                self._reset_worker()
 
     def do(self, callback_name, *args):
         """Write the values of monitored variables to the log."""
+        if self.asynchronous:
+            self._submit()
+            return
         logger.info("Monitoring on auxiliary data started")
         value_dict = self._evaluator.evaluate(self.data_stream)
         self.add_records(self.main_loop.log, value_dict.items())
         logger.info("Monitoring on auxiliary data finished")
 
+    def _submit(self):
+        """Send a snapshot of the current parameters for evaluation."""
+        if self._worker is None:
+            self._start_worker()
+        while len(self._pending) >= self.max_pending:
+            logger.info("Waiting for a pending evaluation to finish")
+            self._receive()
+        iteration = self.main_loop.status['iterations_done']
+        self._tasks.put(
+            (iteration,
+             [variable.get_value() for variable in self._shared_variables]))
+        self._pending.append(iteration)
+        logger.info("Monitoring on auxiliary data started for the snapshot"
+                    " taken at iteration %d", iteration)
+
+    def _receive(self):
+        """Wait for the result of one evaluation and write it to the log.
+
+        Raises the exception of a failed evaluation, or a
+        :class:`RuntimeError` if the evaluator process died.
+
+        """
+        while True:
+            try:
+                iteration, value_dict, error = self._results.get(timeout=1)
+                break
+            except queue.Empty:
+                if not self._worker.is_alive():
+                    exitcode = self._worker.exitcode
+                    self._reset_worker()
+                    raise RuntimeError(
+                        "the evaluator process died with the exit code "
+                        "{}".format(exitcode))
+        self._pending.remove(iteration)
+        if error is not None:
+            logger.error("Monitoring on auxiliary data failed for the "
+                         "snapshot taken at iteration %d", iteration)
+            raise error
+        records = dict((self._record_name(name), value)
+                       for name, value in value_dict.items())
+        self.main_loop.log[iteration].update(records)
+        logger.info("Monitoring on auxiliary data finished for the snapshot"
+                    " taken at iteration %d", iteration)
+        for listener in self._listeners:
+            listener(iteration, records)
+        return iteration
+
+    def poll(self):
+        """Write the results of finished evaluations to the log.
+
+        Does not block.
+
+        Returns
+        -------
+        iterations : list of int
+            The iterations for which results were written.
+
+        """
+        iterations = []
+        while self._pending and not self._results.empty():
+            iterations.append(self._receive())
+        return iterations
+
+    def wait(self):
+        """Block until all pending evaluations finish.
+
+        Returns
+        -------
+        iterations : list of int
+            The iterations for which results were written.
+
+        """
+        iterations = []
+        while self._pending:
+            iterations.append(self._receive())
+        return iterations
+
 
 class TrainingDataMonitoring(SimpleExtension, MonitoringExtension):
     """Monitors values of Theano variables on training batches.
@@ -145,8 +359,42 @@ class TrainingDataMonitoring(SimpleExtension, MonitoringExtension):
             [take_last(v) for v in self._non_variables.requires])
         self._variables = AggregationBuffer(
             self._variables, use_take_last=True)
+        self._readout_functions = {}
         self._last_time_called = -1
 
+    def _readout(self, read_required, read_variables):
+        """Read out and initialize the aggregation buffers.
+
+        A single Theano function is compiled for every combination of the
+        buffers, which computes the aggregated values and applies the
+        initialization updates in one call.
+
+        Returns
+        -------
+        required_values : list
+            The values required for the monitored non-Theano quantities,
+            empty if `read_required` is ``False``.
+        variable_values : list
+            The values of the monitored variables, empty if
+            `read_variables` is ``False``.
+
+        """
+        key = (read_required, read_variables)
+        buffers = [buffer for buffer, read in
+                   zip([self._required_for_non_variables, self._variables],
+                       key) if read]
+        if key not in self._readout_functions:
+            logger.debug("Compiling a readout function for %s", self.name)
+            self._readout_functions[key] = theano.function(
+                [], [tensor.as_tensor_variable(v) for buffer in buffers
+                     for v in buffer.readout_variables.values()],
+                updates=[update for buffer in buffers
+                         for update in buffer.initialization_updates])
+        values = self._readout_functions[key]()
+        num_required = (len(self._required_for_non_variables.variables)
+                        if read_required else 0)
+        return values[:num_required], values[num_required:]
+
     def do(self, callback_name, *args):
         """Initializes the buffer or commits the values to the log.
 
@@ -176,24 +424,27 @@ class TrainingDataMonitoring(SimpleExtension, MonitoringExtension):
         else:
             # When called first time at any iterations, update
             # monitored non-Theano quantities
+            read_required = False
             if (self.main_loop.status['iterations_done'] >
                     self._last_time_called):
-                self._non_variables.aggregate_quantities(
-                    list(self._required_for_non_variables
-                         .get_aggregated_values().values()))
-                self._required_for_non_variables.initialize_aggregators()
+                read_required = bool(self._non_variables.quantities)
                 self._last_time_called = (
                     self.main_loop.status['iterations_done'])
             # If only called to update non-Theano quantities,
-            # do just that
-            if args == ('just_aggregate',):
+            # do just that. Otherwise, also output current values of
+            # from the accumulators to the log.
+            read_variables = args != ('just_aggregate',)
+            if not (read_required or read_variables):
+                return
+            required_values, variable_values = self._readout(
+                read_required, read_variables)
+            if read_required:
+                self._non_variables.aggregate_quantities(required_values)
+            if not read_variables:
                 return
-            # Otherwise, also output current values of from the accumulators
-            # to the log.
             self.add_records(
                 self.main_loop.log,
-                self._variables.get_aggregated_values().items())
-            self._variables.initialize_aggregators()
+                zip(self._variables.variable_names, variable_values))
             self.add_records(
                 self.main_loop.log,
                 self._non_variables.get_aggregated_values().items())
@@ -117,9 +117,32 @@ class TrackTheBest(SimpleExtension):
         super(TrackTheBest, self).__init__(**kwargs)
 
     def do(self, which_callback, *args):
-        clsname = self.__class__.__name__
         current_value = self.main_loop.log.current_row.get(self.record_name)
-        logger.debug('%s: current value of log.current_row["%s"] = %s',
+        self._track(current_value)
+
+    def on_records(self, iteration, records):
+        """Track a value that was written to the log with a delay.
+
+        Meant to be registered as a listener of an asynchronous
+        :class:`.DataStreamMonitoring` (see
+        :meth:`~.DataStreamMonitoring.add_listener`). The notification
+        is written to the current row of the log, as this is when the
+        new best value becomes known.
+
+        Parameters
+        ----------
+        iteration : int
+            The iteration the records belong to.
+        records : dict
+            The records written to the log row of `iteration`.
+
+        """
+        if self.record_name in records:
+            self._track(records[self.record_name])
+
+    def _track(self, current_value):
+        clsname = self.__class__.__name__
+        logger.debug('%s: current value of "%s" = %s',
                      clsname, self.record_name, str(current_value))
         if current_value is None:
             return
@@ -21,6 +21,7 @@ from ..utils import (is_graph_input, is_shared_variable, dict_union,
 from .annotations import add_annotation, Annotation  # noqa
 from .bn import batch_normalization, apply_batch_normalization  # noqa
 from .bn import get_batch_normalization_updates  # noqa
+from .bn import fold_batch_normalization  # noqa
 
 logger = logging.getLogger(__name__)
 
@@ -9,11 +9,12 @@ import collections
 import contextlib
 from functools import partial
 
+import numpy
 import theano
 from toolz import isdistinct
 
 from ..roles import BATCH_NORM_OFFSET, BATCH_NORM_DIVISOR, INPUT, OUTPUT
-from ..utils import find_bricks
+from ..utils import find_bricks, is_shared_variable, shared_floatx
 
 
 def _training_mode_application_calls(application_calls):
@@ -207,6 +208,132 @@ def apply_batch_normalization(computation_graph):
     return computation_graph.replace(replacements)
 
 
+def _value(variable):
+    """Get the value of a shared variable or a constant."""
+    if is_shared_variable(variable):
+        return variable.get_value()
+    return variable.value
+
+
+def _find_folding_target(variable):
+    """Find the output of a brick the variable is a copy of.
+
+    Returns the output variable and the application call of the
+    :class:`~blocks.bricks.Linear` or
+    :class:`~blocks.bricks.conv.Convolutional` brick, or ``(None, None)``
+    if there is none.
+
+    """
+    from ..bricks import Linear
+    from ..bricks.conv import Convolutional, ConvolutionalTranspose
+    from ..filter import get_application_call
+    from ..roles import has_roles
+    while True:
+        app_call = get_application_call(variable)
+        if (app_call is not None and has_roles(variable, [OUTPUT]) and
+                isinstance(app_call.application.brick,
+                           (Linear, Convolutional)) and
+                not isinstance(app_call.application.brick,
+                               ConvolutionalTranspose)):
+            return variable, app_call
+        # Only the copies made by applications are skipped.
+        if (variable.owner is None or
+                not isinstance(variable.owner.op, theano.tensor.Elemwise) or
+                not isinstance(variable.owner.op.scalar_op,
+                               theano.scalar.basic.Identity)):
+            return None, None
+        variable = variable.owner.inputs[0]
+
+
+def fold_batch_normalization(computation_graph):
+    """Fold inference batch normalization into the preceding weights.
+
+    Every inference mode application of a
+    :class:`~blocks.bricks.BatchNormalization` brick to the output of a
+    :class:`~blocks.bricks.Linear` or
+    :class:`~blocks.bricks.conv.Convolutional` brick is replaced with
+    an application of the same transformation with the weights and
+    biases scaled and shifted so that it computes the normalized output
+    directly.
+
+    Parameters
+    ----------
+    computation_graph : :class:`~blocks.graph.ComputationGraph`
+        The computation graph containing :class:`BatchNormalization`
+        brick applications.
+
+    Returns
+    -------
+    folded_graph : :class:`~blocks.graph.ComputationGraph`
+        The computation graph, with the foldable
+        :class:`BatchNormalization` applications removed.
+
+    Notes
+    -----
+    The folded weights and biases are new shared variables holding
+    the values of the parameters and the population statistics at the
+    time of the transformation. Changing the original parameters does
+    not affect the folded graph.
+
+    Batch normalization of a convolutional output can be folded only if
+    its statistics are shared across the spatial dimensions, as in
+    :class:`~blocks.bricks.SpatialBatchNormalization`.
+
+    """
+    from blocks.bricks import BatchNormalization, Linear
+    from ..filter import VariableFilter, get_application_call
+
+    def get_app_call_dict(role):
+        variable_filter = VariableFilter(bricks=[BatchNormalization],
+                                         roles=[role])
+        return collections.OrderedDict((get_application_call(v), v) for v in
+                                       variable_filter(computation_graph))
+    inputs, outputs = map(get_app_call_dict, [INPUT, OUTPUT])
+    training_app_calls = _training_mode_application_calls(inputs.keys())
+
+    replacements = []
+    for app_call in inputs:
+        if app_call in training_app_calls:
+            continue
+        target, target_app_call = _find_folding_target(inputs[app_call])
+        if target is None:
+            continue
+        brick = app_call.application.brick
+        transform = target_app_call.application.brick
+        stdev = (1 if brick.mean_only else
+                 _value(brick.population_stdev))
+        factor = _value(brick.scale) / stdev * numpy.ones_like(
+            _value(brick.population_mean))
+        offset = (_value(brick.shift) -
+                  _value(brick.population_mean) * factor)
+        if isinstance(transform, Linear):
+            weights = transform.W.get_value() * factor
+        else:
+            # The statistics must be the same for all the positions
+            if factor.size != len(factor):
+                continue
+            factor = factor.reshape((-1,))
+            offset = offset.reshape((-1,))
+            weights = transform.W.get_value() * factor[:, None, None, None]
+        replace = {transform.W: shared_floatx(weights, name='W_folded')}
+        if transform.use_bias:
+            biases = transform.b.get_value()
+            if biases.ndim == 3:
+                # Untied biases of a convolution
+                factor = factor[:, None, None]
+                offset = offset[:, None, None]
+            replace[transform.b] = shared_floatx(biases * factor + offset,
+                                                 name='b_folded')
+            new_output = theano.clone(target, replace=replace)
+        else:
+            biases = shared_floatx(offset, name='b_folded')
+            if not isinstance(transform, Linear):
+                biases = biases.dimshuffle('x', 0, 'x', 'x')
+            new_output = theano.clone(target, replace=replace) + biases
+        replacements.append((outputs[app_call], new_output))
+    return computation_graph.replace(replacements)
+
+
 def get_batch_normalization_updates(training_graph, allow_duplicates=False):
     """Extract correspondences for learning BN population statistics.
 
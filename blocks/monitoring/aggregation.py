@@ -3,9 +3,16 @@ from functools import partial
 import logging
 from abc import ABCMeta, abstractmethod
 
+import numpy
+import theano
 from six import add_metaclass
 from theano import tensor
+from theano.compile import optdb
+from theano.gof import (Apply, DestroyHandler, Op, TopoOptimizer,
+                        local_optimizer)
+from theano.gof.type import generic
 from theano.ifelse import ifelse
+from theano.tensor.extra_ops import bincount, searchsorted
 
 from blocks.utils import shared_like
 
@@ -38,6 +45,31 @@ class AggregationScheme(object):
         """Return a new Aggregator for this variable."""
         pass
 
+    def merge(self, values):
+        """Merge partial results aggregated on consecutive parts of data.
+
+        Used for parallel evaluation, in which every worker aggregates a
+        part of the data in its own copy of the accumulators of an
+        aggregator created by this scheme.
+
+        Parameters
+        ----------
+        values : list of lists of :class:`~numpy.ndarray`
+            For every part of the data, in the order of the data, the
+            values of the accumulators after aggregating this part. Only
+            parts which contained at least one batch are given.
+
+        Returns
+        -------
+        list of :class:`~numpy.ndarray`
+            The values of the accumulators that correspond to aggregating
+            all the parts.
+
+        """
+        raise NotImplementedError(
+            "{} does not support merging partial results"
+            .format(self.__class__.__name__))
+
 
 class Aggregator(object):
     """An Aggregator incrementally evaluates a Theano variable on a dataset.
@@ -73,6 +105,9 @@ class Aggregator(object):
         Theano variable that holds the final value based on aggregated
         partial results. *readout_variable must only consist of shared
         variables and constants.*
+    accumulators : list of :class:`~tensor.TensorSharedVariable`
+        The shared variables holding the partial results, in the order
+        expected by :meth:`AggregationScheme.merge`.
 
     Attributes
     ----------
@@ -80,7 +115,8 @@ class Aggregator(object):
 
     """
     def __init__(self, aggregation_scheme, initialization_updates=None,
-                 accumulation_updates=None, readout_variable=None):
+                 accumulation_updates=None, readout_variable=None,
+                 accumulators=None):
         self.aggregation_scheme = aggregation_scheme
         self.readout_variable = readout_variable
 
@@ -88,8 +124,11 @@ class Aggregator(object):
             initialization_updates = []
         if accumulation_updates is None:
             accumulation_updates = []
+        if accumulators is None:
+            accumulators = []
         self.initialization_updates = initialization_updates
         self.accumulation_updates = accumulation_updates
+        self.accumulators = accumulators
 
 
 class Mean(AggregationScheme):
@@ -139,9 +178,20 @@ class Mean(AggregationScheme):
                                 initialization_updates=initialization_updates,
                                 accumulation_updates=accumulation_updates,
                                 readout_variable=(numerator_acc /
-                                                  denominator_acc))
+                                                  denominator_acc),
+                                accumulators=[numerator_acc, denominator_acc,
+                                              initialized])
         return aggregator
 
+    def merge(self, values):
+        numerators, denominators, initialized = zip(*values)
+        return [_sum(numerators), _sum(denominators), initialized[-1]]
+
+
+def _sum(arrays):
+    """Sum arrays keeping the dtype of the first one."""
+    return numpy.asarray(sum(arrays[1:], arrays[0]), dtype=arrays[0].dtype)
+
 
 class Perplexity(Mean):
 
@@ -175,6 +225,9 @@ class _DataIndependent(AggregationScheme):
                           accumulation_updates=[],
                           readout_variable=self.variable)
 
+    def merge(self, values):
+        return []
+
 
 class TakeLast(AggregationScheme):
     """Aggregation scheme which remembers only the last value."""
@@ -184,7 +237,11 @@ class TakeLast(AggregationScheme):
                           initialization_updates=[
                               (self.storage, tensor.zeros_like(self.storage))],
                           accumulation_updates=[(self.storage, self.variable)],
-                          readout_variable=self.storage)
+                          readout_variable=self.storage,
+                          accumulators=[self.storage])
+
+    def merge(self, values):
+        return values[-1]
 
 
 def _simple_aggregation(scheme, variable):
@@ -210,13 +267,23 @@ class Minimum(AggregationScheme):
                               (self.storage, accumulate),
                               (initialized, tensor.ones_like(initialized))
                           ],
-                          readout_variable=self.storage)
+                          readout_variable=self.storage,
+                          accumulators=[self.storage, initialized])
 
     def get_aggregator(self):
         self.storage = shared_like(self.variable)
         return self._build_aggregator(tensor.minimum(self.storage,
                                                      self.variable))
 
+    def _merge_storage(self, storages):
+        return numpy.minimum.reduce(storages)
+
+    def merge(self, values):
+        storages, initialized = zip(*values)
+        return [numpy.asarray(self._merge_storage(storages),
+                              dtype=storages[0].dtype),
+                initialized[-1]]
+
 minimum = partial(_simple_aggregation, Minimum)
 
 
@@ -227,12 +294,104 @@ class Maximum(Minimum):
         return self._build_aggregator(tensor.maximum(self.storage,
                                                      self.variable))
 
+    def _merge_storage(self, storages):
+        return numpy.maximum.reduce(storages)
+
 maximum = partial(_simple_aggregation, Maximum)
 
 
+class _NewList(Op):
+    """Returns a new empty list."""
+    __props__ = ()
+
+    def make_node(self):
+        return Apply(self, [], [generic()])
+
+    def perform(self, node, inputs, output_storage):
+        output_storage[0][0] = []
+
+
+class _AppendToList(Op):
+    """Appends a copy of an array to a list."""
+    __props__ = ('inplace',)
+
+    def __init__(self, inplace=False):
+        self.inplace = inplace
+        if self.inplace:
+            self.destroy_map = {0: [0]}
+
+    def make_node(self, list_, x):
+        return Apply(self, [list_, tensor.as_tensor_variable(x)],
+                     [generic()])
+
+    def perform(self, node, inputs, output_storage):
+        list_, x = inputs
+        if not self.inplace:
+            list_ = list(list_)
+        # Theano can reuse the memory of `x` in the next call
+        list_.append(numpy.array(x, copy=True))
+        output_storage[0][0] = list_
+
+
+@local_optimizer([_AppendToList], inplace=True)
+def _append_to_list_inplace(node):
+    if isinstance(node.op, _AppendToList) and not node.op.inplace:
+        return [_AppendToList(inplace=True)(*node.inputs)]
+    return False
+
+
+class _AppendToListInplaceOptimizer(TopoOptimizer):
+    """Makes the appends to lists in place.
+
+    Theano only checks that an operation can destroy its inputs when
+    the graph has a destroy handler, which is only added in the
+    ``fast_run`` mode. This optimizer adds it itself, so that the appends
+    are made in place in the ``fast_compile`` mode too. Otherwise the
+    list would be copied at every batch.
+
+    """
+    def add_requirements(self, fgraph):
+        super(_AppendToListInplaceOptimizer, self).add_requirements(fgraph)
+        fgraph.attach_feature(DestroyHandler())
+
+
+optdb.register('blocks_append_to_list_inplace',
+               _AppendToListInplaceOptimizer(
+                   _append_to_list_inplace,
+                   failure_callback=TopoOptimizer.warn_inplace),
+               60, 'fast_run', 'fast_compile', 'inplace')
+
+
+class _ConcatenateList(Op):
+    """Concatenates a list of arrays along the first axis."""
+    __props__ = ('ndim', 'dtype')
+
+    def __init__(self, ndim, dtype):
+        self.ndim = ndim
+        self.dtype = dtype
+
+    def make_node(self, list_):
+        return Apply(self, [list_],
+                     [tensor.TensorType(self.dtype,
+                                        (False,) * self.ndim)()])
+
+    def perform(self, node, inputs, output_storage):
+        list_, = inputs
+        if list_:
+            value = numpy.concatenate(list_)
+        else:
+            value = numpy.zeros((0,) * self.ndim, dtype=self.dtype)
+        output_storage[0][0] = value
+
+
 class Concatenate(Minimum):
     """Aggregation scheme which remembers values from all batches.
 
+    The values from the batches are appended to a list, which is
+    concatenated only when the aggregated value is read out. This way
+    aggregating over :math:`n` batches takes :math:`O(n)` time instead
+    of the :math:`O(n^2)` of concatenating at every batch.
+
     Parameters
     ----------
     variable: :class:`~tensor.TensorVariable`
@@ -247,13 +406,203 @@ class Concatenate(Minimum):
         super(Concatenate, self).__init__(variable)
 
     def get_aggregator(self):
-        self.storage = shared_like(self.variable)
-        return self._build_aggregator(tensor.concatenate([self.storage,
-                                                          self.variable]))
+        self.storage = theano.shared(
+            [], name="shared_{}".format(self.variable.name))
+        return Aggregator(aggregation_scheme=self,
+                          initialization_updates=[
+                              (self.storage, _NewList()())],
+                          accumulation_updates=[
+                              (self.storage,
+                               _AppendToList()(self.storage, self.variable))],
+                          readout_variable=_ConcatenateList(
+                              self.variable.ndim,
+                              self.variable.dtype)(self.storage),
+                          accumulators=[self.storage])
+
+    def merge(self, values):
+        return [sum((storage for storage, in values), [])]
 
 concatenate = partial(_simple_aggregation, Concatenate)
 
 
+class Histogram(AggregationScheme):
+    """Aggregation scheme which counts values falling into fixed bins.
+
+    All the elements of the variable are counted. Values smaller than the
+    first bin edge are counted in the first bin and values larger than
+    the last edge in the last bin. The aggregated value is the vector of
+    counts.
+
+    Parameters
+    ----------
+    variable: :class:`~tensor.TensorVariable`
+        The variable that holds the desired values on a single batch.
+    bins : array_like
+        The monotonically increasing bin edges, including the leftmost
+        and the rightmost ones.
+
+    """
+    def __init__(self, variable, bins):
+        super(Histogram, self).__init__(variable)
+        self.bins = numpy.asarray(bins, dtype=theano.config.floatX)
+        if self.bins.ndim != 1 or len(self.bins) < 2:
+            raise ValueError("at least two bin edges are needed")
+
+    def get_aggregator(self):
+        num_bins = len(self.bins) - 1
+        counts = theano.shared(numpy.zeros(num_bins, dtype='int64'),
+                               name="shared_{}".format(self.variable.name))
+        indices = searchsorted(tensor.constant(self.bins[1:-1]),
+                               self.variable.flatten(), side='right')
+        batch_counts = bincount(indices, minlength=num_bins)
+        return Aggregator(aggregation_scheme=self,
+                          initialization_updates=[
+                              (counts, tensor.zeros_like(counts))],
+                          accumulation_updates=[
+                              (counts, counts + batch_counts)],
+                          readout_variable=counts,
+                          accumulators=[counts])
+
+    def merge(self, values):
+        counts, = zip(*values)
+        return [_sum(counts)]
+
+
+def histogram(variable, bins):
+    """Count the values of a variable falling into fixed bins."""
+    return _simple_aggregation(partial(Histogram, bins=bins), variable)
+
+
+def _compress_centroids(means, weights, compression):
+    """Merge weighted centroids so that at most `compression + 1` remain.
+
+    Centroids are grouped by the arcsine of their quantile, as in the
+    t-digest, which keeps the groups small close to the tails.
+
+    """
+    order = numpy.argsort(means, kind='mergesort')
+    means, weights = means[order], weights[order]
+    quantiles = (numpy.cumsum(weights) - weights / 2) / weights.sum()
+    groups = numpy.floor(compression *
+                         (numpy.arcsin(2 * quantiles - 1) / numpy.pi + 0.5))
+    _, groups = numpy.unique(groups, return_inverse=True)
+    new_weights = numpy.bincount(groups, weights)
+    new_means = numpy.bincount(groups, weights * means) / new_weights
+    return new_means, new_weights
+
+
+def _merge_sketches(sketches, compression):
+    """Merge quantile sketches, ignoring empty ones."""
+    sketches = [sketch for sketch in sketches if sketch]
+    if not sketches:
+        return ()
+    means, weights, minima, maxima = zip(*sketches)
+    means, weights = _compress_centroids(
+        numpy.concatenate(means), numpy.concatenate(weights), compression)
+    return means, weights, min(minima), max(maxima)
+
+
+class _UpdateSketch(Op):
+    """Adds the elements of an array to a quantile sketch."""
+    __props__ = ('compression',)
+
+    def __init__(self, compression):
+        self.compression = compression
+
+    def make_node(self, sketch, x):
+        return Apply(self, [sketch, tensor.as_tensor_variable(x)],
+                     [generic()])
+
+    def perform(self, node, inputs, output_storage):
+        sketch, x = inputs
+        x = numpy.asarray(x, dtype='float64').flatten()
+        if x.size:
+            x = (x, numpy.ones_like(x), x.min(), x.max())
+            sketch = _merge_sketches([sketch, x], self.compression)
+        output_storage[0][0] = sketch
+
+
+class _SketchQuantiles(Op):
+    """Estimates quantiles from a quantile sketch."""
+    __props__ = ('quantiles', 'dtype')
+
+    def __init__(self, quantiles, dtype):
+        self.quantiles = quantiles
+        self.dtype = dtype
+
+    def make_node(self, sketch):
+        return Apply(self, [sketch], [tensor.vector(dtype=self.dtype)])
+
+    def perform(self, node, inputs, output_storage):
+        sketch, = inputs
+        if not sketch:
+            value = numpy.nan * numpy.ones(len(self.quantiles))
+        else:
+            means, weights, minimum, maximum = sketch
+            total = weights.sum()
+            positions = numpy.cumsum(weights) - weights / 2
+            value = numpy.interp(
+                numpy.asarray(self.quantiles) * total,
+                numpy.concatenate([[0], positions, [total]]),
+                numpy.concatenate([[minimum], means, [maximum]]))
+        output_storage[0][0] = numpy.asarray(value, dtype=self.dtype)
+
+
+class Quantiles(AggregationScheme):
+    """Aggregation scheme which estimates quantiles of the values.
+
+    All the elements of the variable are taken into account. Instead of
+    storing all the values, a sketch of at most `compression + 1`
+    weighted centroids is maintained, similar to the t-digest [Dunning]_.
+    The estimates are most accurate close to the tails of the
+    distribution. The aggregated value is the vector of the estimated
+    quantiles.
+
+    Parameters
+    ----------
+    variable: :class:`~tensor.TensorVariable`
+        The variable that holds the desired values on a single batch.
+    quantiles : tuple of float, optional
+        The quantiles to estimate, between 0 and 1. By default the
+        median, the 90th and the 99th percentiles.
+    compression : int, optional
+        The maximum number of centroids minus one. Defaults to 100.
+
+    .. [Dunning] Ted Dunning and Otmar Ertl, *Computing Extremely
+       Accurate Quantiles Using t-Digests*.
+
+    """
+    def __init__(self, variable, quantiles=(0.5, 0.9, 0.99),
+                 compression=100):
+        super(Quantiles, self).__init__(variable)
+        self.quantiles = tuple(quantiles)
+        self.compression = compression
+
+    def get_aggregator(self):
+        sketch = theano.shared(
+            (), name="shared_{}".format(self.variable.name))
+        return Aggregator(aggregation_scheme=self,
+                          initialization_updates=[
+                              (sketch, theano.Constant(generic, ()))],
+                          accumulation_updates=[
+                              (sketch, _UpdateSketch(self.compression)(
+                                  sketch, self.variable))],
+                          readout_variable=_SketchQuantiles(
+                              self.quantiles, theano.config.floatX)(sketch),
+                          accumulators=[sketch])
+
+    def merge(self, values):
+        sketches, = zip(*values)
+        return [_merge_sketches(sketches, self.compression)]
+
+
+def quantiles(variable, quantiles=(0.5, 0.9, 0.99), compression=100):
+    """Estimate quantiles of the values of a variable."""
+    return _simple_aggregation(
+        partial(Quantiles, quantiles=quantiles, compression=compression),
+        variable)
+
+
 @add_metaclass(ABCMeta)
 class MonitoredQuantity(object):
     """The base class for monitored-quantities.
@@ -303,3 +652,22 @@ class MonitoredQuantity(object):
     def get_aggregated_value(self):
         """Obtain the result of aggregation."""
         pass
+
+    def merge(self, other):
+        """Merge the results aggregated by another copy of this quantity.
+
+        Used for parallel evaluation, in which every worker aggregates a
+        part of the data in its own copy of the quantity. The copies are
+        merged into an initialized quantity in the order of the data.
+        Note that the copies do not have the :attr:`requires` attribute.
+
+        Parameters
+        ----------
+        other : :class:`MonitoredQuantity`
+            The copy of this quantity that aggregated the next part of
+            the data.
+
+        """
+        raise NotImplementedError(
+            "{} does not support merging partial results"
+            .format(self.__class__.__name__))
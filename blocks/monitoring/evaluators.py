@@ -1,7 +1,13 @@
 from collections import OrderedDict, Counter
+import copy
 import logging
+import multiprocessing
+import signal
+import sys
+import traceback
 
 from picklable_itertools.extras import equizip
+from six.moves import cPickle, queue
 import theano
 from theano import tensor
 
@@ -91,6 +97,32 @@ class MonitoredQuantityBuffer(object):
                     *[numerical_values[self.requires.index(requirement)]
                         for requirement in quantity.requires])
 
+    def get_states(self):
+        """Get the states of the quantities without their requirements."""
+        states = []
+        for quantity in self.quantities:
+            state = dict(quantity.__dict__)
+            del state['requires']
+            states.append(state)
+        return states
+
+    def merge_states(self, states):
+        """Merge the states aggregated on consecutive parts of data.
+
+        Parameters
+        ----------
+        states : list of lists of dicts
+            For every part of the data, in the order of the data, the
+            states of the quantities as returned by :meth:`get_states`.
+
+        """
+        self.initialize_quantities()
+        for part_states in states:
+            for quantity, state in equizip(self.quantities, part_states):
+                other = copy.copy(quantity)
+                other.__dict__ = state
+                quantity.merge(other)
+
 
 class AggregationBuffer(object):
     """Intermediate results of aggregating values of Theano variables.
@@ -132,11 +164,13 @@ class AggregationBuffer(object):
         self.inputs = self._computation_graph.inputs
 
         self._initialized = False
+        self._initialize_fun = None
+        self._readout_fun = None
         self._create_aggregators()
-        self._compile()
 
     def _create_aggregators(self):
         """Create aggregators and collect updates."""
+        self.aggregators = []
         self.initialization_updates = []
         self.accumulation_updates = []
         self.readout_variables = OrderedDict()
@@ -158,13 +192,19 @@ class AggregationBuffer(object):
                     v.tag.aggregation_scheme = Mean(v, 1.0)
 
             aggregator = v.tag.aggregation_scheme.get_aggregator()
+            self.aggregators.append(aggregator)
             self.initialization_updates.extend(
                 aggregator.initialization_updates)
             self.accumulation_updates.extend(aggregator.accumulation_updates)
             self.readout_variables[v.name] = aggregator.readout_variable
 
-    def _compile(self):
-        """Compiles Theano functions.
+    def _compile_initialization(self):
+        """Compiles the initialization function on its first use.
+
+        The functions are compiled lazily, since users such as
+        :class:`.TrainingDataMonitoring` may apply the initialization
+        updates and read out the aggregated values with functions of
+        their own.
 
         .. todo::
 
@@ -173,26 +213,28 @@ class AggregationBuffer(object):
             be out-sourced to `ComputationGraph` to deal with it.
 
         """
-        logger.debug("Compiling initialization and readout functions")
-        if self.initialization_updates:
+        if self._initialize_fun is None:
+            logger.debug("Compiling initialization function")
             self._initialize_fun = theano.function(
                 [], [], updates=self.initialization_updates)
-        else:
-            self._initialize_fun = None
 
-        # We need to call `as_tensor_variable` here
-        # to avoid returning `CudaNdarray`s to the user, which
-        # happens otherwise under some circumstances (see
-        # https://groups.google.com/forum/#!topic/theano-users/H3vkDN-Shok)
-        self._readout_fun = theano.function(
-            [], [tensor.as_tensor_variable(v)
-                 for v in self.readout_variables.values()])
-        logger.debug("Initialization and readout functions compiled")
+    def _compile_readout(self):
+        """Compiles the readout function on its first use."""
+        if self._readout_fun is None:
+            logger.debug("Compiling readout function")
+            # We need to call `as_tensor_variable` here
+            # to avoid returning `CudaNdarray`s to the user, which
+            # happens otherwise under some circumstances (see
+            # https://groups.google.com/forum/#!topic/theano-users/H3vkDN-Shok)
+            self._readout_fun = theano.function(
+                [], [tensor.as_tensor_variable(v)
+                     for v in self.readout_variables.values()])
 
     def initialize_aggregators(self):
         """Initialize the aggregators."""
         self._initialized = True
-        if self._initialize_fun is not None:
+        if self.initialization_updates:
+            self._compile_initialization()
             self._initialize_fun()
 
     def get_aggregated_values(self):
@@ -200,9 +242,34 @@ class AggregationBuffer(object):
         if not self._initialized:
             raise Exception("To readout you must first initialize, then "
                             "process batches!")
+        self._compile_readout()
         ret_vals = self._readout_fun()
         return OrderedDict(equizip(self.variable_names, ret_vals))
 
+    def get_accumulator_values(self):
+        """Get the values of the accumulators of all the aggregators."""
+        return [[accumulator.get_value() for accumulator
+                 in aggregator.accumulators]
+                for aggregator in self.aggregators]
+
+    def merge_accumulator_values(self, values):
+        """Set the accumulators to the merge of partial results.
+
+        Parameters
+        ----------
+        values : list
+            For every part of the data, in the order of the data, the
+            values of the accumulators as returned by
+            :meth:`get_accumulator_values`.
+
+        """
+        for i, aggregator in enumerate(self.aggregators):
+            merged = aggregator.aggregation_scheme.merge(
+                [part_values[i] for part_values in values])
+            for accumulator, value in equizip(aggregator.accumulators,
+                                              merged):
+                accumulator.set_value(value)
+
 
 class DatasetEvaluator(object):
     """A DatasetEvaluator evaluates many Theano variables or other quantities.
@@ -342,3 +409,196 @@ class DatasetEvaluator(object):
                 'will not iterate the over data!')
 
         return self.get_aggregated_values()
+
+
+def _evaluation_worker(evaluator, tasks, results):
+    """Aggregate parts of the data received from the parent process.
+
+    Every task is a pair of the index of a part of the data and the
+    list of its batches. A ``None`` task terminates the worker. The
+    result of a task is the index, ``None`` and the partial results, or
+    the index and the exception raised while aggregating the part.
+
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for index, batches in iter(tasks.get, None):
+        try:
+            evaluator.initialize_aggregators()
+            for batch in batches:
+                evaluator.process_batch(batch)
+            # Pickle right away, as the queue would do it in a separate
+            # thread while the next part is already being aggregated.
+            result = cPickle.dumps(
+                (index, None,
+                 evaluator.theano_buffer.get_accumulator_values(),
+                 evaluator.monitored_quantities_buffer.get_states()),
+                protocol=cPickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            try:
+                result = cPickle.dumps((index, e, None, None),
+                                       protocol=cPickle.HIGHEST_PROTOCOL)
+            except Exception:
+                result = cPickle.dumps(
+                    (index, RuntimeError(traceback.format_exc()), None,
+                     None), protocol=cPickle.HIGHEST_PROTOCOL)
+        results.put(result)
+
+
+def _check_workers(workers):
+    """Raise an error if a worker process died."""
+    for worker in workers:
+        if not worker.is_alive() and worker.exitcode:
+            raise RuntimeError("an evaluation worker died with the exit "
+                               "code {}".format(worker.exitcode))
+
+
+def _put(tasks, task, workers):
+    """Put a task, checking that the workers are still alive."""
+    while True:
+        try:
+            tasks.put(task, timeout=1)
+            return
+        except queue.Full:
+            _check_workers(workers)
+
+
+def _get(results, workers):
+    """Get a result, checking that the workers are still alive."""
+    while True:
+        try:
+            return results.get(timeout=1)
+        except queue.Empty:
+            _check_workers(workers)
+
+
+def _fork_context():
+    """Return the multiprocessing context which forks the workers."""
+    if hasattr(multiprocessing, 'get_context'):
+        try:
+            return multiprocessing.get_context('fork')
+        except ValueError:
+            pass
+    elif sys.platform != 'win32':
+        return multiprocessing
+    raise RuntimeError("the parallel evaluation requires the fork start "
+                       "method, which is not available on this platform")
+
+
+class ParallelDatasetEvaluator(DatasetEvaluator):
+    """Evaluates Theano variables on a dataset with several processes.
+
+    The data stream is read in the main process and split into parts of
+    consecutive batches, which are distributed among worker processes.
+    Every worker aggregates the parts it receives with the compiled
+    aggregation function and returns the partial results, which are
+    then merged in the order of the data with
+    :meth:`.AggregationScheme.merge` and
+    :meth:`.MonitoredQuantity.merge`. The results are the same as the
+    ones of :class:`DatasetEvaluator`.
+
+    Parameters
+    ----------
+    variables : list of :class:`~tensor.TensorVariable` and
+        :class:`MonitoredQuantity`
+        See :class:`DatasetEvaluator`.
+    updates : list of tuples or :class:`~collections.OrderedDict` or None
+        Not supported, the updates would only be made in the workers. A
+        :class:`ValueError` is raised if given.
+    num_workers : int, optional
+        The number of worker processes. Defaults to the number of CPUs.
+    batches_per_part : int, optional
+        The number of consecutive batches sent to a worker at once.
+        Defaults to 16.
+
+    Notes
+    -----
+    The workers are forked at the beginning of every call to
+    :meth:`evaluate`, so they use the current values of the shared
+    variables and the functions compiled in the main process. The fork
+    start method of :mod:`multiprocessing` is used whatever the default
+    one is, a :class:`RuntimeError` is raised on the platforms where it is
+    not available, such as Windows. Forking a process that uses a GPU is
+    not supported.
+
+    """
+    def __init__(self, variables, updates=None, num_workers=None,
+                 batches_per_part=16):
+        if updates:
+            raise ValueError("updates are not supported, they would only "
+                             "be made in the worker processes")
+        _fork_context()
+        super(ParallelDatasetEvaluator, self).__init__(variables, updates)
+        if num_workers is None:
+            num_workers = multiprocessing.cpu_count()
+        self.num_workers = num_workers
+        self.batches_per_part = batches_per_part
+
+    def evaluate(self, data_stream):
+        """Compute the variables over a data stream.
+
+        Parameters
+        ----------
+        data_stream : instance of :class:`.DataStream`
+            The data stream. Only the first epoch of data is used.
+
+        Returns
+        -------
+        A mapping from record names to the values computed on the provided
+        dataset.
+
+        """
+        if not hasattr(self, '_aggregate_fun'):
+            self._compile()
+        if self._aggregate_fun is None:
+            return super(ParallelDatasetEvaluator, self).evaluate(
+                data_stream)
+        # Compiles the initialization function before forking, so that
+        # the workers do not compile it again
+        self.initialize_aggregators()
+
+        context = _fork_context()
+        tasks = context.Queue(2 * self.num_workers)
+        results = context.Queue()
+        workers = [context.Process(target=_evaluation_worker,
+                                   args=(self, tasks, results))
+                   for _ in range(self.num_workers)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        try:
+            num_parts = 0
+            batches = []
+            for batch in data_stream.get_epoch_iterator(as_dict=True):
+                batches.append(batch)
+                if len(batches) == self.batches_per_part:
+                    _put(tasks, (num_parts, batches), workers)
+                    num_parts += 1
+                    batches = []
+            if batches:
+                _put(tasks, (num_parts, batches), workers)
+                num_parts += 1
+            for _ in workers:
+                _put(tasks, None, workers)
+            parts = []
+            for _ in range(num_parts):
+                index, error, accumulator_values, states = cPickle.loads(
+                    _get(results, workers))
+                if error is not None:
+                    raise error
+                parts.append((index, accumulator_values, states))
+            parts.sort(key=lambda part: part[0])
+            for worker in workers:
+                worker.join()
+        finally:
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+                worker.join()
+
+        self.initialize_aggregators()
+        if parts:
+            self.theano_buffer.merge_accumulator_values(
+                [accumulator_values for _, accumulator_values, _ in parts])
+            self.monitored_quantities_buffer.merge_states(
+                [states for _, _, states in parts])
+        return self.get_aggregated_values()
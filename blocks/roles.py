@@ -135,6 +135,13 @@ class InitialStateRole(ParameterRole):
 INITIAL_STATE = InitialStateRole()
 
 
+class CarriedStateRole(PersistentRole):
+    pass
+
+#: The final states of a recurrent application kept for the next batch
+CARRIED_STATE = CarriedStateRole()
+
+
 class FilterRole(WeightRole):
     pass
 
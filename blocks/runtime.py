@@ -0,0 +1,316 @@
+"""NumPy runtime for exported models.
+
+Running a model exported by :func:`blocks.export.export` does not need
+Theano, which makes inference workers start fast and keeps their memory
+footprint small. This module only depends on NumPy and must not import
+Theano, directly or through other Blocks modules.
+
+Sequences follow the time-major layout of Blocks, that is a sequence
+input has the shape (time, batch, features) and its mask has the shape
+(time, batch).
+
+"""
+import json
+import tarfile
+from abc import ABCMeta, abstractmethod
+from contextlib import closing
+
+import numpy
+from six import add_metaclass
+
+#: The name of the array with the description of the layers
+SPEC_NAME = '__spec__'
+
+
+def _logistic(x):
+    return 1 / (1 + numpy.exp(-x))
+
+
+@add_metaclass(ABCMeta)
+class Layer(object):
+    """A layer of an exported model."""
+    @abstractmethod
+    def apply(self, input_, mask=None):
+        """Apply the layer.
+
+        Parameters
+        ----------
+        input_ : :class:`numpy.ndarray`
+            The input of the layer.
+        mask : :class:`numpy.ndarray`, optional
+            The mask of sequence inputs, only used by recurrent layers.
+
+        """
+        pass
+
+
+class Activation(Layer):
+    """An elementwise activation, see :mod:`blocks.bricks.simple`."""
+    functions = {
+        'identity': lambda x: x,
+        'tanh': numpy.tanh,
+        'logistic': _logistic,
+        'softplus': lambda x: numpy.logaddexp(0, x),
+        'rectifier': lambda x: numpy.maximum(x, 0)}
+
+    def __init__(self, function, leak=None):
+        self.function = function
+        self.leak = leak
+
+    def apply(self, input_, mask=None):
+        if self.function == 'leaky_rectifier':
+            return numpy.where(input_ > 0, input_, self.leak * input_)
+        return self.functions[self.function](input_)
+
+
+class Linear(Layer):
+    def __init__(self, W, b=None):
+        self.W = W
+        self.b = b
+
+    def apply(self, input_, mask=None):
+        output = input_.dot(self.W)
+        if self.b is not None:
+            output += self.b
+        return output
+
+
+class Bias(Layer):
+    def __init__(self, b):
+        self.b = b
+
+    def apply(self, input_, mask=None):
+        return input_ + self.b
+
+
+class Softmax(Layer):
+    def apply(self, input_, mask=None):
+        exp = numpy.exp(input_ - input_.max(axis=-1, keepdims=True))
+        return exp / exp.sum(axis=-1, keepdims=True)
+
+
+class LookupTable(Layer):
+    def __init__(self, W):
+        self.W = W
+
+    def apply(self, input_, mask=None):
+        return self.W[input_]
+
+
+class BatchNormalization(Layer):
+    """Batch normalization with the population statistics."""
+    def __init__(self, population_mean, population_stdev=None, scale=None,
+                 shift=None):
+        self.population_mean = population_mean
+        self.population_stdev = population_stdev
+        self.scale = scale
+        self.shift = shift
+
+    def apply(self, input_, mask=None):
+        output = input_ - self.population_mean
+        if self.population_stdev is not None:
+            output = output / self.population_stdev
+        if self.scale is not None:
+            output = output * self.scale
+        if self.shift is not None:
+            output = output + self.shift
+        return output
+
+
+class Recurrent(Layer):
+    """A recurrent transition applied to a whole sequence.
+
+    Returns the states of all steps. The states of the masked steps are
+    copied from the previous ones, like in the recurrent bricks.
+
+    """
+    @abstractmethod
+    def initial_states(self, batch_size):
+        """Return the list of initial states, the first one is output."""
+        pass
+
+    @abstractmethod
+    def step(self, input_, states):
+        """Return the list of next states given the input of a step."""
+        pass
+
+    def apply(self, input_, mask=None):
+        states = self.initial_states(input_.shape[1])
+        outputs = []
+        for i in range(len(input_)):
+            next_states = self.step(input_[i], states)
+            if mask is not None:
+                step_mask = mask[i][:, None]
+                next_states = [step_mask * next_state +
+                               (1 - step_mask) * state
+                               for next_state, state
+                               in zip(next_states, states)]
+            states = next_states
+            outputs.append(states[0])
+        return numpy.stack(outputs)
+
+
+class SimpleRecurrent(Recurrent):
+    def __init__(self, W, initial_state, activation):
+        self.W = W
+        self.initial_state = initial_state
+        self.activation = activation
+
+    def initial_states(self, batch_size):
+        return [numpy.repeat(self.initial_state[None], batch_size, 0)]
+
+    def step(self, input_, states):
+        state, = states
+        return [self.activation.apply(input_ + state.dot(self.W))]
+
+
+class LSTM(Recurrent):
+    def __init__(self, W_state, W_cell_to_in, W_cell_to_forget,
+                 W_cell_to_out, initial_state, initial_cells, activation,
+                 gate_activation):
+        self.W_state = W_state
+        self.W_cell_to_in = W_cell_to_in
+        self.W_cell_to_forget = W_cell_to_forget
+        self.W_cell_to_out = W_cell_to_out
+        self.initial_state = initial_state
+        self.initial_cells = initial_cells
+        self.activation = activation
+        self.gate_activation = gate_activation
+
+    def initial_states(self, batch_size):
+        return [numpy.repeat(self.initial_state[None], batch_size, 0),
+                numpy.repeat(self.initial_cells[None], batch_size, 0)]
+
+    def step(self, input_, states):
+        state, cells = states
+        dim = len(self.initial_state)
+        activation = state.dot(self.W_state) + input_
+        in_gate = self.gate_activation.apply(
+            activation[:, :dim] + cells * self.W_cell_to_in)
+        forget_gate = self.gate_activation.apply(
+            activation[:, dim:2 * dim] + cells * self.W_cell_to_forget)
+        next_cells = (
+            forget_gate * cells +
+            in_gate * self.activation.apply(activation[:, 2 * dim:3 * dim]))
+        out_gate = self.gate_activation.apply(
+            activation[:, 3 * dim:] + next_cells * self.W_cell_to_out)
+        return [out_gate * self.activation.apply(next_cells), next_cells]
+
+
+class GatedRecurrent(Recurrent):
+    """The gated recurrent transition.
+
+    The input is the concatenation of the `inputs` and the `gate_inputs`
+    of :class:`.GatedRecurrent` along the last axis.
+
+    """
+    def __init__(self, state_to_state, state_to_gates, initial_state,
+                 activation, gate_activation):
+        self.state_to_state = state_to_state
+        self.state_to_gates = state_to_gates
+        self.initial_state = initial_state
+        self.activation = activation
+        self.gate_activation = gate_activation
+
+    def initial_states(self, batch_size):
+        return [numpy.repeat(self.initial_state[None], batch_size, 0)]
+
+    def step(self, input_, states):
+        state, = states
+        dim = len(self.initial_state)
+        gate_values = self.gate_activation.apply(
+            state.dot(self.state_to_gates) + input_[:, dim:])
+        update_values = gate_values[:, :dim]
+        reset_values = gate_values[:, dim:]
+        next_state = self.activation.apply(
+            (state * reset_values).dot(self.state_to_state) + input_[:, :dim])
+        return [next_state * update_values + state * (1 - update_values)]
+
+
+class Sequence(Layer):
+    """Applies layers one after another."""
+    def __init__(self, layers):
+        self.layers = layers
+
+    def apply(self, input_, mask=None):
+        for layer in self.layers:
+            input_ = layer.apply(input_, mask)
+        return input_
+
+
+LAYERS = {
+    'activation': Activation, 'linear': Linear, 'bias': Bias,
+    'softmax': Softmax, 'lookup': LookupTable,
+    'batch_normalization': BatchNormalization,
+    'simple_recurrent': SimpleRecurrent, 'lstm': LSTM,
+    'gated_recurrent': GatedRecurrent, 'sequence': Sequence}
+
+
+def build(spec, arrays):
+    """Build a layer from its description.
+
+    Parameters
+    ----------
+    spec : dict
+        The description of the layer. Its `type` is a key of
+        :data:`LAYERS`, its `parameters` are the names of its arrays in
+        `arrays`, its `config` are other keyword arguments, its
+        `children` are descriptions of layers it uses and its `layers`
+        is a list of descriptions of layers it applies.
+    arrays : dict
+        A {name: :class:`numpy.ndarray`} dictionary of arrays.
+
+    """
+    kwargs = {name: arrays[array_name] for name, array_name
+              in spec.get('parameters', {}).items()}
+    kwargs.update(spec.get('config', {}))
+    kwargs.update((name, build(child, arrays))
+                  for name, child in spec.get('children', {}).items())
+    if 'layers' in spec:
+        kwargs['layers'] = [build(layer, arrays) for layer in spec['layers']]
+    return LAYERS[spec['type']](**kwargs)
+
+
+def load_checkpoint_parameters(path):
+    """Load parameter values saved by :func:`blocks.serialization.dump`.
+
+    Like :func:`blocks.serialization.load_parameters`, but does not
+    need Theano.
+
+    Returns
+    -------
+    A {hierarchical name: :class:`numpy.ndarray`} dictionary.
+
+    """
+    with tarfile.open(path, mode='r') as tar_file:
+        with closing(numpy.load(tar_file.extractfile(
+                tar_file.getmember('_parameters')))) as npz_file:
+            return {name.replace('|', '/'): value
+                    for name, value in npz_file.items()}
+
+
+def load(path, checkpoint=None):
+    """Load a model exported by :func:`blocks.export.export`.
+
+    Parameters
+    ----------
+    path : str
+        The path to the exported model.
+    checkpoint : str, optional
+        The path to a file saved by :func:`blocks.serialization.dump`,
+        e.g. by the :class:`.Checkpoint` extension. If given, the values
+        of the parameters saved there replace the exported ones.
+
+    Returns
+    -------
+    A :class:`Layer` to apply the model with.
+
+    """
+    with closing(numpy.load(path)) as npz_file:
+        arrays = dict(npz_file.items())
+    spec = json.loads(str(arrays.pop(SPEC_NAME)))
+    if checkpoint is not None:
+        arrays.update((name, value) for name, value
+                      in load_checkpoint_parameters(checkpoint).items()
+                      if name in arrays)
+    return build(spec, arrays)
@@ -4,30 +4,154 @@ from six.moves import range
 
 import numpy
 from picklable_itertools.extras import equizip
+import theano
 from theano import config, function, tensor
+from theano.sandbox.rng_mrg import MRG_RandomStreams
 
-from blocks.bricks.sequence_generators import BaseSequenceGenerator
+from blocks.bricks.base import Brick
+from blocks.bricks.sequence_generators import (
+    AdaptiveSoftmaxEmitter, BaseSequenceGenerator)
+from blocks.config import config as blocks_config
 from blocks.filter import VariableFilter, get_application_call, get_brick
 from blocks.graph import ComputationGraph
 from blocks.roles import INPUT, OUTPUT
 from blocks.utils import unpack
 
 
-class BeamSearch(object):
-    """Approximate search for the most likely sequence.
+class BeamScorer(object):
+    """Scores the hypotheses of beam search.
 
-    Beam search is an approximate algorithm for finding :math:`y^* =
-    argmax_y P(y|c)`, where :math:`y` is an output sequence, :math:`c` are
-    the contexts, :math:`P` is the output distribution of a
-    :class:`.SequenceGenerator`. At each step it considers :math:`k`
-    candidate sequence prefixes. :math:`k` is called the beam size, and the
-    sequence are called the beam. The sequences are replaced with their
-    :math:`k` most probable continuations, and this is repeated until
-    end-of-line symbol is met.
+    The hypotheses with the smallest scores are kept in the beam. This
+    scorer ranks the hypotheses by their costs, the negative
+    log-likelihoods of the generated sequences.
 
-    The beam search compiles quite a few Theano functions under the hood.
-    Normally those are compiled at the first :meth:`search` call, but
-    you can also explicitly call :meth:`compile`.
+    Attributes
+    ----------
+    coverage_name : str or None
+        The name of the state of the sequence generator with the attention
+        weights, the coverages passed to the scorer are computed from it.
+        If ``None``, coverages are not computed.
+
+    """
+    coverage_name = None
+
+    def score(self, costs, lengths, coverages=None):
+        """Score hypotheses.
+
+        Parameters
+        ----------
+        costs : :class:`numpy.ndarray`
+            A (hypotheses, candidates) matrix of costs of continuations
+            of every hypothesis.
+        lengths : :class:`numpy.ndarray`
+            The lengths of the continuations of every hypothesis.
+        coverages : :class:`numpy.ndarray`, optional
+            A (hypotheses, attended length) matrix of attention weights
+            summed over the outputs of every hypothesis.
+
+        Returns
+        -------
+        A :class:`numpy.ndarray` of the same shape as `costs`.
+
+        """
+        return costs
+
+    def lower_bound(self, costs, lengths, max_length, coverages=None):
+        """Bound the scores of all the continuations of hypotheses.
+
+        Used for early stopping of the search, the bound must not be
+        larger than the score of any continuation of a hypothesis.
+
+        Parameters
+        ----------
+        costs : :class:`numpy.ndarray`
+            The costs of the hypotheses.
+        lengths : :class:`numpy.ndarray`
+            The lengths of the hypotheses.
+        max_length : int
+            The maximum length of a continuation.
+        coverages : :class:`numpy.ndarray`, optional
+            The coverages of the hypotheses.
+
+        Returns
+        -------
+        A :class:`numpy.ndarray` of the same shape as `costs`.
+
+        """
+        return costs
+
+
+class LengthNormalizedScorer(BeamScorer):
+    r"""Scores hypotheses with length and coverage penalties.
+
+    The score of a hypothesis :math:`y` is :math:`c(y) / lp(y) + cp(y)`,
+    where :math:`c(y)` is the cost and
+
+    .. math::
+
+        lp(y) = \left(\frac{5 + |y|}{6}\right)^\alpha, \quad
+        cp(y) = -\beta \sum_i \log \min(\sum_j a_{ij}, 1),
+
+    where :math:`a_{ij}` is the weight of the :math:`i`-th attended
+    element when generating the :math:`j`-th output, see [GNMT]_. The
+    coverage penalty is only taken over the attended elements with
+    non-zero weights, to skip masked elements.
+
+    Parameters
+    ----------
+    alpha : float, optional
+        The strength of the length penalty, 0.6 by default.
+    beta : float, optional
+        The strength of the coverage penalty, 0 by default.
+    coverage_name : str, optional
+        The name of the state with the attention weights, 'weights' by
+        default, which is the name used by
+        :class:`.SequenceContentAttention`. Only used if `beta` is
+        non-zero.
+
+    Notes
+    -----
+    The attention weights of an output are only known after the next
+    states are computed, so the coverages used to score the
+    continuations of a hypothesis do not include the weights of the
+    last output.
+
+    .. [GNMT] Yonghui Wu et al., *Google's Neural Machine Translation
+       System: Bridging the Gap between Human and Machine Translation*,
+       arXiv:1609.08144.
+
+    """
+    def __init__(self, alpha=0.6, beta=0., coverage_name='weights'):
+        self.alpha = alpha
+        self.beta = beta
+        self.coverage_name = coverage_name if beta else None
+
+    def _length_penalty(self, lengths):
+        return ((5. + lengths) / 6.) ** self.alpha
+
+    def _coverage_penalty(self, coverages):
+        logs = numpy.log(numpy.minimum(coverages, 1.), where=coverages > 0,
+                         out=numpy.zeros_like(coverages))
+        return -self.beta * logs.sum(axis=1)
+
+    def score(self, costs, lengths, coverages=None):
+        scores = costs / self._length_penalty(lengths)[:, None]
+        if coverages is not None:
+            scores += self._coverage_penalty(coverages)[:, None]
+        return scores
+
+    def lower_bound(self, costs, lengths, max_length, coverages=None):
+        # The costs never decrease, and the coverage penalty is
+        # non-negative.
+        return costs / self._length_penalty(max_length)
+
+
+class BaseSearch(object):
+    """The base class for searches of the most likely sequence.
+
+    Extracts the initial states, the contexts and the step computation
+    of a sequence generator from its sampling computation graph. The
+    subclasses compile the Theano functions they need from these.
 
     Parameters
     ----------
@@ -35,22 +159,22 @@ class BeamSearch(object):
         An output of a sampling computation graph built by
         :meth:`~blocks.brick.SequenceGenerator.generate`, the one
         corresponding to sampled sequences.
-
-    See Also
-    --------
-    :class:`.SequenceGenerator`
+    cache_size : int, optional
+        The number of inputs for which the initial states and contexts
+        are cached, the least recently used ones are evicted first. This
+        saves the encoding of inputs for repeated requests. No caching by
+        default.
 
     Notes
     -----
-    Sequence generator should use an emitter which has `probs` method
-    e.g. :class:`SoftmaxEmitter`.
-
-    Does not support dummy contexts so far (all the contexts must be used
-    in the `generate` method of the sequence generator for the current code
-    to work).
+    The contexts are kept in shared variables, which are only set when
+    the contexts change, so the compiled step functions only take the
+    states and the outputs as inputs.
 
     """
-    def __init__(self, samples):
+    def __init__(self, samples, cache_size=0):
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
         # Extracting information from the sampling computation graph
         self.cg = ComputationGraph(samples)
         self.inputs = self.cg.inputs
@@ -85,6 +209,15 @@ class BeamSearch(object):
                 self.input_state_names.append(name)
                 self.input_states.append(var[0])
 
+        self.context_variables = [
+            theano.shared(
+                numpy.zeros([int(broadcastable)
+                             for broadcastable in context.broadcastable],
+                            dtype=context.dtype),
+                name=context.name, broadcastable=context.broadcastable)
+            for context in self.contexts]
+        self._context_values = dict.fromkeys(self.context_names)
+
         self.compiled = False
 
     def _compile_initial_state_and_context_computer(self):
@@ -101,7 +234,7 @@ class BeamSearch(object):
         self.initial_state_and_context_computer = function(
             self.inputs, outputs, on_unused_input='ignore')
 
-    def _compile_next_state_computer(self):
+    def _get_next_states_and_outputs(self):
         next_states = [VariableFilter(bricks=[self.generator],
                                       name=name,
                                       roles=[OUTPUT])(self.inner_cg)[-1]
@@ -109,28 +242,34 @@ class BeamSearch(object):
         next_outputs = VariableFilter(
             applications=[self.generator.readout.emit], roles=[OUTPUT])(
                 self.inner_cg.variables)
-        self.next_state_computer = function(
-            self.contexts + self.input_states + next_outputs, next_states,
-            on_unused_input='ignore')
+        return next_states, next_outputs
 
-    def _compile_logprobs_computer(self):
+    def _get_probs(self):
         # This filtering should return identical variables
         # (in terms of computations) variables, and we do not care
         # which to use.
-        probs = VariableFilter(
+        return VariableFilter(
             applications=[self.generator.readout.emitter.probs],
             roles=[OUTPUT])(self.inner_cg)[0]
-        logprobs = -tensor.log(probs)
-        self.logprobs_computer = function(
-            self.contexts + self.input_states, logprobs,
-            on_unused_input='ignore')
+
+    def _function(self, inputs, outputs, **kwargs):
+        """Compile a function reading the contexts from shared variables."""
+        return function(
+            inputs, outputs,
+            givens=list(equizip(self.contexts, self.context_variables)),
+            on_unused_input='ignore', **kwargs)
+
+    def _set_contexts(self, contexts):
+        """Set the values of the contexts that changed."""
+        for name, variable in equizip(self.context_names,
+                                      self.context_variables):
+            if contexts[name] is not self._context_values[name]:
+                variable.set_value(contexts[name], borrow=True)
+                self._context_values[name] = contexts[name]
 
     def compile(self):
         """Compile all Theano functions used."""
-        self._compile_initial_state_and_context_computer()
-        self._compile_next_state_computer()
-        self._compile_logprobs_computer()
-        self.compiled = True
+        raise NotImplementedError
 
     def compute_initial_states_and_contexts(self, inputs):
         """Computes initial states and contexts from inputs.
@@ -148,14 +287,234 @@ class BeamSearch(object):
         `self.state_names`.
 
         """
-        outputs = self.initial_state_and_context_computer(
-            *[inputs[var] for var in self.inputs])
+        if self.cache_size:
+            values = [numpy.asarray(inputs[var]) for var in self.inputs]
+            key = tuple((value.dtype.str, value.shape, value.tobytes())
+                        for value in values)
+            if key in self._cache:
+                outputs = self._cache.pop(key)
+            else:
+                outputs = self.initial_state_and_context_computer(*values)
+                if len(self._cache) >= self.cache_size:
+                    self._cache.popitem(last=False)
+            self._cache[key] = outputs
+            outputs = OrderedDict(outputs)
+        else:
+            outputs = self.initial_state_and_context_computer(
+                *[inputs[var] for var in self.inputs])
         contexts = OrderedDict((n, outputs.pop(n)) for n in self.context_names)
         beam_size = outputs.pop('beam_size')
         initial_states = outputs
         return contexts, initial_states, beam_size
 
-    def compute_logprobs(self, contexts, states):
+    def _find_batch_axes(self, contexts, batch_size, context_batch_axes):
+        """Find the batch axis of every context.
+
+        A context passed in `context_batch_axes` uses the axis given
+        there. Otherwise the only axis of size `batch_size` is used, and
+        if there are several such axes, the axis 1 is preferred following
+        the time-major layout of attended sequences. Contexts without
+        such an axis are shared by all inputs.
+
+        """
+        axes = OrderedDict()
+        for name, value in contexts.items():
+            if name in context_batch_axes:
+                axes[name] = context_batch_axes[name]
+                continue
+            candidates = [axis for axis, size in enumerate(value.shape)
+                          if size == batch_size]
+            if len(candidates) > 1 and 1 in candidates:
+                candidates = [1]
+            if len(candidates) > 1:
+                raise ValueError(
+                    "can not find the batch axis of the context {}, "
+                    "pass it in `context_batch_axes`".format(name))
+            axes[name] = candidates[0] if candidates else None
+        return axes
+
+    @staticmethod
+    def result_to_lists(result):
+        outputs, masks, costs = [array.T for array in result]
+        outputs = [list(output[:int(mask.sum())])
+                   for output, mask in equizip(outputs, masks)]
+        costs = list(costs.T.sum(axis=0))
+        return outputs, costs
+
+
+class BeamSearch(BaseSearch):
+    """Approximate search for the most likely sequence.
+
+    Beam search is an approximate algorithm for finding :math:`y^* =
+    argmax_y P(y|c)`, where :math:`y` is an output sequence, :math:`c` are
+    the contexts, :math:`P` is the output distribution of a
+    :class:`.SequenceGenerator`. At each step it considers :math:`k`
+    candidate sequence prefixes. :math:`k` is called the beam size, and the
+    sequence are called the beam. The sequences are replaced with their
+    :math:`k` most probable continuations, and this is repeated until
+    end-of-line symbol is met.
+
+    The beam search compiles quite a few Theano functions under the hood.
+    Normally those are compiled at the first :meth:`search` call, but
+    you can also explicitly call :meth:`compile`.
+
+    Parameters
+    ----------
+    samples : :class:`~theano.Variable`
+        An output of a sampling computation graph built by
+        :meth:`~blocks.brick.SequenceGenerator.generate`, the one
+        corresponding to sampled sequences.
+    fused_step : bool, optional
+        If ``True``, a single Theano function is compiled that reorders
+        the states, computes the next states and the log probabilities
+        of the next outputs. This halves the number of Theano calls per
+        search step at the cost of a longer compilation. ``False`` by
+        default.
+    shortlisting : bool, optional
+        If ``True``, functions are compiled that compute the readouts
+        only for a shortlist of the outputs, see the `shortlist` argument
+        of :meth:`search`. Requires `output_projection`. ``False`` by
+        default.
+    output_projection : :class:`.Brick` or shared variable or list
+        The parameters projecting to the readouts, whose last axis is
+        sliced to compute the readouts of a shortlist only. A brick
+        stands for its parameters and the ones of its children. For
+        example a :class:`.Linear` brick, a ``(W, b)`` pair or, for the
+        default :class:`.Readout`, ``[readout.merge,
+        readout.post_merge]``. Required for shortlisting.
+    cache_size : int, optional
+        See :class:`BaseSearch`.
+
+    See Also
+    --------
+    :class:`.SequenceGenerator`
+
+    Notes
+    -----
+    Sequence generator should use an emitter which has `probs` method
+    e.g. :class:`SoftmaxEmitter`.
+
+    Does not support dummy contexts so far (all the contexts must be used
+    in the `generate` method of the sequence generator for the current code
+    to work).
+
+    Shortlisting requires the readouts to be computed by a linear output
+    projection, which has to be given as `output_projection`. For a
+    :class:`.SampledEmitter`, which does the projection itself, give the
+    emitter. The :class:`.AdaptiveSoftmaxEmitter` gives exact
+    probabilities but does not support shortlisting.
+
+    """
+    def __init__(self, samples, fused_step=False, shortlisting=False,
+                 output_projection=None, cache_size=0):
+        super(BeamSearch, self).__init__(samples, cache_size)
+        if shortlisting and output_projection is None:
+            raise ValueError("shortlisting requires the output projection")
+        self.fused_step = fused_step
+        self.shortlisting = shortlisting
+        self.output_projection = output_projection
+
+    def _compile_next_state_computer(self):
+        next_states, next_outputs = self._get_next_states_and_outputs()
+        self.next_state_computer = self._function(
+            self.input_states + next_outputs, next_states)
+
+    def _get_output_projection(self):
+        """Collect the parameters of the given output projection."""
+        readout = self.generator.readout
+        if isinstance(readout.emitter, AdaptiveSoftmaxEmitter):
+            raise ValueError("shortlisting is not supported for the "
+                             "adaptive softmax")
+        projection = self.output_projection
+        if not isinstance(projection, (list, tuple)):
+            projection = [projection]
+        bricks = [element for element in projection
+                  if isinstance(element, Brick)]
+        parameters = [element for element in projection
+                      if element is not None and
+                      not isinstance(element, Brick)]
+        while bricks:
+            brick = bricks.pop()
+            bricks.extend(brick.children)
+            parameters.extend(brick.parameters)
+        readout_dim = readout.get_dim('readouts')
+        for parameter in parameters:
+            if (not parameter.ndim or
+                    parameter.get_value().shape[-1] != readout_dim):
+                raise ValueError("the last axis of the output projection "
+                                 "parameter {} is not of the size of the "
+                                 "readouts".format(parameter))
+        if not any(parameter.ndim == 2 for parameter in parameters):
+            raise ValueError("the output projection has no matrix")
+        return parameters
+
+    def _get_logprobs(self, shortlist=None):
+        probs = self._get_probs()
+        if shortlist is not None:
+            # Only the columns of the projection for the shortlisted
+            # outputs are multiplied by.
+            probs = theano.clone(probs, replace=OrderedDict(
+                (parameter,
+                 parameter[(slice(None),) * (parameter.ndim - 1) +
+                           (shortlist,)])
+                for parameter in self._get_output_projection()))
+        return -tensor.log(probs)
+
+    def _compile_logprobs_computer(self):
+        self.logprobs_computer = self._function(
+            self.input_states, self._get_logprobs())
+
+    def _compile_shortlist_logprobs_computer(self):
+        shortlist = tensor.lvector('shortlist')
+        self.shortlist_logprobs_computer = self._function(
+            self.input_states + [shortlist], self._get_logprobs(shortlist))
+
+    def _compile_step_computer(self, shortlisted=False):
+        next_states, next_outputs = self._get_next_states_and_outputs()
+        # Cloning copies intermediate variables, so all the inputs
+        # of the step are replaced with new variables.
+        states = [state.type(state.name) for state in self.input_states]
+        outputs = [output.type(output.name) for output in next_outputs]
+        indexes = tensor.lvector('indexes')
+        replace = OrderedDict(equizip(self.contexts, self.context_variables))
+        replace.update(equizip(next_outputs, outputs))
+        replace.update((input_state, state[indexes]) for input_state, state
+                       in equizip(self.input_states, states))
+        next_states = theano.clone(next_states, replace=replace)
+        next_states_by_name = dict(equizip(self.state_names, next_states))
+        replace = OrderedDict(equizip(self.contexts, self.context_variables))
+        replace.update((input_state, next_states_by_name[name])
+                       for input_state, name in equizip(
+                           self.input_states, self.input_state_names))
+        if shortlisted:
+            shortlist = [tensor.lvector('shortlist')]
+            logprobs = self._get_logprobs(shortlist[0])
+        else:
+            shortlist = []
+            logprobs = self._get_logprobs()
+        next_logprobs = theano.clone(logprobs, replace=replace)
+        step_computer = function(
+            states + [indexes] + outputs + shortlist,
+            next_states + [next_logprobs], on_unused_input='ignore')
+        if shortlisted:
+            self.shortlist_step_computer = step_computer
+        else:
+            self.step_computer = step_computer
+
+    def compile(self):
+        """Compile all Theano functions used."""
+        self._compile_initial_state_and_context_computer()
+        self._compile_next_state_computer()
+        self._compile_logprobs_computer()
+        if self.fused_step:
+            self._compile_step_computer()
+        if self.shortlisting:
+            self._compile_shortlist_logprobs_computer()
+            if self.fused_step:
+                self._compile_step_computer(shortlisted=True)
+        self.compiled = True
+
+    def compute_logprobs(self, contexts, states, shortlist=None):
         """Compute log probabilities of all possible outputs.
 
         Parameters
@@ -164,16 +523,25 @@ class BeamSearch(object):
             A {name: :class:`numpy.ndarray`} dictionary of contexts.
         states : dict
             A {name: :class:`numpy.ndarray`} dictionary of states.
+        shortlist : :class:`numpy.ndarray`, optional
+            A vector of the outputs for which the log probabilities are
+            computed, the probabilities are normalized over these outputs
+            only. Requires the beam search to be created with
+            ``shortlisting=True``.
 
         Returns
         -------
         A :class:`numpy.ndarray` of the (beam size, number of possible
-        outputs) shape.
+        outputs) shape, or of the (beam size, shortlist length) shape if
+        `shortlist` is given.
 
         """
+        self._set_contexts(contexts)
         input_states = [states[name] for name in self.input_state_names]
-        return self.logprobs_computer(*(list(contexts.values()) +
-                                      input_states))
+        if shortlist is not None:
+            return self.shortlist_logprobs_computer(
+                *(input_states + [shortlist]))
+        return self.logprobs_computer(*input_states)
 
     def compute_next_states(self, contexts, states, outputs):
         """Computes next states.
@@ -192,11 +560,48 @@ class BeamSearch(object):
         A {name: numpy.array} dictionary of next states.
 
         """
+        self._set_contexts(contexts)
         input_states = [states[name] for name in self.input_state_names]
-        next_values = self.next_state_computer(*(list(contexts.values()) +
-                                                 input_states + [outputs]))
+        next_values = self.next_state_computer(*(input_states + [outputs]))
         return OrderedDict(equizip(self.state_names, next_values))
 
+    def compute_next_states_and_logprobs(self, contexts, states, indexes,
+                                         outputs, shortlist=None):
+        """Computes next states and log probabilities in a single call.
+
+        Requires the beam search to be created with ``fused_step=True``.
+
+        Parameters
+        ----------
+        contexts : dict
+            A {name: :class:`numpy.ndarray`} dictionary of contexts.
+        states : dict
+            A {name: :class:`numpy.ndarray`} dictionary of states.
+        indexes : :class:`numpy.ndarray`
+            The rows of `states` from which the search continues.
+        outputs : :class:`numpy.ndarray`
+            A :class:`numpy.ndarray` of this step outputs.
+        shortlist : :class:`numpy.ndarray`, optional
+            See :meth:`compute_logprobs`.
+
+        Returns
+        -------
+        A tuple of a {name: numpy.array} dictionary of next states and
+        a :class:`numpy.ndarray` of log probabilities of all possible
+        next outputs.
+
+        """
+        self._set_contexts(contexts)
+        input_states = [states[name] for name in self.input_state_names]
+        arguments = input_states + [indexes, outputs]
+        if shortlist is not None:
+            next_values = self.shortlist_step_computer(
+                *(arguments + [shortlist]))
+        else:
+            next_values = self.step_computer(*arguments)
+        logprobs = next_values.pop()
+        return OrderedDict(equizip(self.state_names, next_values)), logprobs
+
     @staticmethod
     def _smallest(matrix, k, only_first_row=False):
         """Find k smallest elements of a matrix.
@@ -223,8 +628,194 @@ class BeamSearch(object):
         args = args[numpy.argsort(flatten[args])]
         return numpy.unravel_index(args, matrix.shape), flatten[args]
 
+    @staticmethod
+    def _smallest_in_groups(matrix, k):
+        """Find k smallest elements in each group of k consecutive rows.
+
+        Parameters
+        ----------
+        matrix : :class:`numpy.ndarray`
+            The matrix, its number of rows must be a multiple of `k`.
+        k : int
+            The number of rows in a group and the number of smallest
+            elements required from every group.
+
+        Returns
+        -------
+        Tuple of ((row numbers, column numbers), values), where the
+        elements chosen from every group are contiguous and sorted.
+
+        """
+        num_columns = matrix.shape[1]
+        groups = matrix.reshape((-1, k * num_columns))
+        group_numbers = numpy.arange(groups.shape[0])[:, None]
+        args = numpy.argpartition(groups, k, axis=1)[:, :k]
+        args = args[group_numbers,
+                    numpy.argsort(groups[group_numbers, args], axis=1)]
+        values = groups[group_numbers, args].flatten()
+        rows = (group_numbers * k + args // num_columns).flatten()
+        return (rows, (args % num_columns).flatten()), values
+
+    def _check_shortlisting(self, shortlist):
+        if shortlist is not None and not self.shortlisting:
+            raise ValueError("shortlists require the beam search to be "
+                             "created with `shortlisting=True`")
+
+    def _search(self, contexts, states, beam_size, eol_symbol, max_length,
+                ignore_first_eol, batch_axes=None, scorer=None,
+                early_stopping=False, shortlists=None):
+        """Perform beam search for several inputs at once.
+
+        The rows of `contexts` and `states` are split into groups of
+        `beam_size` consecutive rows, one group per input. A group is
+        dropped from the computations as soon as all its sequences are
+        finished, or, if `early_stopping` is ``True``, as soon as its best
+        finished sequence can not be outscored.
+
+        If `shortlists` are given, the log probabilities are computed
+        for the union of the shortlists of all inputs and the end of
+        sequence symbol, and the outputs out of the shortlist of an input
+        are forbidden for it.
+
+        Every step is recorded in preallocated buffers together with
+        the backpointers to the previous step, and the sequences are
+        reconstructed once at the end.
+
+        Returns
+        -------
+        A list with a (matrix of outputs, mask, costs of all generated
+        outputs) tuple for every input.
+
+        """
+        num_rows = len(states['outputs'])
+        num_inputs = num_rows // beam_size
+        if batch_axes is None:
+            batch_axes = dict.fromkeys(contexts, None)
+        if scorer is None:
+            scorer = BeamScorer()
+        shortlist = banned = None
+        eol_column = eol_symbol
+        if shortlists is not None:
+            shortlist = numpy.unique(numpy.concatenate(
+                [[eol_symbol]] + list(shortlists))).astype('int64')
+            eol_column = numpy.searchsorted(shortlist, eol_symbol)
+            banned = numpy.ones((num_inputs, len(shortlist)), dtype=bool)
+            for group, words in enumerate(shortlists):
+                banned[group, numpy.searchsorted(shortlist, words)] = False
+            banned[:, eol_column] = False
+            banned = (numpy.repeat(banned, beam_size, axis=0)
+                      if banned.any() else None)
+        # The sequences of an input always occupy the same `beam_size`
+        # rows of the buffers, `active_rows` are the rows still searched.
+        active_rows = numpy.arange(num_rows)
+        num_steps = numpy.zeros(num_inputs, dtype='int64')
+        all_outputs = numpy.empty((max_length, num_rows),
+                                  dtype=states['outputs'].dtype)
+        all_masks = numpy.empty((max_length, num_rows), dtype=config.floatX)
+        all_costs = numpy.empty((max_length, num_rows), dtype=config.floatX)
+        all_parents = numpy.empty((max_length, num_rows), dtype='int64')
+
+        costs = numpy.zeros(num_rows, dtype=config.floatX)
+        mask = numpy.ones(num_rows, dtype=config.floatX)
+        lengths = numpy.zeros(num_rows, dtype=config.floatX)
+        coverages = None
+        if scorer.coverage_name:
+            coverages = numpy.zeros_like(states[scorer.coverage_name])
+        logprobs = self.compute_logprobs(contexts, states, shortlist)
+        for i in range(max_length):
+            # We carefully hack values of the `logprobs` array to ensure
+            # that all finished sequences are continued with `eos_symbol`.
+            next_costs = costs[:, None] + logprobs * mask[:, None]
+            (finished,) = numpy.where(mask == 0)
+            next_costs[finished, :eol_column] = numpy.inf
+            next_costs[finished, eol_column + 1:] = numpy.inf
+            if banned is not None:
+                next_costs[banned] = numpy.inf
+            # At the first step the beam size is effectively only 1.
+            if i == 0:
+                next_costs[numpy.arange(len(next_costs)) % beam_size != 0] = (
+                    numpy.inf)
+            next_scores = scorer.score(next_costs, lengths + mask, coverages)
+
+            (indexes, outputs), scores = self._smallest_in_groups(
+                next_scores, beam_size)
+            costs = next_costs[indexes, outputs]
+            if shortlist is not None:
+                outputs = shortlist[outputs]
+            # Whether the chosen outputs belong to the sequences
+            valid = mask[indexes]
+            lengths = lengths[indexes] + valid
+            mask = (outputs != eol_symbol).astype(config.floatX)
+            if ignore_first_eol and i == 0:
+                mask[:] = 1
+            all_parents[i, active_rows] = active_rows[indexes]
+            all_outputs[i, active_rows] = outputs
+            all_masks[i, active_rows] = mask
+            all_costs[i, active_rows] = costs
+
+            # Drop the inputs for which the search is over
+            done = mask.reshape((-1, beam_size)).sum(axis=1) == 0
+            if early_stopping:
+                bounds = scorer.lower_bound(
+                    costs, lengths, max_length,
+                    coverages[indexes] if coverages is not None else None)
+                best_finished = numpy.where(mask == 0, scores, numpy.inf)
+                best_active = numpy.where(mask == 0, numpy.inf, bounds)
+                done |= (best_finished.reshape((-1, beam_size)).min(axis=1) <=
+                         best_active.reshape((-1, beam_size)).min(axis=1))
+            if i == max_length - 1:
+                done[:] = True
+            num_steps[active_rows[::beam_size][done] // beam_size] = i + 1
+            if done.all():
+                break
+            if done.any():
+                rows = numpy.where(numpy.repeat(~done, beam_size))[0]
+                for name, axis in batch_axes.items():
+                    if axis is not None:
+                        contexts[name] = contexts[name].take(rows, axis=axis)
+                active_rows = active_rows[rows]
+                indexes = indexes[rows]
+                outputs = outputs[rows]
+                costs = costs[rows]
+                mask = mask[rows]
+                valid = valid[rows]
+                lengths = lengths[rows]
+                if banned is not None:
+                    banned = banned[rows]
+
+            # Compute new states
+            if self.fused_step:
+                next_states, logprobs = self.compute_next_states_and_logprobs(
+                    contexts, states, indexes, outputs, shortlist)
+                states.update(next_states)
+            else:
+                for name in states:
+                    states[name] = states[name][indexes]
+                states.update(
+                    self.compute_next_states(contexts, states, outputs))
+                logprobs = self.compute_logprobs(contexts, states, shortlist)
+            if coverages is not None:
+                coverages = (coverages[indexes] +
+                             states[scorer.coverage_name] * valid[:, None])
+
+        results = []
+        for group, length in enumerate(num_steps):
+            rows = numpy.arange(group * beam_size, (group + 1) * beam_size)
+            outputs, masks, costs = [
+                numpy.zeros((length + 1, beam_size), dtype=array.dtype)
+                for array in (all_outputs, all_masks, all_costs)]
+            masks[0] = 1
+            for j in range(length - 1, -1, -1):
+                outputs[j] = all_outputs[j, rows]
+                masks[j + 1] = all_masks[j, rows]
+                costs[j + 1] = all_costs[j, rows]
+                rows = all_parents[j, rows]
+            results.append((outputs[:-1], masks[:-1], costs[1:] - costs[:-1]))
+        return results
+
     def search(self, input_values, eol_symbol, max_length,
-               ignore_first_eol=False, as_arrays=False):
+               ignore_first_eol=False, as_arrays=False, scorer=None,
+               early_stopping=False, shortlist=None):
         """Performs beam search.
 
         If the beam search was not compiled, it also compiles it.
@@ -238,6 +829,8 @@ class BeamSearch(object):
             `beam_size`. Put it differently, the user is responsible
             for duplicaling inputs necessary number of times, because
             this class has insufficient information to do it properly.
+            See :meth:`search_batch` for searching for several inputs
+            at once without duplicating them.
         eol_symbol : int
             End of sequence symbol, the search stops when the symbol is
             generated.
@@ -252,12 +845,29 @@ class BeamSearch(object):
             If ``True``, the internal representation of search results
             is returned, that is a (matrix of outputs, mask,
             costs of all generated outputs) tuple.
+        scorer : :class:`BeamScorer`, optional
+            Ranks the hypotheses, the default one ranks them by their
+            costs. Use :class:`LengthNormalizedScorer` to avoid the bias
+            towards short sequences.
+        early_stopping : bool, optional
+            If ``True``, the search stops as soon as no unfinished sequence
+            can get a better score than the best finished one. The other
+            sequences of the beam are not necessarily finished then.
+            ``False`` by default.
+        shortlist : list of ints, optional
+            The outputs the search is restricted to, for instance the
+            translations of the input words from an alignment dictionary.
+            The readouts are only computed for these outputs and the end
+            of sequence symbol, which makes the search faster for large
+            vocabularies. Requires the beam search to be created with
+            ``shortlisting=True``.
 
         Returns
         -------
         outputs : list of lists of ints
             A list of the `beam_size` best sequences found in the order
-            of decreasing likelihood.
+            of increasing score, which is decreasing likelihood for the
+            default scorer.
         costs : list of floats
             A list of the costs for the `outputs`, where cost is the
             negative log-likelihood.
@@ -265,62 +875,263 @@ class BeamSearch(object):
         """
         if not self.compiled:
             self.compile()
+        self._check_shortlisting(shortlist)
 
         contexts, states, beam_size = self.compute_initial_states_and_contexts(
             input_values)
+        result, = self._search(
+            contexts, states, beam_size, eol_symbol, max_length,
+            ignore_first_eol, scorer=scorer, early_stopping=early_stopping,
+            shortlists=[shortlist] if shortlist is not None else None)
+        if as_arrays:
+            return result
+        return self.result_to_lists(result)
+
+    def search_batch(self, input_values, eol_symbol, max_length, beam_size,
+                     ignore_first_eol=False, as_arrays=False,
+                     context_batch_axes=None, scorer=None,
+                     early_stopping=False, shortlists=None):
+        """Performs beam search for a batch of inputs.
+
+        The hypotheses for all inputs are kept in a single (batch size
+        times `beam_size`) batch, so that every step of the search costs
+        only a few Theano calls for the whole batch. The inputs for which
+        all hypotheses are finished are removed from the batch.
+
+        Parameters
+        ----------
+        input_values : dict
+            A {:class:`~theano.Variable`: :class:`~numpy.ndarray`}
+            dictionary of input values, shaped like for sampling
+            with one sequence per input. Unlike :meth:`search`, the inputs
+            should not be duplicated.
+        eol_symbol : int
+            End of sequence symbol, the search stops when the symbol is
+            generated.
+        max_length : int
+            Maximum sequence length, the search stops when it is reached.
+        beam_size : int
+            The beam size.
+        ignore_first_eol : bool, optional
+            See :meth:`search`.
+        as_arrays : bool, optional
+            See :meth:`search`.
+        context_batch_axes : dict, optional
+            A {name: axis} dictionary of the batch axes of the contexts.
+            By default the batch axis of a context is the axis of the size
+            equal to the batch size.
+        scorer : :class:`BeamScorer`, optional
+            See :meth:`search`.
+        early_stopping : bool, optional
+            See :meth:`search`, the search for every input stops
+            separately.
+        shortlists : list of lists of ints, optional
+            The shortlist of every input, see :meth:`search`. The readouts
+            are computed for the union of the shortlists.
+
+        Returns
+        -------
+        list
+            A list with the result of :meth:`search` for every input.
+
+        """
+        if not self.compiled:
+            self.compile()
+        self._check_shortlisting(shortlists)
+        if context_batch_axes is None:
+            context_batch_axes = {}
+
+        contexts, states, batch_size = (
+            self.compute_initial_states_and_contexts(input_values))
+        batch_axes = self._find_batch_axes(contexts, batch_size,
+                                           context_batch_axes)
+        for name, axis in batch_axes.items():
+            if axis is not None:
+                contexts[name] = numpy.repeat(contexts[name], beam_size,
+                                              axis=axis)
+        for name in states:
+            states[name] = numpy.repeat(states[name], beam_size, axis=0)
+        results = self._search(contexts, states, beam_size, eol_symbol,
+                               max_length, ignore_first_eol, batch_axes,
+                               scorer, early_stopping, shortlists)
+        if as_arrays:
+            return results
+        return [self.result_to_lists(result) for result in results]
+
+
+class GreedySearch(BaseSearch):
+    """Greedy search for the most likely sequence.
+
+    At every step the most probable output is chosen for every sequence.
+    The choice of the outputs and the computation of the next states are
+    done by a single compiled Theano function, so a step of the search
+    costs one Theano call for the whole batch. The sequences which are
+    finished are removed from the batch.
+
+    Parameters
+    ----------
+    samples : :class:`~theano.Variable`
+        An output of a sampling computation graph built by
+        :meth:`~blocks.brick.SequenceGenerator.generate`, the one
+        corresponding to sampled sequences.
+    cache_size : int, optional
+        See :class:`BaseSearch`.
+
+    See Also
+    --------
+    :class:`BeamSearch`, :class:`SamplingSearch`
+
+    """
+    def _choose_outputs(self, probs):
+        return probs.argmax(axis=-1)
+
+    def _compile_step_computer(self):
+        next_states, next_outputs = self._get_next_states_and_outputs()
+        probs = self._get_probs()
+        outputs = self._choose_outputs(probs)
+        costs = -tensor.log(probs[tensor.arange(outputs.shape[0]), outputs])
+        next_states = theano.clone(next_states, replace=OrderedDict(
+            (next_output, outputs) for next_output in next_outputs))
+        self.step_computer = self._function(
+            self.input_states, [outputs, costs] + next_states)
+
+    def compile(self):
+        """Compile all Theano functions used."""
+        self._compile_initial_state_and_context_computer()
+        self._compile_step_computer()
+        self.compiled = True
+
+    def compute_step(self, contexts, states):
+        """Choose the next outputs and compute the next states.
+
+        Parameters
+        ----------
+        contexts : dict
+            A {name: :class:`numpy.ndarray`} dictionary of contexts.
+        states : dict
+            A {name: :class:`numpy.ndarray`} dictionary of states.
+
+        Returns
+        -------
+        A tuple of the chosen outputs, their costs and a
+        {name: :class:`numpy.ndarray`} dictionary of next states.
+
+        """
+        self._set_contexts(contexts)
+        input_states = [states[name] for name in self.input_state_names]
+        next_values = self.step_computer(*input_states)
+        outputs, costs = next_values[:2]
+        return (outputs, costs,
+                OrderedDict(equizip(self.state_names, next_values[2:])))
+
+    def search(self, input_values, eol_symbol, max_length,
+               ignore_first_eol=False, as_arrays=False,
+               context_batch_axes=None):
+        """Performs the search for a batch of inputs.
+
+        If the search was not compiled, it also compiles it.
+
+        Parameters
+        ----------
+        input_values : dict
+            A {:class:`~theano.Variable`: :class:`~numpy.ndarray`}
+            dictionary of input values, shaped like for sampling
+            with one sequence per input.
+        eol_symbol : int
+            End of sequence symbol, a sequence is finished when the symbol
+            is generated.
+        max_length : int
+            Maximum sequence length, the search stops when it is reached.
+        ignore_first_eol : bool, optional
+            See :meth:`BeamSearch.search`.
+        as_arrays : bool, optional
+            If ``True``, a (matrix of outputs, mask, costs of all
+            generated outputs) tuple is returned, with a column for
+            every input.
+        context_batch_axes : dict, optional
+            See :meth:`BeamSearch.search_batch`.
 
-        # This array will store all generated outputs, including those from
-        # previous step and those from already finished sequences.
-        all_outputs = states['outputs'][None, :]
-        all_masks = numpy.ones_like(all_outputs, dtype=config.floatX)
-        all_costs = numpy.zeros_like(all_outputs, dtype=config.floatX)
+        Returns
+        -------
+        outputs : list of lists of ints
+            A sequence for every input.
+        costs : list of floats
+            A list of the costs for the `outputs`, where cost is the
+            negative log-likelihood.
 
+        """
+        if not self.compiled:
+            self.compile()
+        if context_batch_axes is None:
+            context_batch_axes = {}
+
+        contexts, states, batch_size = (
+            self.compute_initial_states_and_contexts(input_values))
+        batch_axes = self._find_batch_axes(contexts, batch_size,
+                                           context_batch_axes)
+        all_outputs = numpy.zeros((max_length, batch_size),
+                                  dtype=states['outputs'].dtype)
+        all_masks = numpy.zeros((max_length, batch_size),
+                                dtype=config.floatX)
+        all_costs = numpy.zeros((max_length, batch_size),
+                                dtype=config.floatX)
+        active_rows = numpy.arange(batch_size)
+        length = 0
         for i in range(max_length):
-            if all_masks[-1].sum() == 0:
-                break
+            length = i + 1
+            outputs, costs, next_states = self.compute_step(contexts, states)
+            all_outputs[i, active_rows] = outputs
+            all_masks[i, active_rows] = 1
+            all_costs[i, active_rows] = costs
+            states.update(next_states)
 
-            # We carefully hack values of the `logprobs` array to ensure
-            # that all finished sequences are continued with `eos_symbol`.
-            logprobs = self.compute_logprobs(contexts, states)
-            next_costs = (all_costs[-1, :, None] +
-                          logprobs * all_masks[-1, :, None])
-            (finished,) = numpy.where(all_masks[-1] == 0)
-            next_costs[finished, :eol_symbol] = numpy.inf
-            next_costs[finished, eol_symbol + 1:] = numpy.inf
-
-            # The `i == 0` is required because at the first step the beam
-            # size is effectively only 1.
-            (indexes, outputs), chosen_costs = self._smallest(
-                next_costs, beam_size, only_first_row=i == 0)
-
-            # Rearrange everything
-            for name in states:
-                states[name] = states[name][indexes]
-            all_outputs = all_outputs[:, indexes]
-            all_masks = all_masks[:, indexes]
-            all_costs = all_costs[:, indexes]
-
-            # Record chosen output and compute new states
-            states.update(self.compute_next_states(contexts, states, outputs))
-            all_outputs = numpy.vstack([all_outputs, outputs[None, :]])
-            all_costs = numpy.vstack([all_costs, chosen_costs[None, :]])
-            mask = outputs != eol_symbol
+            # Drop the finished sequences
+            unfinished = outputs != eol_symbol
             if ignore_first_eol and i == 0:
-                mask[:] = 1
-            all_masks = numpy.vstack([all_masks, mask[None, :]])
+                unfinished[:] = True
+            if not unfinished.any():
+                break
+            if not unfinished.all():
+                rows, = numpy.where(unfinished)
+                for name, axis in batch_axes.items():
+                    if axis is not None:
+                        contexts[name] = contexts[name].take(rows, axis=axis)
+                for name in states:
+                    states[name] = states[name][rows]
+                active_rows = active_rows[rows]
 
-        all_outputs = all_outputs[1:]
-        all_masks = all_masks[:-1]
-        all_costs = all_costs[1:] - all_costs[:-1]
-        result = all_outputs, all_masks, all_costs
+        result = (all_outputs[:length], all_masks[:length],
+                  all_costs[:length])
         if as_arrays:
             return result
         return self.result_to_lists(result)
 
-    @staticmethod
-    def result_to_lists(result):
-        outputs, masks, costs = [array.T for array in result]
-        outputs = [list(output[:int(mask.sum())])
-                   for output, mask in equizip(outputs, masks)]
-        costs = list(costs.T.sum(axis=0))
-        return outputs, costs
+
+class SamplingSearch(GreedySearch):
+    """Ancestral sampling of sequences.
+
+    Works like :class:`GreedySearch`, but the outputs are sampled from
+    the output distribution instead of taking the most probable ones.
+
+    Parameters
+    ----------
+    samples : :class:`~theano.Variable`
+        An output of a sampling computation graph built by
+        :meth:`~blocks.brick.SequenceGenerator.generate`, the one
+        corresponding to sampled sequences.
+    seed : int, optional
+        The seed with which
+        :class:`~theano.sandbox.rng_mrg.MRG_RandomStreams` is initialized,
+        is taken from ``blocks.config`` by default.
+    cache_size : int, optional
+        See :class:`BaseSearch`.
+
+    """
+    def __init__(self, samples, seed=None, cache_size=0):
+        super(SamplingSearch, self).__init__(samples, cache_size)
+        if seed is None:
+            seed = blocks_config.default_seed
+        self.theano_rng = MRG_RandomStreams(seed)
+
+    def _choose_outputs(self, probs):
+        return self.theano_rng.multinomial(pvals=probs).argmax(axis=-1)
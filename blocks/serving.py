@@ -0,0 +1,430 @@
+"""Serving of models with dynamic batching.
+
+Calling a compiled function for every request separately wastes most of
+its throughput. :class:`InferenceServer` collects concurrent requests
+into batches, calls the function once per batch and sends every client
+its share of the results. Clients connect over a Unix or a TCP socket,
+see :class:`InferenceClient`.
+
+"""
+import logging
+import os
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from multiprocessing.connection import Client, Listener
+
+import numpy
+import theano
+from six.moves import queue
+
+from blocks.serialization import load_parameters
+
+logger = logging.getLogger(__name__)
+
+
+class _Request(object):
+    """A request waiting for its result."""
+    def __init__(self, inputs):
+        self.inputs = inputs
+        self.time = time.time()
+        self.done = threading.Event()
+        self.outputs = None
+        self.error = None
+
+
+class InferenceServer(object):
+    """Serves a function, batching concurrent requests.
+
+    A batch is formed from the requests that arrive within `max_wait`
+    seconds after the first one, up to `max_batch_size` requests.
+
+    Parameters
+    ----------
+    function : callable
+        Takes the batched inputs as positional arguments in the order
+        of `input_names` and returns a list of batched outputs, e.g. a
+        compiled Theano function.
+    input_names : list of str
+        The names of the inputs of `function`, including the masks.
+    max_batch_size : int, optional
+        The maximum number of requests in a batch, 32 by default.
+    max_wait : float, optional
+        The time in seconds a request can wait for other requests to
+        batch with, 0.01 by default.
+    sequence_inputs : dict, optional
+        A {name: mask name} dictionary of the inputs of variable length.
+        A request gives these inputs without the batch axis, they are
+        padded with zeros along their first axis and stacked along the
+        second axis, following the time-major layout of Blocks. The mask
+        of the padding is passed as the input with the mask name, which
+        can be ``None`` if the function takes no mask. The other inputs
+        are stacked along a new first axis.
+    output_batch_axes : list of int, optional
+        The batch axis of every output, 0 by default. Every request gets
+        the slices of the outputs along these axes. Outputs of sequences
+        are not trimmed to the lengths of the requests.
+    address : str or tuple, optional
+        The path of a Unix socket or a (host, port) tuple. By default,
+        a free port on the local host is used. The actual address is
+        available in the `address` attribute once the server is started.
+    authkey : bytes, optional
+        The key clients have to authenticate with. By default, a random
+        key is generated, it is available in the `authkey` attribute and
+        has to be given to the clients. The requests are pickled, so
+        anybody who can connect to the server without authentication can
+        run arbitrary code in it, never give an empty key.
+    latency_window : int, optional
+        The number of most recent requests the latency percentiles are
+        computed over, 10000 by default.
+
+    Notes
+    -----
+    The inputs of every request are checked before batching: all inputs
+    have to be given and, if `function` is a Theano function, with the
+    number of dimensions and a dtype it accepts. A request that fails
+    these checks fails alone. Requests with inputs of different shapes
+    are computed in separate batches. If a batch still fails, its
+    requests are computed one by one, so that only the offending ones
+    get the error.
+
+    To serve a :class:`.SequenceGenerator`, wrap the `search` method of
+    a :class:`.GreedySearch` with ``as_arrays=True`` into a function and
+    set all output batch axes to 1.
+
+    """
+    def __init__(self, function, input_names, max_batch_size=32,
+                 max_wait=0.01, sequence_inputs=None, output_batch_axes=None,
+                 address=None, authkey=None, latency_window=10000):
+        if sequence_inputs is None:
+            sequence_inputs = {}
+        if address is None:
+            address = ('localhost', 0)
+        if authkey is None:
+            authkey = os.urandom(32)
+        if not authkey:
+            raise ValueError("an empty authkey disables authentication")
+        self.function = function
+        self.input_names = input_names
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.sequence_inputs = sequence_inputs
+        self.output_batch_axes = output_batch_axes
+        self.address = address
+        self.authkey = authkey
+        # The types of the inputs of a Theano function
+        maker = getattr(function, 'maker', None)
+        self.input_types = ([input_.variable.type for input_ in maker.inputs]
+                            if maker is not None else None)
+
+        self.masks = {mask: name for name, mask in sequence_inputs.items()
+                      if mask is not None}
+        self.batch_sizes = Counter()
+        self.latencies = deque(maxlen=latency_window)
+        # Guards the statistics, updated by the batching thread and read
+        # by the threads of the clients
+        self._statistics_lock = threading.Lock()
+        self._requests = queue.Queue()
+        # Makes sure no request is queued after the server is stopped
+        self._requests_lock = threading.Lock()
+        self._listener = None
+        self._stopped = threading.Event()
+        self._threads = []
+
+    @classmethod
+    def from_model(cls, model, path=None, **kwargs):
+        r"""Serve the outputs of a model.
+
+        Parameters
+        ----------
+        model : :class:`.Model`
+            The model, its inputs are the inputs of the server.
+        path : str, optional
+            The path to a file saved by :func:`.dump`, if given, the
+            parameter values saved there are loaded into the model.
+        \*\*kwargs : dict
+            Passed to the constructor.
+
+        """
+        if path is not None:
+            with open(path, 'rb') as source:
+                model.set_parameter_values(load_parameters(source))
+        function = theano.function(model.inputs, model.outputs)
+        return cls(function, [input_.name for input_ in model.inputs],
+                   **kwargs)
+
+    def start(self):
+        """Start serving in background threads."""
+        self._stopped.clear()
+        self._listener = Listener(self.address, authkey=self.authkey)
+        self.address = self._listener.address
+        self._threads = [threading.Thread(target=target)
+                         for target in (self._accept, self._serve_batches)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+        logger.info("Serving at {}".format(self.address))
+
+    def stop(self):
+        """Stop serving and wait for the background threads.
+
+        The batch being computed is finished, the requests still waiting
+        in the queue fail with a :class:`RuntimeError`.
+
+        """
+        with self._requests_lock:
+            self._stopped.set()
+        # Wakes up the thread blocked in `accept`
+        Client(self.address, authkey=self.authkey).close()
+        for thread in self._threads:
+            thread.join()
+        self._listener.close()
+        while True:
+            try:
+                request = self._requests.get_nowait()
+            except queue.Empty:
+                break
+            request.error = RuntimeError("the server was stopped")
+            request.done.set()
+
+    def infer(self, inputs):
+        """Compute the outputs for a request.
+
+        Can be called concurrently from several threads, the requests
+        are batched like the ones of the clients.
+
+        Parameters
+        ----------
+        inputs : dict
+            A {name: :class:`numpy.ndarray`} dictionary of inputs without
+            the batch axis.
+
+        Returns
+        -------
+        A list of outputs without the batch axis.
+
+        """
+        request = _Request(inputs)
+        with self._requests_lock:
+            if self._stopped.is_set():
+                raise RuntimeError("the server was stopped")
+            self._requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.outputs
+
+    def statistics(self):
+        """Return the statistics of the served requests.
+
+        Returns
+        -------
+        A dictionary with a {batch size: number of batches} dictionary
+        as `batch_sizes` and the 50th and 99th percentiles of latency in
+        seconds as `latency_p50` and `latency_p99`.
+
+        """
+        with self._statistics_lock:
+            latencies = list(self.latencies)
+            batch_sizes = dict(self.batch_sizes)
+        if latencies:
+            p50, p99 = numpy.percentile(latencies, [50, 99])
+        else:
+            p50 = p99 = None
+        return {'batch_sizes': batch_sizes,
+                'latency_p50': p50, 'latency_p99': p99}
+
+    def _accept(self):
+        while True:
+            try:
+                connection = self._listener.accept()
+            except Exception:
+                if self._stopped.is_set():
+                    return
+                logger.exception("Failed to accept a connection")
+                continue
+            if self._stopped.is_set():
+                connection.close()
+                return
+            thread = threading.Thread(target=self._handle,
+                                      args=(connection,))
+            thread.daemon = True
+            thread.start()
+
+    def _handle(self, connection):
+        try:
+            while True:
+                try:
+                    command, inputs = connection.recv()
+                except (EOFError, IOError):
+                    return
+                if command == 'statistics':
+                    connection.send(('ok', self.statistics()))
+                    continue
+                try:
+                    connection.send(('ok', self.infer(inputs)))
+                except Exception as e:
+                    connection.send(('error', e))
+        finally:
+            connection.close()
+
+    def _serve_batches(self):
+        while not self._stopped.is_set():
+            try:
+                requests = [self._requests.get(timeout=0.1)]
+            except queue.Empty:
+                continue
+            deadline = requests[0].time + self.max_wait
+            while len(requests) < self.max_batch_size:
+                timeout = deadline - time.time()
+                try:
+                    if timeout > 0:
+                        requests.append(self._requests.get(timeout=timeout))
+                    else:
+                        requests.append(self._requests.get_nowait())
+                except queue.Empty:
+                    break
+            self._run_batch(requests)
+
+    def _batch_inputs(self, requests):
+        batch = []
+        for name in self.input_names:
+            if name in self.masks:
+                lengths = [len(request.inputs[self.masks[name]])
+                           for request in requests]
+                mask = numpy.zeros((max(lengths), len(requests)),
+                                   dtype=theano.config.floatX)
+                for i, length in enumerate(lengths):
+                    mask[:length, i] = 1
+                batch.append(mask)
+                continue
+            values = [numpy.asarray(request.inputs[name])
+                      for request in requests]
+            if name not in self.sequence_inputs:
+                batch.append(numpy.stack(values))
+                continue
+            value = numpy.zeros(
+                (max(len(value) for value in values), len(values)) +
+                values[0].shape[1:], dtype=values[0].dtype)
+            for i, sequence in enumerate(values):
+                value[:len(sequence), i] = sequence
+            batch.append(value)
+        return batch
+
+    def _check_inputs(self, request):
+        """Check the inputs of a request and convert them to arrays."""
+        inputs = {}
+        for i, name in enumerate(self.input_names):
+            if name in self.masks:
+                continue
+            if name not in request.inputs:
+                raise KeyError("missing input {}".format(name))
+            value = numpy.asarray(request.inputs[name])
+            if name in self.sequence_inputs and not value.ndim:
+                raise ValueError("input {} is not a sequence".format(name))
+            if self.input_types is not None:
+                type_ = self.input_types[i]
+                if value.ndim != type_.ndim - 1:
+                    raise ValueError(
+                        "input {} has {} dimensions instead of {}".format(
+                            name, value.ndim, type_.ndim - 1))
+                if not numpy.can_cast(value.dtype, type_.dtype,
+                                      'same_kind'):
+                    raise TypeError("input {} of dtype {} can not be cast "
+                                    "to {}".format(name, value.dtype,
+                                                   type_.dtype))
+                value = value.astype(type_.dtype)
+            inputs[name] = value
+        return inputs
+
+    def _shape(self, name, value):
+        """The shape that has to be the same in a batch."""
+        if name in self.sequence_inputs:
+            return value.shape[1:]
+        return value.shape
+
+    def _compute(self, requests):
+        outputs = self.function(*self._batch_inputs(requests))
+        axes = self.output_batch_axes
+        if axes is None:
+            axes = [0] * len(outputs)
+        for i, request in enumerate(requests):
+            request.outputs = [output.take(i, axis=axis)
+                               for output, axis in zip(outputs, axes)]
+
+    def _run_batch(self, requests):
+        # Requests with different shapes can not be stacked, they are
+        # computed in separate batches
+        batches = OrderedDict()
+        for request in requests:
+            try:
+                request.inputs = self._check_inputs(request)
+            except Exception as e:
+                request.error = e
+                continue
+            shapes = tuple(self._shape(name, request.inputs[name])
+                           for name in sorted(request.inputs))
+            batches.setdefault(shapes, []).append(request)
+        for batch in batches.values():
+            try:
+                self._compute(batch)
+            except Exception as e:
+                if len(batch) == 1:
+                    logger.exception("Failed to process a request")
+                    batch[0].error = e
+                    continue
+                logger.exception("Failed to process a batch, computing its "
+                                 "requests one by one")
+                for request in batch:
+                    try:
+                        self._compute([request])
+                    except Exception as e:
+                        request.error = e
+        now = time.time()
+        with self._statistics_lock:
+            self.batch_sizes[len(requests)] += 1
+            self.latencies.extend(now - request.time for request in requests)
+        for request in requests:
+            request.done.set()
+
+
+class InferenceClient(object):
+    """A client of :class:`InferenceServer`.
+
+    Parameters
+    ----------
+    address : str or tuple
+        The address of the server.
+    authkey : bytes
+        The key to authenticate with, the `authkey` attribute of the
+        server.
+
+    """
+    def __init__(self, address, authkey):
+        self.connection = Client(address, authkey=authkey)
+
+    def _call(self, command, inputs=None):
+        self.connection.send((command, inputs))
+        status, result = self.connection.recv()
+        if status == 'error':
+            raise result
+        return result
+
+    def infer(self, inputs):
+        """Compute the outputs for a request.
+
+        See :meth:`InferenceServer.infer`.
+
+        """
+        return self._call('infer', inputs)
+
+    def statistics(self):
+        """Return the statistics of the server.
+
+        See :meth:`InferenceServer.statistics`.
+
+        """
+        return self._call('statistics')
+
+    def close(self):
+        self.connection.close()
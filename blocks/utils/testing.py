@@ -2,6 +2,8 @@ import logging
 import os
 import sys
 import time
+import timeit
+from collections import OrderedDict
 from six import wraps
 from importlib import import_module
 from unittest.case import SkipTest
@@ -14,6 +16,8 @@ from blocks.config import config
 from blocks.main_loop import MainLoop
 from fuel.datasets import IterableDataset
 
+logger = logging.getLogger(__name__)
+
 
 def silence_printing(test):
     @wraps(test)
@@ -98,6 +102,68 @@ def skip_if_configuration_set(configuration, value, message=None):
             raise SkipTest
 
 
+def benchmark(functions, repeat=3, number=1):
+    """Time functions and log the best time of each.
+
+    Parameters
+    ----------
+    functions : :class:`~collections.OrderedDict`
+        A {name: callable} dictionary of the functions to time, they are
+        called without arguments.
+    repeat : int, optional
+        The number of timings of every function, the best one is kept.
+        3 by default.
+    number : int, optional
+        The number of calls in a timing, 1 by default.
+
+    Returns
+    -------
+    A {name: time} :class:`~collections.OrderedDict` of the best times of
+    a call in seconds.
+
+    """
+    times = OrderedDict()
+    for name, function in functions.items():
+        times[name] = min(timeit.repeat(function, repeat=repeat,
+                                        number=number)) / number
+        logger.info("%s: %.6f s", name, times[name])
+    return times
+
+
+def peak_memory(functions):
+    """Measure the peak memory allocated by functions and log it.
+
+    Uses :mod:`tracemalloc`, which also traces the arrays allocated by
+    NumPy, and so by the compiled Theano functions on the CPU.
+
+    Parameters
+    ----------
+    functions : :class:`~collections.OrderedDict`
+        A {name: callable} dictionary of the functions to measure, they
+        are called without arguments.
+
+    Returns
+    -------
+    A {name: size} :class:`~collections.OrderedDict` of the peak sizes of
+    the memory allocated during a call in bytes.
+
+    """
+    try:
+        import tracemalloc
+    except ImportError:
+        raise SkipTest
+    sizes = OrderedDict()
+    for name, function in functions.items():
+        tracemalloc.start()
+        try:
+            function()
+            sizes[name] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        logger.info("%s: %.1f MiB", name, sizes[name] / 2. ** 20)
+    return sizes
+
+
 class MockAlgorithm(TrainingAlgorithm):
     """An algorithm that only saves data.
 
@@ -1,16 +1,19 @@
+from collections import OrderedDict
+
 import numpy
-from numpy.testing import assert_allclose
+from numpy.testing import assert_allclose, assert_raises
 
 import theano
 from theano import tensor
 
 from blocks.bricks import Identity
 from blocks.bricks.attention import (
-    SequenceContentAttention, AttentionRecurrent)
+    SequenceContentAttention, LocalContentAttention, AttentionRecurrent)
 from blocks.bricks.recurrent import SimpleRecurrent
 from blocks.initialization import IsotropicGaussian, Constant
 from blocks.graph import ComputationGraph
 from blocks.select import Selector
+from blocks.utils.testing import benchmark
 
 
 def test_sequence_content_attention():
@@ -180,3 +183,154 @@ def test_stable_attention_weights():
         numpy.ones((attended_length, batch_size)))
     weights = attention.compute_weights(energies, mask).eval()
     assert numpy.all(numpy.isfinite(weights))
+
+
+def test_local_content_attention():
+    rng = numpy.random.RandomState(1)
+    floatX = theano.config.floatX
+    seq_len = 7
+    batch_size = 3
+
+    def make_attention(class_, **kwargs):
+        attention = class_(
+            state_names=["states"], state_dims=[2], attended_dim=3,
+            match_dim=4, weights_init=IsotropicGaussian(0.5),
+            biases_init=Constant(0), name="attention", **kwargs)
+        attention.initialize()
+        return attention
+
+    sequences = tensor.tensor3('sequences')
+    states = tensor.matrix('states')
+    mask = tensor.matrix('mask')
+    positions = tensor.vector('positions')
+    seq_values = rng.uniform(size=(seq_len, batch_size, 3)).astype(floatX)
+    states_values = rng.uniform(size=(batch_size, 2)).astype(floatX)
+    mask_values = numpy.ones((seq_len, batch_size), dtype=floatX)
+    mask_values[5:, 1] = 0
+    mask_values[6:, 2] = 0
+    positions_values = numpy.array([-1, 1, 4], dtype=floatX)
+
+    # With a window over the whole sequence, the weights are the same
+    attention = make_attention(SequenceContentAttention)
+    local_attention = make_attention(LocalContentAttention,
+                                     window_size=seq_len)
+    parameters = Selector(attention).get_parameters()
+    for path, parameter in Selector(local_attention).get_parameters().items():
+        parameter.set_value(parameters[path].get_value())
+    inputs = [sequences, states, mask, positions]
+    values = [seq_values, states_values, mask_values, positions_values]
+    expected = theano.function(inputs, attention.take_glimpses(
+        sequences, attended_mask=mask, states=states),
+        on_unused_input='ignore')(*values)
+
+    def take_glimpses(local_attention, inputs, values, **kwargs):
+        glimpses, weights, next_positions = local_attention.take_glimpses(
+            sequences, attended_mask=mask, states=states, **kwargs)
+        dense_weights = local_attention.dense_weights(
+            weights, next_positions, sequences.shape[0])
+        return theano.function(
+            inputs, [glimpses, weights, next_positions, dense_weights])(
+                *values)
+
+    glimpses, _, next_positions, weights = take_glimpses(
+        local_attention, inputs, values, positions=positions)
+    assert_allclose(glimpses, expected[0], rtol=1e-5)
+    assert_allclose(weights, expected[1], rtol=1e-5)
+    assert_allclose(next_positions, positions_values + 1)
+
+    # Only the elements in the window get weights
+    local_attention = make_attention(LocalContentAttention, window_size=1)
+    glimpses, window_weights, _, weights = take_glimpses(
+        local_attention, inputs, values, positions=positions)
+    assert glimpses.shape == (batch_size, 3)
+    assert window_weights.shape == (batch_size, 3)
+    assert weights.shape == (batch_size, seq_len)
+    window = numpy.zeros((batch_size, seq_len))
+    window[0, :2] = window[1, 1:4] = window[2, 4:6] = 1
+    assert numpy.all((weights > 0) == window)
+    assert_allclose(weights.sum(axis=1), 1, rtol=1e-5)
+    assert_allclose(numpy.sort(window_weights, axis=1),
+                    numpy.sort(weights, axis=1)[:, -3:], rtol=1e-5)
+    assert_raises(ValueError, local_attention.take_glimpses, sequences,
+                  attended_mask=mask, states=states)
+
+    # The predicted positions are in the sequence
+    local_attention = make_attention(LocalContentAttention, window_size=2,
+                                     predictive=True)
+    glimpses, window_weights, next_positions, weights = take_glimpses(
+        local_attention, inputs[:3], values[:3])
+    assert window_weights.shape == (batch_size, 5)
+    assert weights.shape == (batch_size, seq_len)
+    assert numpy.all(next_positions >= 0)
+    assert numpy.all(next_positions <= mask_values.sum(axis=0) - 1)
+    assert numpy.all(weights <= 1)
+    assert numpy.all((weights > 0).sum(axis=1) <= 5)
+
+
+def test_local_attention_recurrent():
+    rng = numpy.random.RandomState(1234)
+    floatX = theano.config.floatX
+    wrapped = SimpleRecurrent(5, Identity())
+    attention = LocalContentAttention(
+        state_names=wrapped.apply.states, attended_dim=4, match_dim=4,
+        window_size=2)
+    recurrent = AttentionRecurrent(wrapped, attention, seed=1234,
+                                   weights_init=IsotropicGaussian(0.5),
+                                   biases_init=Constant(0))
+    recurrent.initialize()
+
+    attended = tensor.tensor3("attended")
+    attended_mask = tensor.matrix("attended_mask")
+    inputs = tensor.tensor3("inputs")
+    states, glimpses, weights, positions = recurrent.apply(
+        inputs=inputs, attended=attended, attended_mask=attended_mask)
+    states_vals, weights_vals, positions_vals = theano.function(
+        [inputs, attended, attended_mask], [states, weights, positions])(
+            rng.uniform(size=(6, 2, 5)).astype(floatX),
+            rng.uniform(size=(10, 2, 4)).astype(floatX),
+            numpy.ones((10, 2), dtype=floatX))
+    assert states_vals.shape == (6, 2, 5)
+    assert weights_vals.shape == (6, 2, 5)
+    assert_allclose(positions_vals, numpy.arange(6)[:, None] *
+                    numpy.ones((1, 2)))
+    # The window of the first step starts before the sequence
+    assert numpy.all(weights_vals[0, :, :2] == 0)
+    assert numpy.all(weights_vals[1, :, :1] == 0)
+    assert_allclose(weights_vals.sum(axis=2), 1, rtol=1e-5)
+
+
+def test_local_content_attention_benchmark():
+    rng = numpy.random.RandomState(1)
+    floatX = theano.config.floatX
+    batch_size = 10
+    dim = 100
+    sequences = tensor.tensor3('sequences')
+    states = tensor.matrix('states')
+    positions = tensor.vector('positions')
+
+    def make_function(attention, **kwargs):
+        attention.initialize()
+        glimpses = attention.take_glimpses(sequences, states=states,
+                                           **kwargs)[0]
+        return theano.function([sequences, states, positions], glimpses,
+                               on_unused_input='ignore')
+
+    kwargs = dict(state_names=["states"], state_dims=[dim],
+                  attended_dim=dim, match_dim=dim,
+                  weights_init=IsotropicGaussian(0.1),
+                  biases_init=Constant(0))
+    attention_functions = OrderedDict([
+        ('global attention', make_function(
+            SequenceContentAttention(**kwargs))),
+        ('local attention', make_function(
+            LocalContentAttention(window_size=10, **kwargs),
+            positions=positions))])
+    functions = OrderedDict()
+    for seq_len in [100, 1000, 10000]:
+        values = [rng.uniform(size=(seq_len, batch_size, dim)).astype(floatX),
+                  rng.uniform(size=(batch_size, dim)).astype(floatX),
+                  numpy.zeros((batch_size,), dtype=floatX)]
+        for name, function in attention_functions.items():
+            functions['{} over {} elements'.format(name, seq_len)] = (
+                lambda function=function, values=values: function(*values))
+    benchmark(functions)
@@ -9,9 +9,11 @@ from blocks.bricks import (Identity, Linear, Maxout, LinearMaxout, MLP, Tanh,
                            Sequence, Random, Logistic, Softplus, Softmax,
                            LeakyRectifier)
 from blocks.bricks.base import application, Brick, lazy, NoneAllocation
-from blocks.bricks.parallel import Parallel, Fork
-from blocks.filter import get_application_call, get_brick
-from blocks.initialization import Constant
+from blocks.bricks.parallel import Parallel, Fork, Distribute
+from blocks.filter import get_application_call, get_brick, VariableFilter
+from blocks.graph import ComputationGraph
+from blocks.initialization import Constant, IsotropicGaussian
+from blocks.roles import OUTPUT
 from blocks.utils import shared_floatx
 
 
@@ -480,6 +482,47 @@ def test_sequence_variable_outputs():
             3 * numpy.ones((8, 5))) + 4 * numpy.ones((4, 5)))
 
 
+def test_fused_fork():
+    x = tensor.tensor3('x')
+    x_val = numpy.random.RandomState(1).normal(
+        size=(2, 3, 4)).astype(theano.config.floatX)
+    fork = Fork(input_dim=4, output_names=['y', 'z'], output_dims=[5, 6],
+                weights_init=IsotropicGaussian(0.1),
+                biases_init=IsotropicGaussian(0.1), seed=1)
+    fork.initialize()
+    fused_fork = Fork(input_dim=4, output_names=['y', 'z'],
+                      output_dims=[5, 6], fused=True)
+    fused_fork.allocate()
+    for child, fused_child in zip(fork.children, fused_fork.children):
+        for parameter, fused_parameter in zip(child.parameters,
+                                              fused_child.parameters):
+            fused_parameter.set_value(parameter.get_value())
+    for output, fused_output in zip(fork.apply(x), fused_fork.apply(x)):
+        assert_allclose(output.eval({x: x_val}),
+                        fused_output.eval({x: x_val}), rtol=1e-5)
+
+    cg = ComputationGraph(fused_fork.apply(x))
+    for child in fused_fork.children:
+        child_output, = VariableFilter(
+            bricks=[child], roles=[OUTPUT])(cg.variables)
+        assert get_application_call(child_output).application == child.apply
+        assert child_output.tag.name == 'output'
+
+    distribute = Distribute(target_names=['a', 'b'], source_name='c',
+                            target_dims=[2, 3], source_dim=3, fused=True,
+                            weights_init=Constant(2))
+    distribute.initialize()
+    assert [len(child.parameters) for child in distribute.children] == [1, 1]
+    a, b, c = tensor.matrices('a', 'b', 'c')
+    new_a, new_b = distribute.apply(a=a, b=b, c=c)
+    assert_allclose(new_a.eval({a: [[2, 2]], c: [[1, 1, 1]]}), [[8, 8]])
+    assert_allclose(new_b.eval({b: [[1, 1, 1]], c: [[1, 1, 1]]}),
+                    [[7, 7, 7]])
+
+    assert_raises(ValueError, Fork, ['y', 'z'], 4, prototype=Tanh(),
+                  fused=True)
+
+
 def test_sequence_variable_inputs():
     x, y = tensor.matrix(), tensor.matrix()
 
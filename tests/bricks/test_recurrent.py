@@ -3,22 +3,26 @@ import unittest
 from collections import OrderedDict
 import numpy
 import theano
+from picklable_itertools.extras import equizip
 from numpy.testing import assert_allclose, assert_raises
 from theano import tensor
 from theano.gof.graph import is_same_graph
 
-from blocks.utils import is_shared_variable
+from blocks.utils import is_shared_variable, pack
 from blocks.bricks.base import application
-from blocks.bricks import Tanh
+from blocks.bricks import Initializable, Linear, Tanh
 from blocks.bricks.recurrent import (
     recurrent, BaseRecurrent, GatedRecurrent,
     SimpleRecurrent, Bidirectional, LSTM,
-    RecurrentStack, RECURRENTSTACK_SEPARATOR)
+    RecurrentStack, RECURRENTSTACK_SEPARATOR, FusedLSTM,
+    ResetAfterGatedRecurrent, convert_lstm_layout,
+    convert_recurrent_parameters)
 from blocks.initialization import (
     Constant, IsotropicGaussian, Orthogonal, Identity)
 from blocks.filter import get_application_call, VariableFilter
 from blocks.graph import ComputationGraph
 from blocks.roles import INITIAL_STATE
+from blocks.utils.testing import benchmark, peak_memory
 
 
 class RecurrentWrapperTestClass(BaseRecurrent):
@@ -113,6 +117,319 @@ def test_return_initial_states_with_outputs():
     assert_allclose(states.eval()[0], numpy.zeros((5, 4)))
 
 
+class RecurrentBrickWithInputProjection(BaseRecurrent, Initializable):
+    def __init__(self, dim, **kwargs):
+        super(RecurrentBrickWithInputProjection, self).__init__(**kwargs)
+        self.dim = dim
+        self.projection = Linear(input_dim=dim, output_dim=dim)
+        self.children = [self.projection]
+
+    @recurrent(sequences=['inputs', 'mask'], states=['states'],
+               outputs=['states'], contexts=[])
+    def apply(self, inputs, states, mask=None, projections=None):
+        if projections:
+            projected = projections['inputs']
+        else:
+            projected = self.projection.apply(inputs)
+        next_states = tensor.tanh(projected + states)
+        if mask:
+            next_states = (mask[:, None] * next_states +
+                           (1 - mask[:, None]) * states)
+        return next_states
+
+    def project_inputs(self, application_name, sequences):
+        return OrderedDict(
+            [('inputs', self.projection.apply(sequences['inputs']))])
+
+    def get_dim(self, name):
+        if name in ['inputs', 'states']:
+            return self.dim
+        return super(RecurrentBrickWithInputProjection, self).get_dim(name)
+
+
+def count_step_dots(outputs):
+    scan, = set(variable.owner.op for variable
+                in ComputationGraph(outputs).variables
+                if isinstance(getattr(variable.owner, 'op', None),
+                              theano.scan_module.scan_op.Scan))
+    return scan, sum(isinstance(node.op, tensor.basic.Dot)
+                     for node in theano.gof.graph.io_toposort(
+                         scan.inputs, scan.outputs))
+
+
+def test_hoist_inputs():
+    brick = RecurrentBrickWithInputProjection(
+        3, weights_init=IsotropicGaussian(0.5), biases_init=Constant(0.1))
+    brick.initialize()
+    x = tensor.tensor3('x')
+    mask = tensor.matrix('mask')
+    rng = numpy.random.RandomState(1)
+    x_val = rng.rand(6, 2, 3).astype(theano.config.floatX)
+    mask_val = numpy.ones((6, 2), dtype=theano.config.floatX)
+    mask_val[4:, 1] = 0
+    for reverse in [False, True]:
+        states = brick.apply(x, mask=mask, reverse=reverse)
+        hoisted = brick.apply(x, mask=mask, reverse=reverse,
+                              hoist_inputs=True)
+        assert_allclose(hoisted.eval({x: x_val, mask: mask_val}),
+                        states.eval({x: x_val, mask: mask_val}), rtol=1e-5)
+    # The product is computed outside of the scan and given as a sequence
+    scan, n_dots = count_step_dots(hoisted)
+    assert scan.n_seqs == 3
+    assert n_dots == 0
+
+
+def test_hoist_inputs_stack():
+    x = tensor.tensor3('x')
+    mask = tensor.matrix('mask')
+    rng = numpy.random.RandomState(1)
+    x_val = rng.rand(6, 2, 3).astype(theano.config.floatX)
+    mask_val = numpy.ones((6, 2), dtype=theano.config.floatX)
+    mask_val[4:, 1] = 0
+    stack = RecurrentStack(
+        [RecurrentBrickWithInputProjection(3),
+         SimpleRecurrent(dim=3, activation=Tanh())],
+        weights_init=IsotropicGaussian(0.5), biases_init=Constant(0.1))
+    stack.initialize()
+    states = stack.apply(x, mask=mask, low_memory=True)
+    hoisted = stack.apply(x, mask=mask, low_memory=True, hoist_inputs=True)
+    for expected, value in equizip(states, hoisted):
+        assert_allclose(value.eval({x: x_val, mask: mask_val}),
+                        expected.eval({x: x_val, mask: mask_val}),
+                        rtol=1e-5)
+    # Only the fork and the recurrent weights of the top layer are left
+    assert count_step_dots(states)[1] == 3
+    assert count_step_dots(hoisted)[1] == 2
+
+
+def test_hoist_inputs_benchmark():
+    x = tensor.tensor3('x')
+    x_val = numpy.random.RandomState(1).rand(1000, 16, 256).astype(
+        theano.config.floatX)
+    stack = RecurrentStack(
+        [RecurrentBrickWithInputProjection(256),
+         SimpleRecurrent(dim=256, activation=Tanh())],
+        weights_init=IsotropicGaussian(0.01), biases_init=Constant(0))
+    stack.initialize()
+    functions = OrderedDict()
+    for hoist_inputs in [False, True]:
+        function = theano.function(
+            [x], stack.apply(x, low_memory=True, hoist_inputs=hoist_inputs))
+        functions['{} input projections'.format(
+            'hoisted' if hoist_inputs else 'per-step')] = (
+                lambda function=function: function(x_val))
+    benchmark(functions)
+
+
+def test_carry_states():
+    rng = numpy.random.RandomState(1)
+    x = tensor.tensor3('x')
+    reset = tensor.vector('reset')
+    x_val = rng.rand(6, 2, 12).astype(theano.config.floatX)
+    reset_val = numpy.array([0, 1], dtype=theano.config.floatX)
+    transitions = [
+        SimpleRecurrent(dim=3, activation=Tanh()),
+        LSTM(dim=3), GatedRecurrent(dim=3),
+        RecurrentStack([SimpleRecurrent(dim=3, activation=Tanh()),
+                        SimpleRecurrent(dim=3, activation=Tanh())])]
+    for transition in transitions:
+        transition.weights_init = IsotropicGaussian(0.5)
+        transition.biases_init = Constant(0)
+        transition.initialize()
+        inputs = x[:, :, :transition.get_dim('inputs')]
+        if isinstance(transition, GatedRecurrent):
+            kwargs = {'inputs': inputs,
+                      'gate_inputs': x[:, :, 3:9]}
+        else:
+            kwargs = {'inputs': inputs}
+        states = pack(transition.apply(**kwargs))[0]
+        carried = pack(transition.apply(carry_states=True, reset=reset,
+                                        **kwargs))[0]
+        cg = ComputationGraph(carried)
+        assert len(cg.updates) > 0
+        function = theano.function([x, reset], carried, updates=cg.updates,
+                                   on_unused_input='ignore')
+
+        # Chunks give the same states as the whole sequences
+        expected = states.eval({x: x_val})
+        first = function(x_val[:3], numpy.zeros_like(reset_val))
+        second = function(x_val[3:], numpy.zeros_like(reset_val))
+        assert_allclose(numpy.concatenate([first, second]), expected,
+                        rtol=1e-5)
+        # The reset rows start from the initial states
+        third = function(x_val[3:], reset_val)
+        assert_allclose(third[:, 1], states.eval({x: x_val[3:]})[:, 1],
+                        rtol=1e-5)
+        assert not numpy.allclose(third[:, 0], states.eval(
+            {x: x_val[3:]})[:, 0])
+        transition.reset_carried_states()
+        assert_allclose(function(x_val[:3], numpy.zeros_like(reset_val)),
+                        first, rtol=1e-5)
+
+
+def test_checkpoint_every():
+    rng = numpy.random.RandomState(1)
+    x = tensor.tensor3('x')
+    mask = tensor.matrix('mask')
+    x_val = rng.rand(7, 2, 12).astype(theano.config.floatX)
+    mask_val = numpy.ones((7, 2), dtype=theano.config.floatX)
+    mask_val[5:, 1] = 0
+    for transition in [LSTM(dim=3), GatedRecurrent(dim=3)]:
+        transition.weights_init = IsotropicGaussian(0.5)
+        transition.initialize()
+        kwargs = {'inputs': x[:, :, :transition.get_dim('inputs')],
+                  'mask': mask}
+        if isinstance(transition, GatedRecurrent):
+            kwargs['gate_inputs'] = x[:, :, 3:9]
+        for reverse, return_initial_states in [(False, False), (True, True)]:
+            outputs = []
+            # The last segment is shorter, of the same length or the only
+            # one
+            for checkpoint_every in [None, 3, 7, 10]:
+                states = pack(transition.apply(
+                    reverse=reverse,
+                    return_initial_states=return_initial_states,
+                    checkpoint_every=checkpoint_every, **kwargs))[0]
+                gradients = tensor.grad(states.sum(), transition.parameters)
+                outputs.append(theano.function(
+                    [x, mask], [states] + gradients,
+                    on_unused_input='ignore')(x_val, mask_val))
+            for checkpointed in outputs[1:]:
+                for expected, value in equizip(outputs[0], checkpointed):
+                    assert_allclose(value, expected, rtol=1e-5)
+
+
+def test_checkpoint_every_benchmark():
+    x = tensor.tensor3('x')
+    x_val = numpy.random.RandomState(1).rand(1000, 16, 1024).astype(
+        theano.config.floatX)
+    transition = LSTM(dim=256, weights_init=IsotropicGaussian(0.01))
+    transition.initialize()
+    functions = OrderedDict()
+    for checkpoint_every in [None, 32]:
+        states = transition.apply(x, checkpoint_every=checkpoint_every)[0]
+        function = theano.function(
+            [x], tensor.grad(states.sum(), transition.parameters))
+        functions['{} checkpoints'.format(
+            'no' if checkpoint_every is None
+            else 'every {} steps'.format(checkpoint_every))] = (
+                lambda function=function: function(x_val))
+    peak_memory(functions)
+    benchmark(functions)
+
+
+def test_unroll():
+    rng = numpy.random.RandomState(1)
+    x = tensor.tensor3('x')
+    mask = tensor.matrix('mask')
+    x_val = rng.rand(5, 2, 12).astype(theano.config.floatX)
+    mask_val = numpy.ones((5, 2), dtype=theano.config.floatX)
+    mask_val[3:, 1] = 0
+    lstm = LSTM(dim=3, weights_init=IsotropicGaussian(0.5))
+    lstm.initialize()
+    for reverse, return_initial_states in [(False, False), (True, True)]:
+        kwargs = dict(inputs=x, mask=mask, reverse=reverse,
+                      return_initial_states=return_initial_states)
+        expected = theano.function([x, mask], lstm.apply(**kwargs))(
+            x_val, mask_val)
+        for unroll in [2, True]:
+            states, cells = lstm.apply(unroll=unroll, n_steps=5, **kwargs)
+            for value, expected_value in equizip(
+                    theano.function([x, mask], [states, cells])(
+                        x_val, mask_val), expected):
+                assert_allclose(value, expected_value, rtol=1e-5)
+
+    # Full unrolling gives a graph without scans
+    states, cells = lstm.apply(x, unroll=True, n_steps=5)
+    cg = ComputationGraph(states)
+    assert not any(isinstance(getattr(variable.owner, 'op', None),
+                              theano.scan_module.scan_op.Scan)
+                   for variable in cg.variables)
+    assert len(VariableFilter(applications=[lstm.apply],
+                              name='states')(cg)) > 5
+    application_call = get_application_call(states)
+    assert all(inner_input.owner is None
+               for inner_input in application_call.inner_inputs)
+    assert is_same_graph(application_call.inner_outputs[0],
+                         lstm.apply(*application_call.inner_inputs,
+                                    iterate=False)[0])
+    assert_raises(ValueError, lstm.apply, x, unroll=True)
+
+
+def sigmoid(x):
+    return 1 / (1 + numpy.exp(-x))
+
+
+def test_fused_lstm():
+    rng = numpy.random.RandomState(1)
+    x = tensor.tensor3('x')
+    x_val = rng.rand(5, 2, 12).astype(theano.config.floatX)
+    lstm = LSTM(dim=3, weights_init=IsotropicGaussian(0.5))
+    lstm.initialize()
+    fused = FusedLSTM(dim=3)
+    fused.allocate()
+    convert_recurrent_parameters(lstm, fused)
+    assert ([parameter.name for parameter in lstm.parameters] ==
+            [parameter.name for parameter in fused.parameters])
+    expected = theano.function([x], lstm.apply(x))(x_val)
+    results = theano.function([x], fused.apply(x))(
+        convert_lstm_layout(x_val, 3))
+    for result, expected_result in equizip(results, expected):
+        assert_allclose(result, expected_result, rtol=1e-5)
+
+    # Converting back gives the original parameters
+    lstm_copy = LSTM(dim=3)
+    lstm_copy.allocate()
+    convert_recurrent_parameters(fused, lstm_copy)
+    for parameter, copy in equizip(lstm.parameters, lstm_copy.parameters):
+        assert_allclose(copy.get_value(), parameter.get_value())
+    assert_raises(ValueError, convert_recurrent_parameters, lstm, lstm_copy)
+
+    # Coupled gates without peepholes
+    x = tensor.matrix('x')
+    h = tensor.matrix('h')
+    c = tensor.matrix('c')
+    fused = FusedLSTM(dim=3, peepholes=False, coupled_gates=True,
+                      weights_init=IsotropicGaussian(0.5))
+    fused.initialize()
+    assert fused.get_dim('inputs') == 9
+    assert len(fused.parameters) == 3
+    x_val, h_val, c_val = [rng.rand(2, dim).astype(theano.config.floatX)
+                           for dim in [9, 3, 3]]
+    next_h, next_c = theano.function([x, h, c], fused.apply(
+        x, h, c, iterate=False))(x_val, h_val, c_val)
+    activation = h_val.dot(fused.W_state.get_value()) + x_val
+    forget_gate = sigmoid(activation[:, :3])
+    out_gate = sigmoid(activation[:, 3:6])
+    expected_c = (forget_gate * c_val +
+                  (1 - forget_gate) * numpy.tanh(activation[:, 6:]))
+    assert_allclose(next_c, expected_c, rtol=1e-5)
+    assert_allclose(next_h, out_gate * numpy.tanh(expected_c), rtol=1e-5)
+
+
+def test_reset_after_gated_recurrent():
+    rng = numpy.random.RandomState(1)
+    x = tensor.matrix('x')
+    gi = tensor.matrix('gi')
+    h = tensor.matrix('h')
+    gru = ResetAfterGatedRecurrent(dim=3, weights_init=IsotropicGaussian(0.5))
+    gru.initialize()
+    x_val, gi_val, h_val = [rng.rand(2, dim).astype(theano.config.floatX)
+                            for dim in [3, 6, 3]]
+    next_h = theano.function([x, gi, h], gru.apply(
+        x, gi, h, iterate=False))(x_val, gi_val, h_val)
+    activation = h_val.dot(gru.W_state.get_value())
+    gates = sigmoid(activation[:, :6] + gi_val)
+    candidate = numpy.tanh(gates[:, 3:] * activation[:, 6:] + x_val)
+    assert_allclose(next_h, candidate * gates[:, :3] +
+                    h_val * (1 - gates[:, :3]), rtol=1e-5)
+
+    # The parameters of the GatedRecurrent can not be converted
+    original = GatedRecurrent(dim=3)
+    original.allocate()
+    assert_raises(ValueError, convert_recurrent_parameters, gru, original)
+
+
 class TestSimpleRecurrent(unittest.TestCase):
     def setUp(self):
         self.simple = SimpleRecurrent(dim=3, weights_init=Constant(2),
@@ -614,6 +931,55 @@ class TestBidirectional(unittest.TestCase):
         assert_allclose(h_simple, h_bidir[..., :3], rtol=1e-04)
         assert_allclose(h_simple_rev, h_bidir[::-1, ...,  3:], rtol=1e-04)
 
+    def test_fused(self):
+        x = tensor.tensor3('x')
+        mask = tensor.matrix('mask')
+        for prototype, inputs in self.fused_prototypes(x):
+            bidirs = [Bidirectional(weights_init=IsotropicGaussian(0.5),
+                                    prototype=prototype, fused=fused,
+                                    seed=1)
+                      for fused in [False, True]]
+            for bidir in bidirs:
+                bidir.initialize()
+            assert ([parameter.name for parameter in bidirs[0].parameters] ==
+                    [parameter.name for parameter in bidirs[1].parameters])
+            outputs = [theano.function(
+                [x, mask], bidir.apply(mask=mask, as_list=True, **inputs))(
+                    self.x_val, self.mask_val) for bidir in bidirs]
+            for expected, value in equizip(*outputs):
+                assert_allclose(value, expected, rtol=1e-5)
+            assert_raises(ValueError, bidirs[1].apply,
+                          return_initial_states=True, **inputs)
+
+    def fused_prototypes(self, x):
+        return [(SimpleRecurrent(dim=3, activation=Tanh()), {'inputs': x}),
+                (LSTM(dim=3), {'inputs': tensor.tile(x, (1, 1, 4))}),
+                (GatedRecurrent(dim=3),
+                 {'inputs': x, 'gate_inputs': tensor.tile(x, (1, 1, 2))}),
+                (FusedLSTM(dim=3), {'inputs': tensor.tile(x, (1, 1, 4))})]
+
+    def test_fused_benchmark(self):
+        x = tensor.tensor3('x')
+        mask = tensor.matrix('mask')
+        x_val = numpy.random.RandomState(1).normal(
+            size=(100, 32, 3)).astype(theano.config.floatX)
+        mask_val = numpy.ones((100, 32), dtype=theano.config.floatX)
+        functions = OrderedDict()
+        for prototype, inputs in self.fused_prototypes(x)[:3]:
+            for fused in [False, True]:
+                bidir = Bidirectional(weights_init=IsotropicGaussian(0.5),
+                                      prototype=prototype, fused=fused,
+                                      seed=1)
+                bidir.initialize()
+                function = theano.function(
+                    [x, mask], bidir.apply(mask=mask, as_list=True,
+                                           **inputs))
+                functions['{} {}'.format(
+                    'fused' if fused else 'separate',
+                    prototype.__class__.__name__)] = (
+                        lambda function=function: function(x_val, mask_val))
+        benchmark(functions)
+
 
 class TestBidirectionalStack(unittest.TestCase):
     def setUp(self):
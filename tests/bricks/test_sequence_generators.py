@@ -1,5 +1,5 @@
 import numpy
-from numpy.testing import assert_allclose, assert_equal
+from numpy.testing import assert_allclose, assert_equal, assert_raises
 
 import theano
 from theano import tensor
@@ -10,7 +10,8 @@ from blocks.bricks.recurrent import SimpleRecurrent, GatedRecurrent
 from blocks.bricks.attention import SequenceContentAttention
 from blocks.bricks.sequence_generators import (
     SequenceGenerator, Readout, TrivialEmitter,
-    SoftmaxEmitter, LookupFeedback)
+    SoftmaxEmitter, LookupFeedback, SampledSoftmaxEmitter, NCEEmitter,
+    sampled_training, AdaptiveSoftmaxEmitter, SampledEmitter)
 from blocks.filter import VariableFilter
 from blocks.graph import ComputationGraph
 from blocks.initialization import Orthogonal, IsotropicGaussian, Constant
@@ -59,6 +60,11 @@ def test_sequence_generator():
     assert costs_val.shape == (n_steps, batch_size)
     assert_allclose(costs_val.sum(), 115.593, rtol=1e-5)
 
+    # Checkpointing gives the same costs
+    costs = generator.cost_matrix(y, mask, checkpoint_every=3)
+    assert_allclose(theano.function([y, mask], costs)(y_test, m_test),
+                    costs_val, rtol=1e-5)
+
     # Test 'cost' method
     cost = generator.cost(y, mask)
     assert cost.ndim == 0
@@ -280,3 +286,86 @@ def test_softmax_emitter_initial_outputs():
     emitter.readout_dim = 0
     assert_equal(emitter.initial_outputs(2).eval(),
                  3 * numpy.ones((2,), dtype='int64'))
+
+
+def test_sampled_emitters():
+    floatX = theano.config.floatX
+    rng = numpy.random.RandomState(1)
+    readouts_val = rng.normal(size=(4, 3, 5)).astype(floatX)
+    outputs_val = rng.randint(50, size=(4, 3))
+    readouts = tensor.tensor3('readouts')
+    outputs = tensor.lmatrix('outputs')
+    for emitter_class in [SampledSoftmaxEmitter, NCEEmitter]:
+        emitter = emitter_class(num_outputs=50, num_samples=10,
+                                readout_dim=5, theano_seed=1,
+                                weights_init=IsotropicGaussian(0.1),
+                                biases_init=Constant(0))
+        emitter.initialize()
+        W, b = [parameter.get_value() for parameter in emitter.parameters]
+
+        # Outside of the context the cost is exact
+        energies = readouts_val.dot(W) + b
+        energies -= energies.max(axis=-1, keepdims=True)
+        log_probs = energies - numpy.log(
+            numpy.exp(energies).sum(axis=-1, keepdims=True))
+        expected = -log_probs[numpy.arange(4)[:, None], numpy.arange(3),
+                              outputs_val]
+        cost = emitter.cost(readouts, outputs)
+        assert_allclose(cost.eval({readouts: readouts_val,
+                                   outputs: outputs_val}),
+                        expected, rtol=1e-5)
+        assert_allclose(emitter.probs(readouts).eval(
+            {readouts: readouts_val}).sum(axis=-1), 1, rtol=1e-5)
+
+        with sampled_training(emitter):
+            sampled_cost = emitter.cost(readouts, outputs)
+        sampled_cost_val = sampled_cost.eval({readouts: readouts_val,
+                                              outputs: outputs_val})
+        assert sampled_cost_val.shape == (4, 3)
+        assert numpy.all(numpy.isfinite(sampled_cost_val))
+        assert numpy.all(sampled_cost_val >= 0)
+        gradient = tensor.grad(sampled_cost.sum(), emitter.parameters[0])
+        assert numpy.all(numpy.isfinite(gradient.eval(
+            {readouts: readouts_val, outputs: outputs_val})))
+        assert not emitter._training_mode
+
+    assert_raises(TypeError, SampledEmitter, 50, 10)
+
+    samples = emitter.sample_outputs().eval()
+    assert samples.shape == (10,)
+    assert numpy.all((samples >= 0) & (samples < 50))
+    assert_allclose(numpy.exp(emitter.log_expected_count(
+        numpy.arange(50)).eval()).sum(), 10, rtol=1e-5)
+
+
+def test_adaptive_softmax_emitter():
+    floatX = theano.config.floatX
+    rng = numpy.random.RandomState(1)
+    readouts_val = rng.normal(size=(4, 3, 8)).astype(floatX)
+    outputs_val = numpy.array([[0, 1, 4], [5, 9, 10], [12, 19, 2],
+                               [3, 7, 15]])
+    readouts = tensor.tensor3('readouts')
+    outputs = tensor.lmatrix('outputs')
+    emitter = AdaptiveSoftmaxEmitter([4, 10, 20], reduction_factor=2,
+                                     readout_dim=8, theano_seed=1,
+                                     weights_init=IsotropicGaussian(0.1),
+                                     biases_init=Constant(0.1))
+    emitter.initialize()
+    assert [parameter.get_value().shape
+            for parameter in emitter.parameters] == [
+        (8, 6), (6,), (8, 4), (4, 6), (6,), (8, 2), (2, 10), (10,)]
+
+    probs = emitter.probs(readouts).eval({readouts: readouts_val})
+    assert probs.shape == (4, 3, 20)
+    assert_allclose(probs.sum(axis=-1), 1, rtol=1e-5)
+    cost = emitter.cost(readouts, outputs).eval({readouts: readouts_val,
+                                                 outputs: outputs_val})
+    expected = -numpy.log(probs[numpy.arange(4)[:, None], numpy.arange(3),
+                                outputs_val])
+    assert_allclose(cost, expected, rtol=1e-5)
+
+    step_readouts = tensor.matrix('step_readouts')
+    outputs_sample = emitter.emit(step_readouts).eval(
+        {step_readouts: readouts_val[0]})
+    assert outputs_sample.shape == (3,)
+    assert numpy.all((outputs_sample >= 0) & (outputs_sample < 20))
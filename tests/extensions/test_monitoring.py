@@ -1,13 +1,15 @@
 import numpy
 import theano
 from fuel.datasets import IterableDataset
-from numpy.testing import assert_allclose
+from numpy.testing import assert_allclose, assert_raises
 from theano import tensor
 
 from blocks.extensions import TrainingExtension, FinishAfter
 from blocks.extensions.monitoring import (
     MonitoringExtension,
+    DataStreamMonitoring,
     TrainingDataMonitoring)
+from blocks.extensions.training import TrackTheBest
 from blocks.monitoring import aggregation
 from blocks.algorithms import GradientDescent, UpdatesAlgorithm, Scale
 from blocks.utils import shared_floatx
@@ -28,6 +30,12 @@ class MeanFeaturesTimesTarget(aggregation.MonitoredQuantity):
         return self._aggregated / self._num_batches
 
 
+class FailingQuantity(MeanFeaturesTimesTarget):
+
+    def aggregate(self, features, targets):
+        raise ValueError("can not aggregate")
+
+
 def test_monitoring_extension__record_name():
     test_name = "test-test"
 
@@ -124,6 +132,60 @@ def test_training_data_monitoring():
                         (features * targets[:, None]).mean(axis=0))
 
 
+def test_training_data_monitoring_several_epochs():
+    features = [numpy.array(f, dtype=theano.config.floatX)
+                for f in [[1, 2], [3, 5], [5, 8]]]
+    targets = numpy.array([f.sum() for f in features])
+    n_batches = 3
+    n_epochs = 3
+    dataset = IterableDataset(dict(features=features, targets=targets))
+
+    x = tensor.vector('features')
+    y = tensor.scalar('targets')
+    W = shared_floatx([0, 0], name='W')
+    W_sum = W.sum().copy(name='W_sum')
+    cost = ((x * W).sum() - y) ** 2
+    cost.name = 'cost'
+    scaled = (W_sum * x).copy(name='scaled_features')
+    ftt = MeanFeaturesTimesTarget(requires=[scaled, y], name='ftt')
+
+    per_epoch = TrainingDataMonitoring(
+        [aggregation.mean(W_sum), cost, ftt], prefix="epoch",
+        after_epoch=True)
+    main_loop = MainLoop(
+        model=None, data_stream=dataset.get_example_stream(),
+        algorithm=GradientDescent(cost=cost, parameters=[W],
+                                  step_rule=Scale(0.001)),
+        extensions=[
+            FinishAfter(after_n_epochs=n_epochs),
+            TrainingDataMonitoring([W_sum, cost], prefix="batch",
+                                   after_batch=True),
+            per_epoch])
+    main_loop.run()
+
+    # The values are read out and the aggregators initialized by the
+    # fused function only
+    assert per_epoch._variables._readout_fun is None
+    assert per_epoch._required_for_non_variables._readout_fun is None
+
+    # The aggregators are initialized after every epoch, so that the
+    # values only aggregate the batches of the epoch
+    for epoch in range(n_epochs):
+        iterations = range(epoch * n_batches + 1,
+                           (epoch + 1) * n_batches + 1)
+        row = main_loop.log[(epoch + 1) * n_batches]
+        W_sums = numpy.array([main_loop.log[i]['batch_W_sum']
+                              for i in iterations])
+        costs = [main_loop.log[i]['batch_cost'] for i in iterations]
+        assert_allclose(row['epoch_W_sum'], W_sums.mean())
+        assert_allclose(row['epoch_cost'], numpy.mean(costs))
+        assert_allclose(
+            row['epoch_ftt'],
+            (W_sums[:, None] * features * targets[:, None]).mean(axis=0),
+            rtol=1e-5)
+    assert main_loop.log[n_batches]['epoch_W_sum'] != row['epoch_W_sum']
+
+
 def test_training_data_monitoring_updates_algorithm():
     features = [numpy.array(f, dtype=theano.config.floatX)
                 for f in [[1, 2], [3, 5], [5, 8]]]
@@ -145,3 +207,72 @@ def test_training_data_monitoring_updates_algorithm():
     assert len(main_loop.algorithm.updates) == 0
     main_loop.extensions[0].do('before_training')
     assert len(main_loop.algorithm.updates) > 0
+
+
+def test_data_stream_monitoring_asynchronous():
+    features = [numpy.array(f, dtype=theano.config.floatX)
+                for f in [[1, 2], [3, 5], [5, 8]]]
+    targets = numpy.array([f.sum() for f in features],
+                          dtype=theano.config.floatX)
+    dataset = IterableDataset(dict(features=features, targets=targets))
+
+    x = tensor.vector('features')
+    y = tensor.scalar('targets')
+    W = shared_floatx([0, 0], name='W')
+    cost = ((x * W).sum() - y) ** 2
+    cost.name = 'cost'
+
+    def run(asynchronous):
+        W.set_value(numpy.zeros(2, dtype=theano.config.floatX))
+        monitoring = DataStreamMonitoring(
+            [cost], dataset.get_example_stream(), prefix='valid',
+            asynchronous=asynchronous, max_pending=2)
+        track_the_best = TrackTheBest('valid_cost', after_epoch=False)
+        received = []
+        monitoring.add_listener(track_the_best.on_records)
+        monitoring.add_listener(
+            lambda iteration, records: received.append(iteration))
+        main_loop = MainLoop(
+            model=None, data_stream=dataset.get_example_stream(),
+            algorithm=GradientDescent(cost=cost, parameters=[W],
+                                      step_rule=Scale(0.001)),
+            extensions=[FinishAfter(after_n_epochs=3), monitoring,
+                        track_the_best])
+        main_loop.run()
+        return main_loop, received
+
+    sync_loop, sync_received = run(False)
+    async_loop, async_received = run(True)
+    assert sync_received == []
+    assert async_received == [0, 3, 6, 9]
+    for iteration in async_received:
+        assert_allclose(async_loop.log[iteration]['valid_cost'],
+                        sync_loop.log[iteration]['valid_cost'])
+    assert_allclose(async_loop.status['best_valid_cost'],
+                    sync_loop.log[9]['valid_cost'])
+
+
+def test_data_stream_monitoring_asynchronous_error():
+    features = [numpy.array(f, dtype=theano.config.floatX)
+                for f in [[1, 2], [3, 5], [5, 8]]]
+    targets = numpy.array([f.sum() for f in features],
+                          dtype=theano.config.floatX)
+    dataset = IterableDataset(dict(features=features, targets=targets))
+
+    x = tensor.vector('features')
+    y = tensor.scalar('targets')
+    W = shared_floatx([0, 0], name='W')
+    cost = ((x * W).sum() - y) ** 2
+    cost.name = 'cost'
+    failing = FailingQuantity(requires=[x, y], name='failing')
+    monitoring = DataStreamMonitoring(
+        [cost, failing], dataset.get_example_stream(), prefix='valid',
+        asynchronous=True)
+    main_loop = MainLoop(
+        model=None, data_stream=dataset.get_example_stream(),
+        algorithm=GradientDescent(cost=cost, parameters=[W],
+                                  step_rule=Scale(0.001)),
+        extensions=[FinishAfter(after_n_epochs=2), monitoring])
+    # The error of the evaluator process is raised in the training one
+    # instead of blocking it forever
+    assert_raises(ValueError, main_loop.run)
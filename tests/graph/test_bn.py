@@ -4,12 +4,14 @@ import theano
 from theano import tensor
 
 from blocks.bricks import (BatchNormalization, Sequence, Tanh, MLP,
-                           BatchNormalizedMLP)
+                           BatchNormalizedMLP, SpatialBatchNormalization)
+from blocks.bricks.conv import Convolutional
 from blocks.filter import get_brick
 from blocks.graph import (ComputationGraph, batch_normalization,
                           apply_batch_normalization,
-                          get_batch_normalization_updates)
-from blocks.initialization import Constant
+                          get_batch_normalization_updates,
+                          fold_batch_normalization)
+from blocks.initialization import Constant, IsotropicGaussian
 from blocks.roles import (has_roles, BATCH_NORM_POPULATION_MEAN,
                           BATCH_NORM_POPULATION_STDEV)
 from blocks.utils import is_shared_variable
@@ -72,6 +74,71 @@ def test_apply_batch_normalization_nested():
     assert_allclose(y_, y_expected, rtol=1e-3)
 
 
+def randomize_population_statistics(bricks, rng):
+    for brick in bricks:
+        for variable in [brick.population_mean, brick.population_stdev,
+                         brick.scale, brick.shift]:
+            shape = variable.get_value().shape
+            variable.set_value(
+                rng.uniform(0.5, 1.5, size=shape).astype(
+                    theano.config.floatX))
+
+
+def test_fold_batch_normalization_mlp():
+    rng = numpy.random.RandomState((2016, 1, 18))
+    x = tensor.matrix()
+    for use_bias in [False, True]:
+        mlp = BatchNormalizedMLP([Tanh(), Tanh()], [4, 5, 6],
+                                 use_bias=use_bias,
+                                 weights_init=IsotropicGaussian(0.5),
+                                 biases_init=IsotropicGaussian(0.5))
+        mlp.initialize()
+        randomize_population_statistics(
+            [activation.children[0] for activation in mlp.activations], rng)
+        y = mlp.apply(x)
+        with batch_normalization(mlp):
+            y_bn = mlp.apply(x)
+        folded = fold_batch_normalization(ComputationGraph([y, y_bn]))
+        assert not any(isinstance(get_brick(v), BatchNormalization)
+                       for v in ComputationGraph(folded.outputs[0]).variables)
+        # Training mode applications are kept
+        assert any(isinstance(get_brick(v), BatchNormalization)
+                   for v in ComputationGraph(folded.outputs[1]).variables)
+        x_ = rng.uniform(size=(3, 4)).astype(theano.config.floatX)
+        assert_allclose(folded.outputs[0].eval({x: x_}), y.eval({x: x_}),
+                        rtol=1e-5)
+
+
+def test_fold_batch_normalization_convolutional():
+    rng = numpy.random.RandomState((2016, 1, 18))
+    x = tensor.tensor4()
+    for use_bias, tied_biases in [(False, True), (True, True),
+                                  (True, False)]:
+        conv = Convolutional(filter_size=(3, 3), num_filters=4,
+                             num_channels=2, image_size=(6, 6),
+                             use_bias=use_bias, tied_biases=tied_biases,
+                             weights_init=IsotropicGaussian(0.5),
+                             biases_init=IsotropicGaussian(0.5))
+        conv.initialize()
+        bn = SpatialBatchNormalization(input_dim=(4, 4, 4))
+        bn.initialize()
+        randomize_population_statistics([bn], rng)
+        y = bn.apply(conv.apply(x))
+        folded = fold_batch_normalization(ComputationGraph([y]))
+        assert not any(isinstance(get_brick(v), BatchNormalization)
+                       for v in folded.variables)
+        x_ = rng.uniform(size=(3, 2, 6, 6)).astype(theano.config.floatX)
+        assert_allclose(folded.outputs[0].eval({x: x_}), y.eval({x: x_}),
+                        rtol=1e-4)
+
+    # Normalization of every position can not be folded
+    bn = BatchNormalization(input_dim=(4, 4, 4))
+    bn.initialize()
+    y = bn.apply(conv.apply(x))
+    folded = fold_batch_normalization(ComputationGraph([y]))
+    assert folded.outputs[0] is y
+
+
 class TestSimpleGetBatchNormalizationUpdates(object):
     def setUp(self):
         self.mlp = BatchNormalizedMLP([Tanh(), Tanh()], [5, 7, 9])
@@ -7,15 +7,18 @@ from blocks import bricks
 from blocks.bricks.base import application
 from blocks.graph import ComputationGraph
 from blocks.monitoring.aggregation import (
-    mean, Mean, Minimum, Maximum, Concatenate, Perplexity)
+    mean, Mean, Minimum, Maximum, Concatenate, Perplexity, Histogram,
+    Quantiles, histogram, quantiles)
 from blocks.utils import shared_floatx
+from blocks.utils.testing import benchmark
 
 from collections import OrderedDict
 from fuel.datasets import IndexableDataset
 from fuel.streams import DataStream
 from fuel.schemes import SequentialScheme
 
-from blocks.monitoring.evaluators import DatasetEvaluator, AggregationBuffer
+from blocks.monitoring.evaluators import (
+    DatasetEvaluator, ParallelDatasetEvaluator, AggregationBuffer)
 
 
 class TestBrick(bricks.Brick):
@@ -177,6 +180,99 @@ def test_concatenate_aggregator():
                     numpy.array([16, 12], dtype=theano.config.floatX))
 
 
+def test_concatenate_aggregator_reset():
+    x = tensor.vector('x')
+    y = (2 * x).copy('y')
+    aggregator = Concatenate(y).get_aggregator()
+    initialize = theano.function([], updates=aggregator.initialization_updates)
+    aggregate = theano.function([x], updates=aggregator.accumulation_updates)
+    readout = theano.function([], aggregator.readout_variable)
+
+    initialize()
+    assert readout().shape == (0, 0)
+    for i in range(3):
+        aggregate(numpy.array([i, i + 1], dtype=theano.config.floatX))
+    assert_allclose(readout(), [[0, 2], [2, 4], [4, 6]])
+    initialize()
+    aggregate(numpy.array([5, 6], dtype=theano.config.floatX))
+    assert_allclose(readout(), [[10, 12]])
+
+
+def test_concatenate_aggregator_inplace():
+    x = tensor.vector('x')
+    y = (2 * x).copy('y')
+    aggregator = Concatenate(y).get_aggregator()
+    storage, = aggregator.accumulators
+    initialize = theano.function([], updates=aggregator.initialization_updates)
+    for mode in ['FAST_RUN', 'FAST_COMPILE']:
+        aggregate = theano.function(
+            [x], updates=aggregator.accumulation_updates, mode=mode)
+        initialize()
+        list_ = storage.get_value(borrow=True)
+        for i in range(3):
+            aggregate(numpy.array([i, i + 1], dtype=theano.config.floatX))
+        # The values are appended to the same list, not to copies
+        assert storage.get_value(borrow=True) is list_
+        assert len(list_) == 3
+
+
+def test_concatenate_aggregator_benchmark():
+    x = tensor.vector('x')
+    y = (2 * x).copy('y')
+    aggregator = Concatenate(y).get_aggregator()
+    initialize = theano.function([], updates=aggregator.initialization_updates)
+    aggregate = theano.function([x], updates=aggregator.accumulation_updates)
+    readout = theano.function([], aggregator.readout_variable)
+    value = numpy.ones(100, dtype=theano.config.floatX)
+
+    def aggregate_batches(num_batches):
+        def run():
+            initialize()
+            for _ in range(num_batches):
+                aggregate(value)
+            readout()
+        return run
+    # The time should grow linearly with the number of batches
+    benchmark(OrderedDict(
+        ('concatenate over {} batches'.format(num_batches),
+         aggregate_batches(num_batches))
+        for num_batches in [1000, 2000, 4000]))
+
+
+def test_histogram_and_quantiles_aggregators():
+    rng = numpy.random.RandomState(1)
+    features = rng.exponential(size=(200, 50)).astype(theano.config.floatX)
+    dataset = IndexableDataset(OrderedDict([('features', features)]))
+    data_stream = DataStream(dataset,
+                             iteration_scheme=SequentialScheme(200, 10))
+
+    def get_variables():
+        x = tensor.matrix('features')
+        return [histogram(x.copy('histogram'), [0, 0.5, 1, 2]),
+                quantiles((2 * x).copy('quantiles'), (0.1, 0.5, 0.99))]
+
+    desired_counts, _ = numpy.histogram(numpy.clip(features, 0, 2),
+                                        [0, 0.5, 1, 2])
+    desired_quantiles = 2 * numpy.percentile(features, [10, 50, 99])
+    for evaluator in [DatasetEvaluator(get_variables()),
+                      ParallelDatasetEvaluator(get_variables(), num_workers=2,
+                                               batches_per_part=3)]:
+        values = evaluator.evaluate(data_stream)
+        assert_allclose(values['histogram'], desired_counts)
+        assert_allclose(values['quantiles'], desired_quantiles, rtol=1e-2)
+
+
+def test_histogram_needs_two_edges():
+    assert_raises_regex(ValueError, 'two bin edges',
+                        Histogram, tensor.vector(), [0])
+
+
+def test_quantiles_readout_without_data():
+    aggregator = Quantiles(tensor.vector('x')).get_aggregator()
+    theano.function([], updates=aggregator.initialization_updates)()
+    assert numpy.isnan(aggregator.readout_variable.eval()).all()
+
+
 def test_aggregation_buffer_name_uniqueness():
     x1 = tensor.scalar('x')
     x2 = tensor.scalar('x')
@@ -1,13 +1,36 @@
+from collections import OrderedDict
+
 import numpy
 import theano
-from fuel.datasets import IterableDataset
-from numpy.testing import assert_raises
+from fuel.datasets import IterableDataset, IndexableDataset
+from fuel.schemes import SequentialScheme
+from fuel.streams import DataStream
+from numpy.testing import assert_raises, assert_allclose
+from theano import tensor
 
 from blocks.graph import ComputationGraph
-from blocks.monitoring.evaluators import DatasetEvaluator
+from blocks.monitoring.aggregation import (
+    MonitoredQuantity, Minimum, Maximum, Concatenate, TakeLast)
+from blocks.monitoring.evaluators import (
+    DatasetEvaluator, ParallelDatasetEvaluator)
+from blocks.utils.testing import benchmark
 from tests.monitoring.test_aggregation import TestBrick
 
 
+class SumOfSquares(MonitoredQuantity):
+    def initialize(self):
+        self.total = 0.
+
+    def aggregate(self, x):
+        self.total += (x ** 2).sum()
+
+    def get_aggregated_value(self):
+        return self.total
+
+    def merge(self, other):
+        self.total += other.total
+
+
 def test_dataset_evaluators():
     X = theano.tensor.matrix('X')
     brick = TestBrick(name='test_brick')
@@ -32,3 +55,91 @@ def test_dataset_evaluators():
         data_stream = IterableDataset(dict(X2=data)).get_example_stream()
         validator.evaluate(data_stream)
     assert "Not all data sources" in ar.exception.args[0]
+
+
+def test_parallel_dataset_evaluator():
+    features = numpy.arange(42, dtype=theano.config.floatX).reshape(14, 3)
+    features[5] = -features[5]
+    dataset = IndexableDataset(OrderedDict([('features', features)]))
+    data_stream = DataStream(dataset,
+                             iteration_scheme=SequentialScheme(14, 3))
+
+    def get_variables():
+        x = tensor.matrix('features')
+        row_sums = x.sum(axis=1)
+        minimum = row_sums.min().copy('minimum')
+        minimum.tag.aggregation_scheme = Minimum(minimum)
+        maximum = x.max(axis=0).copy('maximum')
+        maximum.tag.aggregation_scheme = Maximum(maximum)
+        concatenated = row_sums.sum().copy('concatenated')
+        concatenated.tag.aggregation_scheme = Concatenate(concatenated)
+        last = x[-1].copy('last')
+        last.tag.aggregation_scheme = TakeLast(last)
+        return [x.mean().copy('mean'), minimum, maximum, concatenated, last,
+                SumOfSquares(requires=[x], name='sum_of_squares')]
+
+    expected = DatasetEvaluator(get_variables()).evaluate(data_stream)
+    evaluator = ParallelDatasetEvaluator(get_variables(), num_workers=2,
+                                         batches_per_part=1)
+    # Evaluate twice to check that the accumulators are reset
+    for _ in range(2):
+        values = evaluator.evaluate(data_stream)
+        assert list(values.keys()) == list(expected.keys())
+        for name in expected:
+            assert_allclose(values[name], expected[name])
+    # The initialization function is compiled before forking
+    assert evaluator.theano_buffer._initialize_fun is not None
+
+    # The updates would be lost in the workers
+    counter = theano.shared(0, name='counter')
+    assert_raises(ValueError, ParallelDatasetEvaluator, get_variables(),
+                  updates=[(counter, counter + 1)])
+
+
+def test_parallel_dataset_evaluator_benchmark():
+    rng = numpy.random.RandomState(1)
+    features = rng.rand(4096, 256).astype(theano.config.floatX)
+    dataset = IndexableDataset(OrderedDict([('features', features)]))
+    data_stream = DataStream(dataset,
+                             iteration_scheme=SequentialScheme(4096, 64))
+    W = theano.shared(rng.rand(256, 256).astype(theano.config.floatX))
+
+    def get_variables():
+        x = tensor.matrix('features')
+        h = x
+        for _ in range(8):
+            h = tensor.tanh(tensor.dot(h, W))
+        return [h.mean().copy('mean')]
+
+    evaluators = OrderedDict([
+        ('sequential evaluation', DatasetEvaluator(get_variables())),
+        ('parallel evaluation with 2 workers',
+         ParallelDatasetEvaluator(get_variables(), num_workers=2))])
+    values = [evaluator.evaluate(data_stream)['mean']
+              for evaluator in evaluators.values()]
+    assert_allclose(values[0], values[1], rtol=1e-5)
+    benchmark(OrderedDict(
+        (name, lambda evaluator=evaluator: evaluator.evaluate(data_stream))
+        for name, evaluator in evaluators.items()))
+
+
+class FailingSumOfSquares(SumOfSquares):
+    def aggregate(self, x):
+        if (x < 0).any():
+            raise ValueError("negative features")
+        super(FailingSumOfSquares, self).aggregate(x)
+
+
+def test_parallel_dataset_evaluator_error():
+    features = numpy.arange(42, dtype=theano.config.floatX).reshape(14, 3)
+    features[5] = -features[5]
+    dataset = IndexableDataset(OrderedDict([('features', features)]))
+    data_stream = DataStream(dataset,
+                             iteration_scheme=SequentialScheme(14, 3))
+    x = tensor.matrix('features')
+    evaluator = ParallelDatasetEvaluator(
+        [x.mean().copy('mean'),
+         FailingSumOfSquares(requires=[x], name='sum_of_squares')],
+        num_workers=2, batches_per_part=1)
+    # The error of a worker is raised instead of blocking forever
+    assert_raises(ValueError, evaluator.evaluate, data_stream)
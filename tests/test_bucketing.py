@@ -0,0 +1,135 @@
+from collections import OrderedDict
+
+import numpy
+import theano
+from numpy.testing import assert_allclose, assert_raises
+from fuel.datasets import IndexableDataset, IterableDataset
+from fuel.streams import DataStream
+from fuel.schemes import ConstantScheme
+from fuel.transformers import Batch, Padding
+from theano import tensor
+
+from blocks.bricks import Tanh
+from blocks.bricks.recurrent import SimpleRecurrent
+from blocks.bucketing import (BucketedBatch, ContiguousChunks,
+                              LengthBucketScheme, PaddingRatio,
+                              bucket_batches)
+from blocks.extensions import FinishAfter
+from blocks.graph import ComputationGraph
+from blocks.initialization import Constant, Orthogonal
+from blocks.utils.testing import MockMainLoop
+
+
+def get_sequences():
+    rng = numpy.random.RandomState(1)
+    lengths = rng.randint(1, 30, size=50)
+    return [numpy.arange(length) for length in lengths]
+
+
+def test_bucket_batches():
+    lengths = [5, 1, 7, 2, 9, 3]
+    batches = bucket_batches(lengths, 2, [3, 7])
+    assert batches == [[1, 3], [5], [0, 2], [4]]
+    batches = bucket_batches(lengths, 2, [3, 7], window_size=3)
+    assert batches == [[1], [0, 2], [3, 5], [4]]
+    batches = bucket_batches(lengths, 2, [3, 7],
+                             rng=numpy.random.RandomState(1))
+    assert sorted(batches) == [[0, 2], [1, 3], [4], [5]]
+
+
+def test_length_bucket_scheme():
+    sequences = get_sequences()
+    lengths = [len(sequence) for sequence in sequences]
+    scheme = LengthBucketScheme(lengths, 8, [5, 10, 20])
+    batches = list(scheme.get_request_iterator())
+    assert sorted(sum(batches, [])) == list(range(len(sequences)))
+    assert all(len(batch) <= 8 for batch in batches)
+    for batch in batches:
+        buckets = set(numpy.searchsorted([5, 10, 20], [lengths[i]
+                                                       for i in batch]))
+        assert len(buckets) == 1
+
+    # Less padding than with random batches
+    naive = 0
+    for start in range(0, len(lengths), 8):
+        batch = lengths[start:start + 8]
+        naive += len(batch) * max(batch)
+    assert scheme.padding_ratio < 1 - float(sum(lengths)) / naive
+
+    dataset = IndexableDataset(OrderedDict([('features', sequences)]))
+    stream = Padding(DataStream(dataset, iteration_scheme=scheme))
+    main_loop = MockMainLoop(data_stream=stream,
+                             extensions=[FinishAfter(after_n_epochs=1),
+                                         PaddingRatio(scheme)])
+    main_loop.run()
+    assert (main_loop.log.current_row['padding_ratio'] ==
+            scheme.padding_ratio)
+
+
+def test_bucketed_batch():
+    sequences = get_sequences()
+    dataset = IterableDataset(OrderedDict([('features', sequences)]))
+    batching = BucketedBatch(dataset.get_example_stream(), 8, [5, 10, 20],
+                             window_size=20)
+    stream = Padding(batching)
+    total = 0
+    for features, mask in stream.get_epoch_iterator():
+        assert len(features) <= 8
+        assert features.shape == mask.shape
+        total += mask.sum()
+    assert total == sum(len(sequence) for sequence in sequences)
+    assert 0 < batching.padding_ratio < 1
+    assert batching.padding_ratio == 1 - total / float(batching.padded_steps)
+
+    assert_raises(ValueError, BucketedBatch, stream, 8, [5], 20)
+
+
+def test_contiguous_chunks():
+    rng = numpy.random.RandomState(1)
+    lengths = [7, 3, 12, 1, 5, 9, 4]
+    documents = [rng.uniform(size=(length, 3)).astype(theano.config.floatX)
+                 for length in lengths]
+    dataset = IterableDataset(OrderedDict([
+        ('features', documents),
+        ('ids', [numpy.repeat(i, length)
+                 for i, length in enumerate(lengths)]),
+        ('positions', [numpy.arange(length) for length in lengths])]))
+    chunking = ContiguousChunks(dataset.get_example_stream(), 3, 4)
+    assert chunking.sources == ('features', 'features_mask', 'ids',
+                                'ids_mask', 'positions', 'positions_mask',
+                                'reset')
+
+    rnn = SimpleRecurrent(dim=3, activation=Tanh(),
+                          weights_init=Orthogonal(),
+                          biases_init=Constant(0))
+    rnn.initialize()
+    x = tensor.tensor3('features')
+    mask = tensor.matrix('features_mask')
+    reset = tensor.vector('reset')
+    carried = rnn.apply(inputs=x, mask=mask, carry_states=True, reset=reset)
+    carry = theano.function([x, mask, reset], carried,
+                            updates=ComputationGraph(carried).updates)
+    whole = theano.function([x], rnn.apply(inputs=x))
+    expected = [whole(document[:, None])[:, 0] for document in documents]
+
+    for epoch in range(2):
+        steps = 0
+        for (features, features_mask, ids, _, positions, _,
+             resets) in chunking.get_epoch_iterator():
+            assert features.shape[1] == 3
+            assert features.shape[0] <= 4
+            states = carry(features, features_mask, resets)
+            for i in range(3):
+                row = features_mask[:, i] == 1
+                if not row.any():
+                    continue
+                assert resets[i] == (positions[0, i] == 0)
+                assert_allclose(
+                    states[row, i],
+                    expected[ids[0, i]][positions[row, i]], rtol=1e-5)
+                steps += row.sum()
+        assert steps == sum(lengths)
+
+    assert_raises(ValueError, ContiguousChunks,
+                  Batch(dataset.get_example_stream(), ConstantScheme(2)),
+                  3, 4)
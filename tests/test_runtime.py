@@ -0,0 +1,111 @@
+import os
+import subprocess
+import sys
+from tempfile import NamedTemporaryFile
+
+import numpy
+import theano
+from numpy.testing import assert_allclose, assert_raises
+from theano import tensor
+
+from blocks.bricks import (
+    BatchNormalization, GatedRecurrent, Linear, LSTM, LeakyRectifier, MLP,
+    Maxout, Rectifier, Sequence, SimpleRecurrent, Softmax, Tanh)
+from blocks.bricks.lookup import LookupTable
+from blocks.export import export
+from blocks.initialization import Constant, IsotropicGaussian
+from blocks.model import Model
+from blocks.runtime import Layer, Recurrent, load
+from blocks.serialization import dump
+
+floatX = theano.config.floatX
+
+
+def export_and_load(model, checkpoint=None):
+    with NamedTemporaryFile(suffix='.npz', delete=False) as f:
+        pass
+    export(model, f.name)
+    runtime = load(f.name, checkpoint)
+    os.remove(f.name)
+    return runtime
+
+
+def test_export_feedforward():
+    x = tensor.matrix('features')
+    mlp = MLP([Tanh(), LeakyRectifier(leak=0.1), Rectifier(), Softmax()],
+              [4, 5, 6, 7, 3], weights_init=IsotropicGaussian(1),
+              biases_init=IsotropicGaussian(1))
+    mlp.initialize()
+    bn = BatchNormalization(input_dim=3)
+    bn.initialize()
+    rng = numpy.random.RandomState(1)
+    bn.population_mean.set_value(rng.rand(3).astype(floatX))
+    bn.population_stdev.set_value(rng.rand(3).astype(floatX) + 1)
+    model = Model(bn.apply(mlp.apply(x)))
+
+    features = rng.rand(10, 4).astype(floatX)
+    runtime = export_and_load(model)
+    assert_allclose(runtime.apply(features),
+                    model.get_theano_function()(features)[0], rtol=1e-5)
+
+    # Parameters from a checkpoint replace the exported ones
+    with NamedTemporaryFile(delete=False) as f:
+        for parameter in model.parameters:
+            parameter.set_value(parameter.get_value() * 2)
+        dump(None, f, parameters=model.parameters)
+    runtime = export_and_load(model)
+    for parameter in model.parameters:
+        parameter.set_value(parameter.get_value() / 2)
+    runtime_from_checkpoint = export_and_load(model, f.name)
+    os.remove(f.name)
+    assert_allclose(runtime_from_checkpoint.apply(features),
+                    runtime.apply(features), rtol=1e-5)
+
+    maxout = Maxout(num_pieces=2)
+    assert_raises(ValueError, export, [maxout], 'unused.npz')
+
+
+def test_export_recurrent():
+    rng = numpy.random.RandomState(1)
+    indices = rng.randint(10, size=(6, 3))
+    mask = numpy.ones((6, 3), dtype=floatX)
+    mask[4:, 1] = 0
+    x = tensor.lmatrix('indices')
+    x_mask = tensor.matrix('indices_mask')
+    for transition, input_dim in [
+            (SimpleRecurrent(dim=5, activation=Tanh()), 5),
+            (LSTM(dim=5), 20), (GatedRecurrent(dim=5), 15)]:
+        lookup = LookupTable(10, 4)
+        linear = Linear(4, input_dim)
+        for brick in [lookup, linear, transition]:
+            brick.weights_init = IsotropicGaussian(0.5)
+            brick.biases_init = Constant(0.1)
+            brick.initialize()
+        inputs = linear.apply(lookup.apply(x))
+        if isinstance(transition, GatedRecurrent):
+            states = transition.apply(inputs=inputs[:, :, :5],
+                                      gate_inputs=inputs[:, :, 5:],
+                                      mask=x_mask)
+        elif isinstance(transition, LSTM):
+            states, _ = transition.apply(inputs, mask=x_mask)
+        else:
+            states = transition.apply(inputs, mask=x_mask)
+        expected = theano.function([x, x_mask], states)(indices, mask)
+        runtime = export_and_load(Model(states))
+        assert_allclose(runtime.apply(indices, mask), expected, rtol=1e-5,
+                        atol=1e-6)
+
+    sequence = Sequence([lookup.apply, linear.apply])
+    assert len(export_and_load([sequence]).layers[0].layers) == 2
+
+
+def test_abstract_layers():
+    assert_raises(TypeError, Layer)
+    assert_raises(TypeError, Recurrent)
+
+
+def test_runtime_does_not_import_theano():
+    subprocess.check_call([
+        sys.executable, '-c',
+        "import sys; import blocks.runtime; "
+        "assert 'theano' not in sys.modules"])
@@ -1,7 +1,7 @@
 import numpy
 import theano
 from theano import tensor
-from numpy.testing import assert_allclose
+from numpy.testing import assert_allclose, assert_raises
 
 from blocks.bricks import Tanh, Initializable
 from blocks.bricks.attention import SequenceContentAttention
@@ -13,7 +13,8 @@ from blocks.bricks.sequence_generators import (
 from blocks.graph import ComputationGraph
 from blocks.initialization import IsotropicGaussian
 from blocks.filter import VariableFilter
-from blocks.search import BeamSearch
+from blocks.search import (
+    BeamSearch, GreedySearch, LengthNormalizedScorer, SamplingSearch)
 
 
 class SimpleGenerator(Initializable):
@@ -115,3 +116,210 @@ def test_beam_search():
                                      0, 3 * length)
     for i in range(len(results2)):
         assert results2[i] == list(results.T[i, :mask.T[i].sum()])
+
+
+def build_samples(alphabet_size):
+    simple_generator = SimpleGenerator(10, alphabet_size, seed=1234)
+    simple_generator.weights_init = IsotropicGaussian(0.5)
+    simple_generator.biases_init = IsotropicGaussian(0.5)
+    simple_generator.initialize()
+
+    inputs = tensor.lmatrix('inputs')
+    samples, = VariableFilter(
+            applications=[simple_generator.generator.generate],
+            name="outputs")(
+        ComputationGraph(simple_generator.generate(inputs)))
+    return inputs, samples
+
+
+def test_beam_search_batch():
+    rng = numpy.random.RandomState(1234)
+    alphabet_size = 20
+    beam_size = 5
+    length = 8
+    batch_size = 3
+
+    inputs, samples = build_samples(alphabet_size)
+    input_vals = rng.randint(alphabet_size, size=(length, batch_size))
+    search = BeamSearch(samples)
+    results = search.search_batch({inputs: input_vals}, 0, 3 * length,
+                                  beam_size)
+    assert len(results) == batch_size
+    for i, (outputs, costs) in enumerate(results):
+        tiled_vals = numpy.tile(input_vals[:, i:i + 1], (1, beam_size))
+        outputs2, costs2 = search.search({inputs: tiled_vals},
+                                         0, 3 * length)
+        assert outputs == outputs2
+        assert_allclose(costs, costs2, rtol=1e-5)
+
+
+def test_beam_search_fused_step():
+    rng = numpy.random.RandomState(1234)
+    alphabet_size = 20
+    beam_size = 5
+    length = 8
+
+    inputs, samples = build_samples(alphabet_size)
+    input_vals = rng.randint(alphabet_size, size=(length, 3))
+    results = BeamSearch(samples).search_batch(
+        {inputs: input_vals}, 0, 3 * length, beam_size)
+    fused_results = BeamSearch(samples, fused_step=True).search_batch(
+        {inputs: input_vals}, 0, 3 * length, beam_size)
+    for (outputs, costs), (outputs2, costs2) in zip(results, fused_results):
+        assert outputs == outputs2
+        assert_allclose(costs, costs2, rtol=1e-5)
+
+
+def test_length_normalized_scorer():
+    scorer = LengthNormalizedScorer(alpha=1., beta=1.)
+    costs = numpy.array([[6., 12.], [6., 6.]])
+    lengths = numpy.array([1., 7.])
+    coverages = numpy.array([[0.5, 2., 0.], [1., 1., 1.]])
+    assert_allclose(scorer.score(costs, lengths, coverages),
+                    [[6. - numpy.log(0.5), 12. - numpy.log(0.5)],
+                     [3., 3.]])
+    assert_allclose(scorer.lower_bound(costs[:, 0], lengths, 13), [2., 2.])
+
+
+def test_beam_search_scorer_and_early_stopping():
+    rng = numpy.random.RandomState(1234)
+    alphabet_size = 20
+    beam_size = 5
+    length = 8
+
+    inputs, samples = build_samples(alphabet_size)
+    input_vals = rng.randint(alphabet_size, size=(length, 3))
+    search = BeamSearch(samples)
+    results = search.search_batch({inputs: input_vals}, 0, 3 * length,
+                                  beam_size)
+
+    # Without penalties the scores are the costs
+    results2 = search.search_batch(
+        {inputs: input_vals}, 0, 3 * length, beam_size,
+        scorer=LengthNormalizedScorer(alpha=0.))
+    for (outputs, costs), (outputs2, costs2) in zip(results, results2):
+        assert outputs == outputs2
+        assert_allclose(costs, costs2, rtol=1e-5)
+
+    # The best sequence does not change when stopping early
+    results2 = search.search_batch({inputs: input_vals}, 0, 3 * length,
+                                   beam_size, early_stopping=True)
+    for (outputs, costs), (outputs2, costs2) in zip(results, results2):
+        assert outputs[0] == outputs2[0]
+        assert_allclose(costs[0], costs2[0], rtol=1e-5)
+
+    scorer = LengthNormalizedScorer(alpha=1., beta=0.2)
+    for outputs, costs in search.search_batch(
+            {inputs: input_vals}, 0, 3 * length, beam_size,
+            scorer=scorer, early_stopping=True):
+        lengths = numpy.array([len(output) for output in outputs])
+        assert outputs[0][-1] == 0
+        assert len(outputs) == beam_size
+        assert numpy.all(numpy.isfinite(costs))
+        assert numpy.all(lengths <= 3 * length)
+
+
+def test_beam_search_shortlist():
+    rng = numpy.random.RandomState(1234)
+    alphabet_size = 20
+    beam_size = 5
+    length = 8
+
+    inputs, samples = build_samples(alphabet_size)
+    input_vals = rng.randint(alphabet_size, size=(length, 3))
+    readout = BeamSearch(samples).generator.readout
+    assert_raises(ValueError, BeamSearch, samples, shortlisting=True)
+    assert_raises(ValueError, BeamSearch(
+        samples, shortlisting=True,
+        output_projection=readout.feedback_brick).compile)
+    search = BeamSearch(samples, shortlisting=True,
+                        output_projection=[readout.merge,
+                                           readout.post_merge])
+    search.compile()
+
+    # The shortlisted probabilities are renormalized full ones
+    contexts, states, _ = search.compute_initial_states_and_contexts(
+        {inputs: input_vals})
+    shortlist = numpy.array([0, 3, 4, 11, 19])
+    logprobs = search.compute_logprobs(contexts, states)[:, shortlist]
+    logprobs += numpy.log(numpy.exp(-logprobs).sum(axis=1))[:, None]
+    assert_allclose(search.compute_logprobs(contexts, states, shortlist),
+                    logprobs, rtol=1e-5)
+
+    results = search.search_batch({inputs: input_vals}, 0, 3 * length,
+                                  beam_size)
+    results2 = search.search_batch(
+        {inputs: input_vals}, 0, 3 * length, beam_size,
+        shortlists=[numpy.arange(alphabet_size)] * 3)
+    for (outputs, costs), (outputs2, costs2) in zip(results, results2):
+        assert outputs == outputs2
+        assert_allclose(costs, costs2, rtol=1e-5)
+
+    shortlists = [[3, 4, 5, 6, 7], [11, 19, 7, 8, 2, 1],
+                  [5, 9, 12, 13, 14]]
+    results = search.search_batch({inputs: input_vals}, 0, 3 * length,
+                                  beam_size, shortlists=shortlists)
+    for (outputs, costs), shortlist in zip(results, shortlists):
+        for output in outputs:
+            assert set(output) <= set(shortlist) | {0}
+
+
+def test_greedy_search():
+    rng = numpy.random.RandomState(1234)
+    alphabet_size = 20
+    length = 8
+
+    inputs, samples = build_samples(alphabet_size)
+    input_vals = rng.randint(alphabet_size, size=(length, 3))
+    results = BeamSearch(samples).search_batch(
+        {inputs: input_vals}, 0, 3 * length, 1)
+    outputs, costs = GreedySearch(samples).search(
+        {inputs: input_vals}, 0, 3 * length)
+    for (beam_outputs, beam_costs), output, cost in zip(
+            results, outputs, costs):
+        assert beam_outputs[0] == output
+        assert_allclose(beam_costs[0], cost, rtol=1e-5)
+
+    outputs, mask, costs = GreedySearch(samples).search(
+        {inputs: input_vals}, 0, 0, as_arrays=True)
+    assert outputs.shape == mask.shape == costs.shape == (0, 3)
+
+
+def test_sampling_search():
+    rng = numpy.random.RandomState(1234)
+    alphabet_size = 20
+    length = 8
+
+    inputs, samples = build_samples(alphabet_size)
+    input_vals = rng.randint(alphabet_size, size=(length, 3))
+    outputs, mask, costs = SamplingSearch(samples, seed=1).search(
+        {inputs: input_vals}, 0, 3 * length, as_arrays=True)
+    outputs2, mask2, costs2 = SamplingSearch(samples, seed=1).search(
+        {inputs: input_vals}, 0, 3 * length, as_arrays=True)
+    assert numpy.all(outputs == outputs2)
+    assert_allclose(costs, costs2)
+    assert numpy.all(costs[mask == 0] == 0)
+    assert numpy.all(costs[mask == 1] > 0)
+    assert_raises(ValueError, SamplingSearch, samples, seed=0)
+
+
+def test_beam_search_cache():
+    rng = numpy.random.RandomState(1234)
+    alphabet_size = 20
+    beam_size = 5
+    length = 8
+
+    inputs, samples = build_samples(alphabet_size)
+    input_vals = [rng.randint(alphabet_size, size=(length, 3))
+                  for _ in range(3)]
+    search = BeamSearch(samples)
+    cached_search = BeamSearch(samples, cache_size=2)
+    for i in [0, 1, 0, 2, 1, 0]:
+        results = search.search_batch({inputs: input_vals[i]}, 0,
+                                      3 * length, beam_size)
+        results2 = cached_search.search_batch({inputs: input_vals[i]}, 0,
+                                              3 * length, beam_size)
+        for (outputs, costs), (outputs2, costs2) in zip(results, results2):
+            assert outputs == outputs2
+            assert_allclose(costs, costs2, rtol=1e-5)
+    assert len(cached_search._cache) == 2
@@ -0,0 +1,167 @@
+import os
+import threading
+import time
+from tempfile import NamedTemporaryFile, mkdtemp
+
+import numpy
+import theano
+from numpy.testing import assert_allclose, assert_raises
+from theano import tensor
+
+from blocks.bricks import MLP, Tanh
+from blocks.bricks.recurrent import SimpleRecurrent
+from blocks.initialization import Constant, IsotropicGaussian
+from blocks.model import Model
+from blocks.serialization import dump
+from blocks.serving import InferenceClient, InferenceServer
+
+floatX = theano.config.floatX
+
+
+def test_inference_server():
+    x = tensor.matrix('features')
+    mlp = MLP([Tanh(), None], [4, 5, 3], weights_init=Constant(1),
+              biases_init=Constant(0))
+    mlp.initialize()
+    model = Model(mlp.apply(x))
+    with NamedTemporaryFile(delete=False) as f:
+        dump(None, f, parameters=model.parameters)
+    for parameter in model.parameters:
+        parameter.set_value(parameter.get_value() * 0)
+
+    server = InferenceServer.from_model(model, f.name, max_batch_size=4,
+                                        max_wait=0.5)
+    os.remove(f.name)
+    server.start()
+    features = numpy.random.RandomState(1).rand(8, 4).astype(floatX)
+    expected = model.get_theano_function()(features)[0]
+    results = [None] * len(features)
+
+    def request(i):
+        client = InferenceClient(server.address, server.authkey)
+        results[i], = client.infer({'features': features[i]})
+        client.close()
+    threads = [threading.Thread(target=request, args=(i,))
+               for i in range(len(features))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert_allclose(numpy.array(results), expected, rtol=1e-5)
+
+    client = InferenceClient(server.address, server.authkey)
+    statistics = client.statistics()
+    assert sum(size * count for size, count
+               in statistics['batch_sizes'].items()) == len(features)
+    assert max(statistics['batch_sizes']) <= 4
+    assert statistics['latency_p50'] <= statistics['latency_p99']
+    assert_raises(Exception, client.infer, {'features': features[:, :2]})
+    client.close()
+    assert_raises(Exception, InferenceClient, server.address, b'wrong')
+
+    # Malformed requests only fail themselves
+    requests = [{'features': features[0]}, {'features': features[1, :2]},
+                {}, {'features': features[2].astype('float64')}]
+    results = [None] * len(requests)
+
+    def request_or_error(i):
+        client = InferenceClient(server.address, server.authkey)
+        try:
+            results[i], = client.infer(requests[i])
+        except Exception as e:
+            results[i] = e
+        client.close()
+    threads = [threading.Thread(target=request_or_error, args=(i,))
+               for i in range(len(requests))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert_allclose(results[0], expected[0], rtol=1e-5)
+    assert isinstance(results[1], Exception)
+    assert isinstance(results[2], KeyError)
+    assert_allclose(results[3], expected[2], rtol=1e-5)
+    server.stop()
+
+
+def test_inference_server_sequences():
+    x = tensor.tensor3('features')
+    mask = tensor.matrix('features_mask')
+    rnn = SimpleRecurrent(dim=3, activation=Tanh(),
+                          weights_init=IsotropicGaussian(0.1))
+    rnn.initialize()
+    h = rnn.apply(x, mask=mask)
+    function = theano.function([x, mask], [h[-1]])
+
+    directory = mkdtemp()
+    server = InferenceServer(
+        function, ['features', 'features_mask'], max_wait=0.1,
+        sequence_inputs={'features': 'features_mask'},
+        address=os.path.join(directory, 'socket'))
+    server.start()
+    rng = numpy.random.RandomState(1)
+    sequences = [rng.rand(length, 3).astype(floatX) for length in [2, 5]]
+    results = [server.infer({'features': sequence})[0]
+               for sequence in sequences]
+    for sequence, result in zip(sequences, results):
+        expected, = function(sequence[:, None],
+                             numpy.ones((len(sequence), 1), dtype=floatX))
+        assert_allclose(result, expected[0], rtol=1e-5)
+
+    # Padded requests in one batch give the same results
+    batched = [None] * len(sequences)
+
+    def request(i):
+        client = InferenceClient(server.address, server.authkey)
+        batched[i], = client.infer({'features': sequences[i]})
+        client.close()
+    threads = [threading.Thread(target=request, args=(i,))
+               for i in range(len(sequences))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert_allclose(numpy.array(batched), numpy.array(results), rtol=1e-5)
+    server.stop()
+    os.rmdir(directory)
+
+
+def test_inference_server_stop():
+    started = threading.Event()
+    release = threading.Event()
+
+    def function(features):
+        started.set()
+        release.wait()
+        return [2 * features]
+    server = InferenceServer(function, ['features'], max_batch_size=1,
+                             max_wait=0)
+    server.start()
+    results = [None] * 3
+
+    def request(i):
+        try:
+            results[i], = server.infer({'features': numpy.ones(2) * i})
+        except Exception as e:
+            results[i] = e
+    threads = [threading.Thread(target=request, args=(0,))]
+    threads[0].start()
+    started.wait()
+    threads.extend(threading.Thread(target=request, args=(i,))
+                   for i in range(1, 3))
+    for thread in threads[1:]:
+        thread.start()
+    while server._requests.qsize() < 2:
+        time.sleep(0.01)
+
+    # The batch being computed is finished, the queued requests fail
+    stop = threading.Thread(target=server.stop)
+    stop.start()
+    server._stopped.wait()
+    release.set()
+    stop.join()
+    for thread in threads:
+        thread.join()
+    assert_allclose(results[0], numpy.zeros(2))
+    assert all(isinstance(result, RuntimeError) for result in results[1:])
+    assert_raises(RuntimeError, server.infer, {'features': numpy.ones(2)})